@@ -20,6 +20,7 @@ import os
 import pprint
 import signal
 import subprocess
+import threading
 import time
 
 
@@ -46,11 +47,85 @@ class CommandFailedError(Exception):
         self.rc = rc
 
 
+class ProcessGroupTracker(object):
+
+    """Records the processes that BasicEnv.cmd() starts on threads
+    where this is installed with set_process_tracker().  Each is put
+    in a process group of its own, so that kill() also kills anything
+    they have started, e.g. so that a hung command can be timed out.
+
+    Note that Ctrl-C does not reach commands in other process groups.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pids = []
+        self.killed = False
+
+    def add(self, process):
+        self._lock.acquire()
+        try:
+            self._pids.append(process.pid)
+            killed = self.killed
+        finally:
+            self._lock.release()
+        if killed:
+            self._kill_group(process.pid, signal.SIGKILL)
+
+    def kill(self, sig=signal.SIGKILL):
+        self._lock.acquire()
+        try:
+            self.killed = True
+            pids = list(self._pids)
+        finally:
+            self._lock.release()
+        for pid in pids:
+            self._kill_group(pid, sig)
+
+    def _kill_group(self, pid, sig):
+        try:
+            os.killpg(pid, sig)
+        except OSError, exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+
+_tracking = threading.local()
+
+
+def get_process_tracker():
+    return getattr(_tracking, "tracker", None)
+
+
+def set_process_tracker(tracker):
+    # Returns the previous tracker so that it can be restored.
+    previous = get_process_tracker()
+    _tracking.tracker = tracker
+    return previous
+
+
+def _in_new_process_group(preexec_fn):
+    def func():
+        os.setpgid(0, 0)
+        if preexec_fn is not None:
+            preexec_fn()
+    return func
+
+
 class BasicEnv(object):
 
     def cmd(self, args, do_wait=True, fork=True, **kwargs):
         if fork:
+            tracker = get_process_tracker()
+            if tracker is not None:
+                if tracker.killed:
+                    raise CommandFailedError(
+                        "Command cancelled: %s" % args, -signal.SIGKILL)
+                kwargs["preexec_fn"] = _in_new_process_group(
+                    kwargs.get("preexec_fn"))
             process = subprocess.Popen(args, **kwargs)
+            if tracker is not None:
+                tracker.add(process)
             if do_wait:
                 rc = process.wait()
                 if rc != 0:
@@ -17,6 +17,8 @@
 
 import os
 import tempfile
+import threading
+import time
 import unittest
 
 import cmd_env
@@ -57,5 +59,31 @@ class WriteFileToEnvTest(unittest.TestCase):
             os.remove(filename)
 
 
+class ProcessGroupTrackerTest(unittest.TestCase):
+
+    def test_kill_includes_grandchildren(self):
+        pid_file = tempfile.mktemp()
+        tracker = cmd_env.ProcessGroupTracker()
+        previous = cmd_env.set_process_tracker(tracker)
+        try:
+            threading.Timer(0.2, tracker.kill).start()
+            self.assertRaises(
+                cmd_env.CommandFailedError,
+                lambda: cmd_env.call(["sh", "-c", 'sleep 60 & echo $! >"$0"; '
+                                      'wait', pid_file]))
+            # Commands started after the kill are not run.
+            self.assertRaises(cmd_env.CommandFailedError,
+                              lambda: cmd_env.call(["true"]))
+        finally:
+            cmd_env.set_process_tracker(previous)
+        sleep_pid = int(cmd_env.read_file(pid_file))
+        os.remove(pid_file)
+        for i in range(100):
+            if not os.path.exists("/proc/%i" % sleep_pid):
+                break
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists("/proc/%i" % sleep_pid))
+        cmd_env.call(["true"])
+
 if __name__ == "__main__":
     unittest.main()
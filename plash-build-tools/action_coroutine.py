@@ -0,0 +1,223 @@
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Support for leaf actions written as generators, so that many actions
+that mostly wait for commands can share one thread.
+
+Instead of blocking, such an action yields what it is waiting for and
+is resumed with the result:
+
+  def build(self, log):
+      proc = self._env.cmd(["make"], do_wait=False)
+      rc = yield proc
+      if rc != 0:
+          raise Exception("make failed")
+
+An action can yield a subprocess.Popen (resumed with its return
+code), a list of them (resumed with a list of return codes), or a
+number of seconds to sleep for (resumed with None).
+
+When run by a CoroutineLoop with a timeout, commands started through
+cmd_env are killed on expiry (see action_timeout), and ActionTimeout
+is raised inside the action.
+"""
+
+import inspect
+import subprocess
+import sys
+import threading
+import time
+import types
+
+import action_timeout
+
+
+def is_coroutine_action(action):
+    # Look through wrappers such as action_tree.AnnotatedAction.
+    while not (inspect.isfunction(action) or inspect.ismethod(action)):
+        action = action.__dict__.get("_action")
+        if action is None:
+            return False
+    return inspect.isgeneratorfunction(action)
+
+
+def is_generator(value):
+    return isinstance(value, types.GeneratorType)
+
+
+def _check_waitable(waitable):
+    if isinstance(waitable, (list, tuple)):
+        for proc in waitable:
+            assert isinstance(proc, subprocess.Popen), proc
+    else:
+        assert isinstance(waitable, (subprocess.Popen, int, float)), \
+            waitable
+
+
+def wait_for(waitable):
+    _check_waitable(waitable)
+    if isinstance(waitable, subprocess.Popen):
+        return waitable.wait()
+    elif isinstance(waitable, (list, tuple)):
+        return [proc.wait() for proc in waitable]
+    else:
+        time.sleep(waitable)
+        return None
+
+
+def run_to_completion(generator):
+    """Runs a coroutine action in the calling thread, blocking on
+    each thing it waits for in turn."""
+    value = None
+    while True:
+        try:
+            waitable = generator.send(value)
+        except StopIteration:
+            return
+        value = wait_for(waitable)
+
+
+class _Waiting(object):
+
+    def __init__(self, generator, on_done, timeout):
+        self.generator = generator
+        self.on_done = on_done
+        self.waitable = None
+        self.deadline = None
+        self.timeout = timeout
+        self.expires = None
+        self.tracker = None
+        if timeout is not None:
+            self.expires = time.time() + timeout
+            self.tracker = action_timeout.make_tracker()
+
+    def kill(self):
+        action_timeout.kill(self.tracker)
+        if isinstance(self.waitable, subprocess.Popen):
+            procs = [self.waitable]
+        elif isinstance(self.waitable, (list, tuple)):
+            procs = self.waitable
+        else:
+            procs = []
+        for proc in procs:
+            if proc.poll() is None:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+
+    def poll(self, now):
+        if isinstance(self.waitable, subprocess.Popen):
+            return self.waitable.poll() is not None, self.waitable.returncode
+        elif isinstance(self.waitable, (list, tuple)):
+            for proc in self.waitable:
+                if proc.poll() is None:
+                    return False, None
+            return True, [proc.returncode for proc in self.waitable]
+        else:
+            return now >= self.deadline, None
+
+
+class CoroutineLoop(object):
+
+    """Runs coroutine actions on a single daemon thread.
+
+    Child processes are polled, because reaping them with waitpid(-1)
+    would steal them from other threads' subprocess.Popen objects.
+    """
+
+    def __init__(self, poll_interval=0.01):
+        self._poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._new = []
+        self._stopped = False
+        thread = threading.Thread(target=self._run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def add(self, generator, on_done, timeout=None):
+        """on_done is called on the loop's thread with None, or with
+        sys.exc_info() if the coroutine raised."""
+        self._lock.acquire()
+        try:
+            self._new.append(_Waiting(generator, on_done, timeout))
+        finally:
+            self._lock.release()
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def _step(self, item, value, waiting, exception=None):
+        previous = action_timeout.set_tracker(item.tracker)
+        try:
+            if exception is None:
+                item.waitable = item.generator.send(value)
+            else:
+                item.waitable = item.generator.throw(exception)
+            _check_waitable(item.waitable)
+        except StopIteration:
+            item.on_done(None)
+            return
+        except:
+            item.on_done(sys.exc_info())
+            return
+        finally:
+            action_timeout.set_tracker(previous)
+        if exception is not None:
+            # It ignored the timeout, so just wait for it to finish.
+            item.expires = None
+        if isinstance(item.waitable, (int, float)):
+            item.deadline = time.time() + item.waitable
+        waiting.append(item)
+
+    def _run(self):
+        waiting = []
+        while not self._stopped:
+            self._wakeup.clear()
+            self._lock.acquire()
+            try:
+                new, self._new = self._new, []
+            finally:
+                self._lock.release()
+            still_waiting = []
+            for item in new:
+                self._step(item, None, still_waiting)
+            now = time.time()
+            for item in waiting:
+                ready, value = item.poll(now)
+                if item.expires is not None and now >= item.expires:
+                    item.kill()
+                    self._step(item, None, still_waiting,
+                               action_timeout.ActionTimeout(
+                                   action_timeout.describe(item.timeout)))
+                elif ready:
+                    self._step(item, value, still_waiting)
+                else:
+                    still_waiting.append(item)
+            waiting = still_waiting
+            timeout = self._poll_interval
+            for item in waiting:
+                for deadline in (item.deadline, item.expires):
+                    if deadline is not None:
+                        timeout = max(0, min(timeout, deadline - now))
+            if len(waiting) == 0:
+                timeout = None
+            self._wakeup.wait(timeout)
@@ -0,0 +1,250 @@
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Filter expressions for selecting parts of an action tree.
+
+A pattern selects the actions it matches together with everything
+inside them.  Patterns are:
+
+  name            an action with this name
+  sub.name        an action called "name" inside one called "sub"
+  na*e            shell-style wildcards, matched per dotted component
+  /regexp/        a regular expression searched for in the full
+                  dotted path of the action
+
+Patterns can be combined with "and", "or", "not" and parentheses.
+"-pattern" is short for "not pattern".  For example:
+
+  -f "debs and not (i386 or /^all\\.slow/)"
+
+A leaf action is kept if the expression is true for it.  Other nodes
+are kept if the expression is true for them or if any of their
+descendants are kept.
+"""
+
+import fnmatch
+import re
+
+import action_index
+
+
+class FilterSyntaxError(ValueError):
+
+    pass
+
+
+class NameAtom(object):
+
+    def __init__(self, text):
+        self._components = text.split(".")
+        if action_index.is_glob(text):
+            self._match = fnmatch.fnmatchcase
+        else:
+            self._match = lambda x, y: x == y
+
+    def matches(self, path):
+        if len(self._components) > len(path):
+            return False
+        for name, component in zip(path[-len(self._components):],
+                                   self._components):
+            if not self._match(name, component):
+                return False
+        return True
+
+
+class RegexpAtom(object):
+
+    def __init__(self, text):
+        try:
+            self._regexp = re.compile(text)
+        except re.error, exc:
+            raise FilterSyntaxError("Bad regular expression %r: %s"
+                                    % (text, exc))
+
+    def matches(self, path):
+        return self._regexp.search(".".join(path)) is not None
+
+
+# Expression nodes.  flags[i] says whether atom i matched the node or
+# any of its ancestors.
+
+class AtomRef(object):
+
+    def __init__(self, index):
+        self._index = index
+
+    def evaluate(self, flags):
+        return flags[self._index]
+
+
+class Not(object):
+
+    def __init__(self, expr):
+        self._expr = expr
+
+    def evaluate(self, flags):
+        return not self._expr.evaluate(flags)
+
+
+class And(object):
+
+    def __init__(self, exprs):
+        self._exprs = exprs
+
+    def evaluate(self, flags):
+        for expr in self._exprs:
+            if not expr.evaluate(flags):
+                return False
+        return True
+
+
+class Or(object):
+
+    def __init__(self, exprs):
+        self._exprs = exprs
+
+    def evaluate(self, flags):
+        for expr in self._exprs:
+            if expr.evaluate(flags):
+                return True
+        return False
+
+
+class CompiledFilter(object):
+
+    def __init__(self, atoms, expr):
+        self._atoms = atoms
+        self._expr = expr
+
+    def initial_flags(self):
+        return (False,) * len(self._atoms)
+
+    def update_flags(self, parent_flags, path):
+        # path is the list of names from the root to the node.
+        return tuple([flag or atom.matches(path)
+                      for flag, atom in zip(parent_flags, self._atoms)])
+
+    def evaluate(self, flags):
+        return self._expr.evaluate(flags)
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        char = text[pos]
+        if char.isspace():
+            pos += 1
+        elif char in "()":
+            tokens.append(char)
+            pos += 1
+        elif char == "/":
+            end = pos + 1
+            while end < len(text) and text[end] != "/":
+                if text[end] == "\\":
+                    end += 1
+                end += 1
+            if end >= len(text):
+                raise FilterSyntaxError("Unterminated regexp: %r" % text)
+            tokens.append(text[pos:end + 1])
+            pos = end + 1
+        elif char == "-":
+            tokens.append("not")
+            pos += 1
+        else:
+            end = pos
+            while end < len(text) and not (text[end].isspace() or
+                                            text[end] in "()"):
+                end += 1
+            tokens.append(text[pos:end])
+            pos = end
+    return tokens
+
+
+class Parser(object):
+
+    def __init__(self, tokens, atoms):
+        self._tokens = tokens
+        self._pos = 0
+        self._atoms = atoms
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise FilterSyntaxError("Unexpected end of filter expression")
+        self._pos += 1
+        return token
+
+    def parse(self):
+        expr = self._parse_or()
+        if self._peek() is not None:
+            raise FilterSyntaxError("Unexpected %r in filter expression"
+                                    % self._peek())
+        return expr
+
+    def _parse_or(self):
+        exprs = [self._parse_and()]
+        while self._peek() == "or":
+            self._next()
+            exprs.append(self._parse_and())
+        if len(exprs) == 1:
+            return exprs[0]
+        return Or(exprs)
+
+    def _parse_and(self):
+        exprs = [self._parse_not()]
+        while self._peek() == "and":
+            self._next()
+            exprs.append(self._parse_not())
+        if len(exprs) == 1:
+            return exprs[0]
+        return And(exprs)
+
+    def _parse_not(self):
+        token = self._next()
+        if token == "not":
+            return Not(self._parse_not())
+        elif token == "(":
+            expr = self._parse_or()
+            if self._next() != ")":
+                raise FilterSyntaxError("Missing ) in filter expression")
+            return expr
+        elif token in (")", "and", "or"):
+            raise FilterSyntaxError("Unexpected %r in filter expression"
+                                    % token)
+        elif token.startswith("/"):
+            return self._add_atom(RegexpAtom(token[1:-1]))
+        else:
+            return self._add_atom(NameAtom(token))
+
+    def _add_atom(self, atom):
+        self._atoms.append(atom)
+        return AtomRef(len(self._atoms) - 1)
+
+
+def compile_filters(texts):
+    """Compiles a list of filter expressions, all of which must hold,
+    into one CompiledFilter."""
+    atoms = []
+    exprs = [Parser(tokenize(text), atoms).parse() for text in texts]
+    return CompiledFilter(atoms, And(exprs))
@@ -0,0 +1,230 @@
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import cPickle as pickle
+import fnmatch
+import hashlib
+import os
+
+FORMAT_VERSION = 1
+
+
+def is_glob(text):
+    for char in "*?[":
+        if char in text:
+            return True
+    return False
+
+
+class StaleIndexError(LookupError):
+
+    """Raised when an index, typically a cached one, turns out not to
+    match the tree it is used with."""
+
+
+class ActionIndex(object):
+
+    """Index of the nodes of an action tree, numbered in pre-order as
+    printed by --print.
+
+    Node i has a name and the index of its parent (-1 for the root),
+    and is child number positions[i] of that parent.  Nothing is
+    stored per dotted name.  Instead, the nodes are indexed by name,
+    and by parent and name, so that a name such as "subtree1.foo" is
+    looked up by taking whichever of its components names the fewest
+    nodes, then following parents and children from those nodes.  When
+    one of the components is unique in the tree, as a subtree's name
+    usually is, that takes time proportional to the length of the name.
+    """
+
+    def __init__(self, names, parents, positions, fingerprint):
+        self.names = names
+        self.parents = parents
+        self.positions = positions
+        self.fingerprint = fingerprint
+        # ends[i] is one past the index of node i's last descendant.
+        self.ends = range(1, len(names) + 1)
+        for index in xrange(len(names) - 1, 0, -1):
+            parent = parents[index]
+            if self.ends[index] > self.ends[parent]:
+                self.ends[parent] = self.ends[index]
+        self.levels = [0] * len(names)
+        self._by_name = {}
+        self._by_parent_and_name = {}
+        for index, name in enumerate(names):
+            if index > 0:
+                self.levels[index] = self.levels[parents[index]] + 1
+            self._by_name.setdefault(name, []).append(index)
+            self._by_parent_and_name.setdefault(
+                (parents[index], name), []).append(index)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_path(self, index):
+        path = []
+        while index >= 0:
+            path.append(self.names[index])
+            index = self.parents[index]
+        path.reverse()
+        return path
+
+    def get_children(self, index):
+        child = index + 1
+        while child < self.ends[index]:
+            yield child
+            child = self.ends[child]
+
+    def get_child_action(self, action, index):
+        """Returns the action for node index, given its parent's action.
+        Raises StaleIndexError if the tree does not have a child with
+        node index's name in its position."""
+        children = getattr(action, "children", None)
+        position = self.positions[index]
+        if (children is None or position >= len(children) or
+            children[position][0] != self.names[index]):
+            raise StaleIndexError("No action %s at position %i in the tree"
+                                  % (".".join(self.get_path(index)),
+                                     position))
+        return children[position][1]
+
+    def get_action(self, root, index):
+        path = []
+        while self.parents[index] >= 0:
+            path.append(index)
+            index = self.parents[index]
+        action = root
+        for index in reversed(path):
+            action = self.get_child_action(action, index)
+        return action
+
+    def _ancestors_match(self, index, components, match):
+        for component in reversed(components):
+            index = self.parents[index]
+            if index < 0 or not match(self.names[index], component):
+                return False
+        return True
+
+    def _descendants_matching(self, index, components, use_globs):
+        matches = [index]
+        for component in components:
+            if use_globs and is_glob(component):
+                matches = [child for parent in matches
+                           for child in self.get_children(parent)
+                           if fnmatch.fnmatchcase(self.names[child],
+                                                  component)]
+            else:
+                matches = [child for parent in matches
+                           for child in self._by_parent_and_name.get(
+                               (parent, component), [])]
+        return matches
+
+    def _find(self, components, use_globs):
+        literal = [position for position, component in enumerate(components)
+                   if not (use_globs and is_glob(component))]
+        if len(literal) > 0:
+            pivot = min(literal, key=lambda position:
+                            len(self._by_name.get(components[position], [])))
+            starts = self._by_name.get(components[pivot], [])
+        else:
+            pivot = len(components) - 1
+            starts = [index for name, indexes in self._by_name.iteritems()
+                      if fnmatch.fnmatchcase(name, components[pivot])
+                      for index in indexes]
+        if use_globs:
+            match = fnmatch.fnmatchcase
+        else:
+            match = lambda name, component: name == component
+        got = []
+        for index in starts:
+            if self._ancestors_match(index, components[:pivot], match):
+                got.extend(self._descendants_matching(
+                        index, components[pivot + 1:], use_globs))
+        got.sort()
+        return got
+
+    def lookup(self, name):
+        """Returns the nodes whose dotted path ends with name, plus
+        node number int(name) if name is a number."""
+        got = self._find(name.split("."), False)
+        if name.isdigit() and int(name) < len(self.names):
+            got.append(int(name))
+        return got
+
+    def glob(self, pattern):
+        """Like lookup(), but each dot-separated component of pattern
+        is a shell-style wildcard matching one component of a name.
+        A pattern such as "all_steps.subtree1.b*" selects by prefix."""
+        return self._find(pattern.split("."), True)
+
+    def save(self, filename):
+        temp_filename = filename + ".tmp"
+        fh = open(temp_filename, "wb")
+        try:
+            pickle.dump((FORMAT_VERSION, self.fingerprint, self.names,
+                         self.parents, self.positions),
+                        fh, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fh.close()
+        os.rename(temp_filename, filename)
+
+
+def build_index(action, get_children, fingerprint=None):
+    """Builds an ActionIndex by walking the tree without recursion.
+    get_children(node) returns a list of (name, subnode) pairs, or
+    None for a leaf.  If no fingerprint is given, one is computed from
+    the tree's shape and names."""
+    names = []
+    parents = []
+    positions = []
+    digest = hashlib.sha1()
+    stack = [(action, action.__name__, -1, 0)]
+    while len(stack) > 0:
+        node, name, parent, position = stack.pop()
+        index = len(names)
+        names.append(name)
+        parents.append(parent)
+        positions.append(position)
+        digest.update("%i %s\n" % (parent, name))
+        children = get_children(node)
+        if children is not None:
+            for position in xrange(len(children) - 1, -1, -1):
+                subname, subnode = children[position]
+                stack.append((subnode, subname, index, position))
+    if fingerprint is None:
+        fingerprint = digest.hexdigest()
+    return ActionIndex(names, parents, positions, fingerprint)
+
+
+def load_index(filename, fingerprint):
+    """Returns the index cached in filename, or None if there is none
+    or it was built for a tree with a different fingerprint."""
+    try:
+        fh = open(filename, "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            data = pickle.load(fh)
+        except Exception:
+            return None
+    finally:
+        fh.close()
+    if data[0] != FORMAT_VERSION or data[1] != fingerprint:
+        return None
+    version, fingerprint, names, parents, positions = data
+    return ActionIndex(names, parents, positions, fingerprint)
@@ -0,0 +1,151 @@
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import os
+import threading
+import time
+
+
+class Timing(object):
+
+    def __init__(self, start, end, user, system):
+        self.start = start
+        self.end = end
+        self.wall = end - start
+        self.user = user
+        self.system = system
+
+
+def get_cpu_times():
+    # Includes child processes that have been waited for, which is
+    # where most of the time goes for actions that run commands.
+    times = os.times()
+    return (times[0] + times[2], times[1] + times[3])
+
+
+class ProfileMonitor(object):
+
+    """Leaf monitor (see action_tree.LeafMonitors) that records the
+    wall, user and system time of each leaf action that is run.
+
+    User and system time are process-wide, so they are only
+    attributed accurately when actions are not run concurrently.
+    """
+
+    def __init__(self, get_time=time.time, get_cpu_times=get_cpu_times):
+        self._get_time = get_time
+        self._get_cpu_times = get_cpu_times
+        self._started = {}
+        self._lock = threading.Lock()
+        self.timings = {}
+
+    def before(self, key, action):
+        self._started[key] = (self._get_time(), self._get_cpu_times())
+        return None
+
+    def after(self, key, action, result):
+        end = self._get_time()
+        end_user, end_system = self._get_cpu_times()
+        self._lock.acquire()
+        try:
+            # Leaves skipped by another monitor were never started.
+            if key not in self._started:
+                return
+            start, (start_user, start_system) = self._started.pop(key)
+            self.timings[key] = Timing(start, end, end_user - start_user,
+                                       end_system - start_system)
+        finally:
+            self._lock.release()
+
+
+def get_prefixes(keys):
+    prefixes = set()
+    for key in keys:
+        while key not in prefixes:
+            prefixes.add(key)
+            key, sep, name = key.rpartition(".")
+            if sep == "":
+                break
+    return prefixes
+
+
+def critical_path(action, path, timings, get_children):
+    """Returns (span, keys), where span is the time the tree would take
+    with unlimited concurrency given the measured leaf times and the
+    dependencies between siblings, and keys are the leaves on the
+    longest chain.  Subtrees containing no measured leaves are not
+    visited."""
+    prefixes = get_prefixes(timings.keys())
+
+    def visit(node, key):
+        if key not in prefixes:
+            return 0, []
+        children = get_children(node)
+        if children is None:
+            return timings[key].wall, [key]
+        finish = []
+        for index, (name, subnode) in enumerate(children):
+            span, keys = visit(subnode, "%s.%s" % (key, name))
+            start, before = 0, []
+            for dep_index in node.get_deps(index):
+                if finish[dep_index][0] > start:
+                    start, before = finish[dep_index]
+            finish.append((start + span, before + keys))
+        return max([(0, [])] + finish)
+
+    return visit(action, ".".join(path))
+
+
+def format_duration(seconds):
+    return "%.2fs" % seconds
+
+
+def write_report(stream, timings, action, path, get_children, top=10):
+    if len(timings) == 0:
+        stream.write("No actions were run\n")
+        return
+    work = sum(timing.wall for timing in timings.itervalues())
+    elapsed = (max(timing.end for timing in timings.itervalues()) -
+               min(timing.start for timing in timings.itervalues()))
+    span, keys = critical_path(action, path, timings, get_children)
+    stream.write("Total work %s, elapsed %s, critical path %s\n"
+                 % (format_duration(work), format_duration(elapsed),
+                    format_duration(span)))
+    if span > 0:
+        stream.write("Parallelism available from the tree's shape: %.1f\n"
+                     % (work / span))
+    stream.write("\nCritical path:\n")
+    for key in keys:
+        stream.write("  %10s  %s\n" % (format_duration(timings[key].wall),
+                                       key))
+    stream.write("\nSlowest actions:\n")
+    stream.write("  %10s %10s %10s  %s\n" % ("wall", "user", "system",
+                                             "action"))
+    slowest = sorted(timings.iteritems(), key=lambda item: -item[1].wall)
+    for key, timing in slowest[:top]:
+        stream.write("  %10s %10s %10s  %s\n"
+                     % (format_duration(timing.wall),
+                        format_duration(timing.user),
+                        format_duration(timing.system), key))
+
+
+def write_folded_stacks(fh, timings):
+    # The format read by flamegraph.pl: one line per leaf giving its
+    # semicolon-separated path and its wall time in milliseconds.
+    for key, timing in sorted(timings.iteritems()):
+        fh.write("%s %i\n" % (key.replace(".", ";"),
+                              int(round(timing.wall * 1000))))
@@ -0,0 +1,424 @@
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Running the leaves of an action tree on worker processes, which may
+be on other hosts.
+
+The coordinator listens on a socket and each worker connects to it.
+Workers build the action tree themselves and are told which leaf to
+run by its dotted name, so any leaf can be run remotely, but names
+must not contain dots.  The protocol is line-based.  The coordinator
+sends:
+
+  run <job> <dotted name>
+  quit
+
+and the worker replies with the records of the leaf's log, in the
+line protocol written by build_log.NodeWriter, as they are written:
+
+  log <job> <record>
+  file <job> <filename> <size>      followed by size bytes
+  done <job>
+  failed <job> <size>               followed by a traceback
+  timeout <job> <size>              followed by a message
+
+The records are replayed onto the leaf's log in the coordinator, so
+all the logs from a run end up in one LogDir.
+"""
+
+import collections
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import action_timeout
+import action_tree
+import build_log
+
+
+class RemoteActionError(Exception):
+
+    pass
+
+
+def parse_address(text):
+    host, sep, port = text.rpartition(":")
+    if sep == "":
+        raise ValueError("Address %r should be HOST:PORT" % text)
+    return (host, int(port))
+
+
+def find_action(root, root_path, key):
+    names = key.split(".")
+    if names[:len(root_path)] != root_path:
+        raise LookupError("Action %r is not inside %r"
+                          % (key, ".".join(root_path)))
+    action = root
+    for name in names[len(root_path):]:
+        matches = [subnode for subname, subnode
+                   in action_tree.get_children(action) or []
+                   if subname == name]
+        if len(matches) == 0:
+            raise LookupError("No action %r" % key)
+        if len(matches) > 1:
+            raise LookupError("More than one action is called %r" % key)
+        action = matches[0]
+    return action
+
+
+class _JobOutput(object):
+
+    # Output for a build_log.NodeStream.  NodeWriter writes one
+    # record per call.
+    def __init__(self, wfile, job_id):
+        self._wfile = wfile
+        self._job_id = job_id
+
+    def write(self, data):
+        self._wfile.write("log %s %s" % (self._job_id, data))
+        self._wfile.flush()
+
+
+def _run_job(root, root_path, job_id, key, wfile):
+    spool_dir = tempfile.mkdtemp(prefix="action-worker-")
+    try:
+        stream = build_log.NodeStream(_JobOutput(wfile, job_id))
+        # The LogDir is only used for naming the files the action
+        # writes, which are sent once it has finished.
+        log = build_log.LogWriter(build_log.NodeWriter(stream, "root"),
+                                  build_log.LogDir(spool_dir), key,
+                                  time.time)
+        try:
+            action_tree.call_action(find_action(root, root_path, key), log)
+        except action_timeout.ActionTimeout, exc:
+            reply, error = "timeout", str(exc)
+        except:
+            reply, error = "failed", traceback.format_exc()
+        else:
+            reply, error = "done", None
+        for leafname in sorted(os.listdir(spool_dir)):
+            fh = open(os.path.join(spool_dir, leafname), "rb")
+            try:
+                data = fh.read()
+            finally:
+                fh.close()
+            wfile.write("file %s %s %i\n" % (job_id, leafname, len(data)))
+            wfile.write(data)
+        if error is None:
+            wfile.write("done %s\n" % job_id)
+        else:
+            wfile.write("%s %s %i\n" % (reply, job_id, len(error)))
+            wfile.write(error)
+        wfile.flush()
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def serve(root, root_path, rfile, wfile):
+    """Runs the leaves the coordinator asks for, one at a time, until
+    told to quit or disconnected.  root_path is the path of root in
+    the coordinator's tree."""
+    while True:
+        line = rfile.readline()
+        if line in ("", "quit\n"):
+            break
+        command, job_id, key = line.rstrip("\n").split(" ", 2)
+        assert command == "run", line
+        _run_job(root, root_path, job_id, key, wfile)
+
+
+def run_worker(root, root_path, address):
+    sock = socket.create_connection(address)
+    rfile = sock.makefile("rb")
+    wfile = sock.makefile("wb")
+    try:
+        serve(root, root_path, rfile, wfile)
+    finally:
+        rfile.close()
+        wfile.close()
+        sock.close()
+
+
+class LogReplayer(object):
+
+    """Applies the records written by a build_log.NodeWriter to a log
+    writer, as if the calls that produced them had been made on it.
+    The contents of files arrive separately, via add_file().  Logs
+    are given the start and end times that were recorded."""
+
+    def __init__(self, log):
+        self._logs = {"root": log}
+        self._pending = {}
+        self._files = {}
+        self._end_times = {}
+
+    def process_line(self, line):
+        node_id, attr, arg = line.split(" ", 2)
+        if attr == "add":
+            tag_name, new_node_id = arg.split(" ", 1)
+            self._pending[new_node_id] = (self._logs[node_id], tag_name)
+        elif node_id in self._pending:
+            # A new node's first attribute says what it is.
+            parent, tag_name = self._pending.pop(node_id)
+            if tag_name == "log":
+                assert attr == "name", line
+                self._logs[node_id] = parent.child_log(arg, do_start=False)
+            elif tag_name == "message":
+                assert attr == "text", line
+                parent.message(arg)
+            elif tag_name == "file":
+                assert attr == "filename", line
+                self._files[arg] = parent.make_file()
+        elif attr == "start_time":
+            self._logs[node_id].start(float(arg))
+        elif attr == "end_time":
+            # LogWriter.finish() writes this just before the result.
+            self._end_times[node_id] = float(arg)
+        elif attr == "result":
+            self._logs[node_id].finish(int(arg),
+                                       self._end_times.pop(node_id, None))
+
+    def add_file(self, filename, data):
+        fh = self._files.pop(filename)
+        try:
+            fh.write(data)
+        finally:
+            fh.close()
+
+    def close(self):
+        for fh in self._files.itervalues():
+            fh.close()
+        self._files.clear()
+
+
+class _Worker(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+        self.wfile = sock.makefile("wb")
+        self.job = None
+
+
+def _exc_info(exception):
+    try:
+        raise exception
+    except:
+        return sys.exc_info()
+
+
+class RemoteExecutor(object):
+
+    """Executor (see action_tree.ThreadExecutor) that runs every leaf
+    on one of a fixed number of workers.
+
+    Unless listen_address is given, the workers are forked from this
+    process, and run the leaves of root, whose path is root_path.
+    Otherwise they are expected to connect from elsewhere, e.g. by
+    running the same action tree with --connect.
+    """
+
+    def __init__(self, workers, root=None, root_path=None,
+                 listen_address=None):
+        self.capacities = {"remote": workers}
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._idle = []
+        self._workers = []
+        self._job_counter = 0
+        self._closed = False
+        self._pids = []
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if listen_address is None:
+            self._listener.bind(("127.0.0.1", 0))
+        else:
+            self._listener.bind(listen_address)
+        self._listener.listen(workers)
+        self.address = self._listener.getsockname()
+        if listen_address is None:
+            for i in range(workers):
+                self._fork_worker(root, root_path)
+        self._start_thread(self._accept)
+
+    def _fork_worker(self, root, root_path):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # Leave it to the coordinator to deal with Ctrl-C.
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self._listener.close()
+                run_worker(root, root_path, self.address)
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        self._pids.append(pid)
+
+    def _start_thread(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._listener.accept()
+            except socket.error:
+                if self._closed:
+                    break
+                raise
+            worker = _Worker(sock)
+            self._lock.acquire()
+            try:
+                self._workers.append(worker)
+                self._idle.append(worker)
+                self._dispatch()
+            finally:
+                self._lock.release()
+            self._start_thread(self._read_from, worker)
+
+    def get_lane(self, action):
+        return "remote"
+
+    def submit(self, action, log, on_done, key):
+        self._lock.acquire()
+        try:
+            self._pending.append((key, log, on_done))
+            self._dispatch()
+        finally:
+            self._lock.release()
+
+    def _dispatch(self):
+        # Called with the lock held.
+        while len(self._pending) > 0 and len(self._idle) > 0:
+            worker = self._idle.pop()
+            key, log, on_done = self._pending.popleft()
+            self._job_counter += 1
+            job_id = str(self._job_counter)
+            worker.job = (job_id, LogReplayer(log), on_done)
+            try:
+                worker.wfile.write("run %s %s\n" % (job_id, key))
+                worker.wfile.flush()
+            except socket.error:
+                # The reader thread will notice that it has gone.
+                pass
+
+    def _finish_job(self, worker, exc_info):
+        job_id, replayer, on_done = worker.job
+        replayer.close()
+        self._lock.acquire()
+        try:
+            worker.job = None
+            if worker in self._workers:
+                self._idle.append(worker)
+            self._dispatch()
+        finally:
+            self._lock.release()
+        on_done(exc_info)
+
+    def _read_from(self, worker):
+        try:
+            while self._handle_line(worker, worker.rfile.readline()):
+                pass
+        except:
+            error = "Lost connection to worker:\n%s" % traceback.format_exc()
+        else:
+            error = "Lost connection to worker"
+        self._lose_worker(worker, error)
+
+    def _handle_line(self, worker, line):
+        if line == "":
+            return False
+        kind, sep, rest = line.rstrip("\n").partition(" ")
+        job_id, sep, rest = rest.partition(" ")
+        assert worker.job is not None and job_id == worker.job[0], line
+        replayer = worker.job[1]
+        if kind == "log":
+            replayer.process_line(rest)
+        elif kind == "file":
+            filename, size = rest.split(" ")
+            replayer.add_file(filename, worker.rfile.read(int(size)))
+        elif kind == "done":
+            self._finish_job(worker, None)
+        elif kind == "failed":
+            error = worker.rfile.read(int(rest))
+            self._finish_job(worker, _exc_info(RemoteActionError(
+                "Action failed on worker:\n%s" % error)))
+        elif kind == "timeout":
+            message = worker.rfile.read(int(rest))
+            self._finish_job(
+                worker, _exc_info(action_timeout.ActionTimeout(message)))
+        else:
+            raise AssertionError("Unknown message: %r" % line)
+        return True
+
+    def _lose_worker(self, worker, error):
+        self._lock.acquire()
+        try:
+            if worker in self._idle:
+                self._idle.remove(worker)
+            self._workers.remove(worker)
+            # Jobs still queued would never be run.
+            lost = []
+            if len(self._workers) == 0 and not self._closed:
+                lost = list(self._pending)
+                self._pending.clear()
+        finally:
+            self._lock.release()
+        worker.sock.close()
+        if self._closed:
+            return
+        if worker.job is not None:
+            self._finish_job(worker, _exc_info(RemoteActionError(error)))
+        for key, log, on_done in lost:
+            on_done(_exc_info(RemoteActionError("No workers left")))
+
+    def close(self, wait=True):
+        # Workers that are still running jobs are killed whatever wait
+        # says.
+        self._closed = True
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._listener.close()
+        self._lock.acquire()
+        try:
+            workers = list(self._workers)
+        finally:
+            self._lock.release()
+        busy = False
+        for worker in workers:
+            busy = busy or worker.job is not None
+            try:
+                worker.wfile.write("quit\n")
+                worker.wfile.flush()
+            except socket.error:
+                pass
+        for pid in self._pids:
+            # Jobs are only left running if we are being interrupted.
+            if busy:
+                os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
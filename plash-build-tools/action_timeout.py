@@ -0,0 +1,132 @@
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Timeouts for leaf actions.
+
+A leaf with a timeout attribute (see action_tree.annotate()) or a
+deadline attribute (an absolute time) is run with a watchdog.  When
+it expires, the commands the action started through cmd_env are
+killed, along with their process groups, and the action fails with
+ActionTimeout, which is logged with TIMEOUT_RESULT.
+
+Actions that do not use cmd_env cannot be interrupted, so they only
+fail once they return.  cmd_env lives in in-chroot, which must be on
+the path for commands to be killed; if it is not, a warning is given
+the first time a timeout is used.
+"""
+
+import sys
+import threading
+import time
+
+try:
+    import cmd_env
+except ImportError:
+    cmd_env = None
+
+_warned = False
+
+
+# The same as timeout(1) exits with.
+TIMEOUT_RESULT = 124
+
+
+class ActionTimeout(Exception):
+
+    pass
+
+
+def describe(timeout):
+    return "timed out after %gs" % timeout
+
+
+def get_result(exc_value):
+    # The result to log for a leaf that raised exc_value.
+    if isinstance(exc_value, ActionTimeout):
+        return TIMEOUT_RESULT
+    return 1
+
+
+def get_timeout(action):
+    """Returns the number of seconds action may run for, or None.
+    Raises ActionTimeout if its deadline has already passed."""
+    timeout = getattr(action, "timeout", None)
+    deadline = getattr(action, "deadline", None)
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ActionTimeout("Deadline passed before %s started"
+                                % action.__name__)
+        if timeout is None or remaining < timeout:
+            timeout = remaining
+    return timeout
+
+
+def make_tracker():
+    global _warned
+    if cmd_env is None:
+        if not _warned:
+            _warned = True
+            sys.stderr.write("Warning: cmd_env could not be imported, so "
+                             "commands will not be killed on timeout\n")
+        return None
+    return cmd_env.ProcessGroupTracker()
+
+
+def set_tracker(tracker):
+    if cmd_env is None:
+        return None
+    return cmd_env.set_process_tracker(tracker)
+
+
+def kill(tracker):
+    if tracker is not None:
+        tracker.kill()
+
+
+def call_with_timeout(call, action, log, timeout):
+    tracker = make_tracker()
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        kill(tracker)
+
+    timer = threading.Timer(timeout, expire)
+    timer.setDaemon(True)
+    timer.start()
+    previous = set_tracker(tracker)
+    try:
+        try:
+            call(action, log)
+        except (SystemExit, KeyboardInterrupt):
+            # Commands in their own process groups do not get Ctrl-C.
+            kill(tracker)
+            raise
+        except:
+            if not timed_out.isSet():
+                raise
+        if timed_out.isSet():
+            log.message(describe(timeout))
+            raise ActionTimeout(describe(timeout))
+    finally:
+        timer.cancel()
+        # This is quick once cancelled, and stops the daemonic thread
+        # from still being around at exit.
+        timer.join()
+        set_tracker(previous)
@@ -16,10 +16,24 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+import Queue
+import hashlib
+import heapq
 import optparse
+import pickle
+import signal
 import sys
+import threading
+import time
+import traceback
 
+import action_coroutine
+import action_filter
+import action_index
+import action_profile
+import action_timeout
 import build_log
+import stamp_db
 
 
 # Workaround for Python's variable binding semantics.
@@ -27,91 +41,1112 @@ def thunkify(func, *args):
     return lambda: func(*args)
 
 
+def call_action(action, log):
+    timeout = action_timeout.get_timeout(action)
+    if timeout is None:
+        _call_action(action, log)
+    else:
+        action_timeout.call_with_timeout(_call_action, action, log, timeout)
+
+
+def _call_action(action, log):
+    # A coroutine action (see action_coroutine) returns a generator
+    # when called, which needs running to completion.
+    result = action(log)
+    if action_coroutine.is_generator(result):
+        action_coroutine.run_to_completion(result)
+
+
+class ActionsFailed(Exception):
+
+    """Raised at the end of a run with keep_going set in which some
+    actions failed.  failures lists (dotted name, exc_info) pairs for
+    the leaves that raised."""
+
+    def __init__(self, failures):
+        Exception.__init__(self, "%i action(s) failed: %s"
+                           % (len(failures),
+                              ", ".join(key for key, exc_info in failures)))
+        self.failures = failures
+
+
+def log_exception(log, exc_info):
+    fh = log.make_file()
+    try:
+        traceback.print_exception(exc_info[0], exc_info[1], exc_info[2],
+                                  file=fh)
+    finally:
+        fh.close()
+
+
 class ActionTreeNode(object):
 
-    def __init__(self, children, name):
+    def __init__(self, children, name, deps=None):
         self.children = children
         self.__name__ = name
+        # deps[i] lists the indexes of the earlier siblings that child
+        # i waits for.  None means it just follows its previous
+        # sibling, which is what you get unless you use after().
+        if deps is None:
+            deps = [None] * len(children)
+        assert len(deps) == len(children)
+        for index, dep_indexes in enumerate(deps):
+            if dep_indexes is not None:
+                for dep_index in dep_indexes:
+                    assert 0 <= dep_index < index, (name, index, dep_index)
+        self.deps = deps
 
-    def two_stage_run(self, log):
+    def get_deps(self, index):
+        if self.deps[index] is None:
+            if index == 0:
+                return []
+            else:
+                return [index - 1]
+        return self.deps[index]
+
+    # monitor, if given, is told about each leaf before and after it
+    # is run (see LeafMonitors).  path is used to name the leaves.
+    #
+    # With keep_going, a failure does not stop the run.  Only the
+    # actions that declared a dependency on a failed one with after()
+    # are not run, and ActionsFailed is raised at the end.  Siblings
+    # that just follow a failed action are still run.
+    def two_stage_run(self, log, monitor=None, path=None, keep_going=False):
+        if path is None:
+            path = [self.__name__]
         steps = []
         for name, node in self.children:
             sublog = log.child_log(name, do_start=False)
             if isinstance(node, ActionTreeNode):
-                func = node.two_stage_run(sublog)
+                func = node.two_stage_run(sublog, monitor, path + [name],
+                                          keep_going)
+            elif monitor is not None:
+                func = thunkify(run_monitored, node, sublog, monitor,
+                                ".".join(path + [name]))
             else:
-                func = thunkify(node, sublog)
-            steps.append((sublog, func))
+                func = thunkify(call_action, node, sublog)
+            steps.append((sublog, func, isinstance(node, ActionTreeNode),
+                          ".".join(path + [name])))
         def run():
-            for sublog, func in steps:
+            failures = []
+            not_run = set()
+            for index, (sublog, func, is_node, key) in enumerate(steps):
+                if not_run.intersection(self.deps[index] or []):
+                    not_run.add(index)
+                    continue
                 try:
                     sublog.start()
                     func()
                 except (SystemExit, KeyboardInterrupt):
                     raise
                 except:
-                    sublog.finish(1)
-                    raise
+                    exc_info = sys.exc_info()
+                    if is_node:
+                        sublog.finish(1)
+                    else:
+                        if keep_going:
+                            log_exception(sublog, exc_info)
+                        sublog.finish(action_timeout.get_result(exc_info[1]))
+                    if not keep_going:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    not_run.add(index)
+                    if isinstance(exc_info[1], ActionsFailed):
+                        failures.extend(exc_info[1].failures)
+                    else:
+                        failures.append((key, exc_info))
                 else:
                     sublog.finish(0)
+            if len(failures) > 0:
+                raise ActionsFailed(failures)
         return run
 
-    def __call__(self, log):
-        self.two_stage_run(log)()
+    def __call__(self, log, monitor=None, path=None, keep_going=False):
+        self.two_stage_run(log, monitor, path, keep_going)()
 
 
 def make_node(actions, name):
-    return ActionTreeNode([coerce_to_name_action_pair(action)
-                           for action in actions], name)
+    children = []
+    deps = []
+    for action in actions:
+        subname, subnode, dep_names = coerce_to_child(action)
+        if dep_names is None:
+            deps.append(None)
+        else:
+            deps.append([find_sibling(children, dep_name, name)
+                         for dep_name in dep_names])
+        children.append((subname, subnode))
+    return ActionTreeNode(children, name, deps)
+
+
+def find_sibling(children, name, parent_name):
+    indexes = [index for index, (subname, subnode) in enumerate(children)
+               if subname == name]
+    if len(indexes) != 1:
+        raise ValueError("Dependency %r of node %r must name exactly one "
+                         "earlier sibling" % (name, parent_name))
+    return indexes[0]
 
 
-# Intended to be used as a decorator
+class LazyActionTreeNode(ActionTreeNode):
+
+    """An ActionTreeNode whose children are only computed, by calling
+    get_actions(), when they are first needed."""
+
+    def __init__(self, get_actions, name):
+        self.__name__ = name
+        self._get_actions = get_actions
+        self._node = None
+
+    def _get_node(self):
+        if self._node is None:
+            self._node = make_node(self._get_actions(), self.__name__)
+            self._get_actions = None
+        return self._node
+
+    @property
+    def children(self):
+        return self._get_node().children
+
+    @property
+    def deps(self):
+        return self._get_node().deps
+
+
+# Intended to be used as a decorator.  The node is created once per
+# instance, and the method is not called until the node's children
+# are needed, so selecting one action from a large tree (using a
+# cached index) only expands the nodes on the way to it.
 def action_node(unbound_method):
+    name = unbound_method.__name__
+    cache_attr = "_action_node_%s" % name
+
     def wrapper(self):
-        return make_node(unbound_method(self), name=unbound_method.__name__)
+        node = self.__dict__.get(cache_attr)
+        if node is None:
+            node = LazyActionTreeNode(thunkify(unbound_method, self), name)
+            self.__dict__[cache_attr] = node
+        return node
     return property(wrapper)
 
 
+class LeafDefaultsNode(ActionTreeNode):
+
+    """A view of an action tree in which leaves that lack any of the
+    given attributes have them added, e.g. to give every leaf a
+    timeout.  Children are wrapped when first needed."""
+
+    def __init__(self, node, attrs):
+        self.__name__ = node.__name__
+        self._node = node
+        self._attrs = attrs
+        self._children = None
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = [(name, with_leaf_defaults(subnode, self._attrs))
+                              for name, subnode in self._node.children]
+        return self._children
+
+    @property
+    def deps(self):
+        return self._node.deps
+
+
+def with_leaf_defaults(action, attrs):
+    if isinstance(action, ActionTreeNode):
+        return LeafDefaultsNode(action, attrs)
+    missing = dict((key, value) for key, value in attrs.iteritems()
+                   if getattr(action, key, None) is None)
+    if len(missing) == 0:
+        return action
+    return annotate(action, **missing)
+
+
 def coerce_to_name_action_pair(val):
     if isinstance(val, tuple):
-        return val
+        return val[:2]
     else:
         return (val.__name__, val)
 
 
+def coerce_to_child(val):
+    if isinstance(val, tuple) and len(val) == 3:
+        return val
+    name, action = coerce_to_name_action_pair(val)
+    return (name, action, None)
+
+
+# Use in an action_node list to say that an action only needs the
+# named earlier siblings to have finished, rather than everything
+# before it.  Actions that do not wait on each other can be run
+# concurrently with --jobs.
+def after(dep_names, action):
+    name, action = coerce_to_name_action_pair(action)
+    return (name, action, list(dep_names))
+
+
+class AnnotatedAction(object):
+
+    """Wraps a leaf action to attach attributes to it, such as the
+    inputs it declares.  Other attributes are passed through."""
+
+    def __init__(self, action, attrs):
+        self._action = action
+        self.__name__ = action.__name__
+        self.__dict__.update(attrs)
+
+    def __getattr__(self, attr):
+        # Avoid recursing when being unpickled.
+        if attr.startswith("__") or attr == "_action":
+            raise AttributeError(attr)
+        return getattr(self._action, attr)
+
+    def __call__(self, log):
+        return self._action(log)
+
+
+def annotate(action, **attrs):
+    return AnnotatedAction(action, attrs)
+
+
+# Declares the files (or directories) and parameters that an action's
+# result depends on.  With --stamps, the action is skipped if these
+# have not changed since it last succeeded.
+def inputs(action, files=(), params=None):
+    return annotate(action, input_files=list(files), input_params=params)
+
+
+def parse_resources(specs):
+    # Turns ["NAME=AMOUNT", "NAME", ...] into a dict.  AMOUNT
+    # defaults to 1.
+    resources = {}
+    for spec in specs:
+        name, sep, amount = spec.rpartition("=")
+        if sep == "":
+            name, amount = spec, "1"
+        try:
+            resources[name] = int(amount)
+        except ValueError:
+            raise ValueError("Bad resource %r: should be NAME or "
+                             "NAME=AMOUNT" % spec)
+    return resources
+
+
+# Declares named resources that a leaf action holds while it runs,
+# e.g. uses(action, "chroot:foo", "cpu=2").  When actions are run
+# concurrently, the scheduler does not let the actions running at
+# once use more of a resource than its capacity, given with
+# --resource, which defaults to 1.
+def uses(action, *specs):
+    return annotate(action, resources=parse_resources(specs))
+
+
+UP_TO_DATE_MESSAGE = "skipped (up to date)"
+RESUMED_MESSAGE = "skipped (finished in previous run)"
+
+
+class LeafMonitors(object):
+
+    """Combines objects that are told about each leaf action as it is
+    run, keyed by the leaf's dotted path.
+
+    before(key, action) may return a message saying why the leaf
+    should be skipped, or None.  after(key, action, result) is called
+    once the leaf has finished or been skipped, with the result that
+    is logged for it.  Both may be called from several threads.
+    """
+
+    def __init__(self, monitors):
+        self._monitors = monitors
+
+    def before(self, key, action):
+        # Monitors after one that skips the leaf are not asked.
+        for monitor in self._monitors:
+            skip_message = monitor.before(key, action)
+            if skip_message is not None:
+                return skip_message
+        return None
+
+    def after(self, key, action, result):
+        for monitor in self._monitors:
+            monitor.after(key, action, result)
+
+
+class StampMonitor(object):
+
+    def __init__(self, stamps):
+        self._stamps = stamps
+        self._digests = {}
+
+    def before(self, key, action):
+        digest = self._stamps.get_digest(action)
+        self._digests[key] = digest
+        if self._stamps.is_up_to_date(key, digest):
+            return UP_TO_DATE_MESSAGE
+        return None
+
+    def after(self, key, action, result):
+        # There is no digest if another monitor skipped the leaf.
+        digest = self._digests.pop(key, None)
+        if result == 0:
+            self._stamps.record(key, digest)
+
+
+class RunStateMonitor(object):
+
+    # Records each leaf's result and, if it succeeded, how long it
+    # took, which later runs use to decide what to start first.
+    def __init__(self, state_writer, duration_writer=None,
+                 get_time=time.time):
+        self._state_writer = state_writer
+        self._duration_writer = duration_writer
+        self._get_time = get_time
+        self._started = {}
+
+    def before(self, key, action):
+        self._started[key] = self._get_time()
+        return None
+
+    def after(self, key, action, result):
+        self._state_writer.record(key, result)
+        # Leaves skipped by another monitor were never started.
+        start = self._started.pop(key, None)
+        if (result == 0 and start is not None and
+            self._duration_writer is not None):
+            self._duration_writer.record(
+                key, "%.3f" % (self._get_time() - start))
+
+
+class ResumeMonitor(object):
+
+    def __init__(self, finished_keys):
+        self._finished_keys = finished_keys
+
+    def before(self, key, action):
+        if key in self._finished_keys:
+            return RESUMED_MESSAGE
+        return None
+
+    def after(self, key, action, result):
+        pass
+
+
+def get_rerun_monitor(monitors):
+    # For re-running actions whose inputs have changed, as --watch
+    # does: --resume only applies to the first run, because actions
+    # must be re-run even if they finished then.
+    return LeafMonitors([monitor for monitor in monitors
+                         if not isinstance(monitor, ResumeMonitor)])
+
+
+def run_monitored(action, log, monitor, key):
+    skip_message = monitor.before(key, action)
+    if skip_message is not None:
+        log.message(skip_message)
+        monitor.after(key, action, 0)
+        return
+    try:
+        call_action(action, log)
+    except (SystemExit, KeyboardInterrupt):
+        raise
+    except:
+        monitor.after(key, action,
+                      action_timeout.get_result(sys.exc_info()[1]))
+        raise
+    monitor.after(key, action, 0)
+
+
+class ThreadExecutor(object):
+
+    """Runs leaf actions on a fixed number of worker threads.
+
+    submit() returns immediately; on_done is later called on the
+    worker thread with None, or with sys.exc_info() if the action
+    raised.  key is the leaf's dotted name.
+
+    Executors put each action in a lane, and capacities gives the
+    number of actions that each lane can run at once.
+
+    close() waits for the worker threads to exit, unless wait is
+    false, as when interrupted while actions are still running.
+    """
+
+    def __init__(self, jobs):
+        self.capacities = {"threads": jobs}
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(jobs):
+            thread = threading.Thread(target=self._worker)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            action, log, on_done = item
+            try:
+                call_action(action, log)
+            except:
+                on_done(sys.exc_info())
+            else:
+                on_done(None)
+
+    def get_lane(self, action):
+        return "threads"
+
+    def submit(self, action, log, on_done, key):
+        self._queue.put((action, log, on_done))
+
+    def close(self, wait=True):
+        for thread in self._threads:
+            self._queue.put(None)
+        # The threads are daemonic, so they do not hold up exit if we
+        # do not wait for them.
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class ProcessAction(object):
+
+    """A leaf action that can be pickled and run in a worker process.
+
+    Calls func(*(args + (log,))).  func must be a module-level
+    function and args must be picklable.
+    """
+
+    run_in_process = True
+
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+        self.__name__ = func.__name__
+
+    def __call__(self, log):
+        return self._func(*(self._args + (log,)))
+
+
+def in_process(func, *args):
+    return ProcessAction(func, args)
+
+
+class ProcessActionError(Exception):
+
+    pass
+
+
+def _init_worker():
+    # Leave it to the parent to deal with Ctrl-C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_in_worker(pickled_action):
+    recorder = build_log.LogRecorder()
+    try:
+        call_action(pickle.loads(pickled_action), recorder)
+    except action_timeout.ActionTimeout, exc:
+        return recorder.get_records(), str(exc), True
+    except:
+        # The exception might not be picklable, and SystemExit would
+        # take the worker down, so pass back a description instead.
+        return recorder.get_records(), traceback.format_exc(), False
+    return recorder.get_records(), None, False
+
+
+class ProcessExecutor(object):
+
+    """Runs leaf actions that have a true run_in_process attribute
+    (see in_process()) in a multiprocessing pool, so that CPU-bound
+    actions are not limited by the GIL.  The log records they write
+    are replayed onto their log in this process.  Other actions are
+    run on threads.
+    """
+
+    def __init__(self, jobs):
+        import multiprocessing
+        self.capacities = {"threads": jobs, "processes": jobs}
+        self._pool = multiprocessing.Pool(jobs, _init_worker)
+        self._threads = ThreadExecutor(jobs)
+
+    def get_lane(self, action):
+        if getattr(action, "run_in_process", False):
+            return "processes"
+        return "threads"
+
+    def submit(self, action, log, on_done, key):
+        if self.get_lane(action) != "processes":
+            self._threads.submit(action, log, on_done, key)
+            return
+        try:
+            pickled_action = pickle.dumps(action, pickle.HIGHEST_PROTOCOL)
+        except:
+            on_done(sys.exc_info())
+            return
+
+        def callback(result):
+            records, error, timed_out = result
+            try:
+                build_log.replay_log(records, log)
+                if timed_out:
+                    raise action_timeout.ActionTimeout(error)
+                elif error is not None:
+                    raise ProcessActionError(
+                        "Action %s failed in worker process:\n%s"
+                        % (action.__name__, error))
+            except:
+                on_done(sys.exc_info())
+            else:
+                on_done(None)
+
+        self._pool.apply_async(_run_in_worker, (pickled_action,),
+                               callback=callback)
+
+    def close(self, wait=True):
+        self._pool.terminate()
+        self._pool.join()
+        self._threads.close(wait)
+
+
+class CoroutineExecutor(object):
+
+    """Runs coroutine actions (see action_coroutine), up to jobs of
+    them at once, on a single event loop thread, and passes other
+    actions on to executor.
+    """
+
+    def __init__(self, executor, jobs):
+        self._executor = executor
+        self.capacities = dict(executor.capacities)
+        self.capacities["coroutines"] = jobs
+        self._loop = action_coroutine.CoroutineLoop()
+
+    def get_lane(self, action):
+        if action_coroutine.is_coroutine_action(action):
+            return "coroutines"
+        return self._executor.get_lane(action)
+
+    def submit(self, action, log, on_done, key):
+        if self.get_lane(action) != "coroutines":
+            self._executor.submit(action, log, on_done, key)
+            return
+        try:
+            timeout = action_timeout.get_timeout(action)
+            generator = action(log)
+        except:
+            on_done(sys.exc_info())
+            return
+
+        def done(exc_info):
+            if (exc_info is not None and
+                isinstance(exc_info[1], action_timeout.ActionTimeout)):
+                log.message(str(exc_info[1]))
+            on_done(exc_info)
+
+        self._loop.add(generator, done, timeout)
+
+    def close(self, wait=True):
+        self._loop.stop()
+        self._executor.close(wait)
+
+
+class _Task(object):
+
+    def __init__(self, action, log, parent, path):
+        self.action = action
+        self.log = log
+        self.parent = parent
+        self.path = path
+        self.children = []
+        self.dependents = []
+        self.waiting_on = 0
+        self.unfinished_children = 0
+        self.started = False
+        self.finished = False
+        self.failed = False
+        self.lane = None
+        # Estimated time to run this task with unlimited workers, the
+        # same plus the later siblings that must wait for it, and the
+        # same plus everything that must follow it in the whole tree.
+        self.span = 0
+        self.within = 0
+        self.priority = 0
+        self.start_time = None
+        self.needs = {}
+        # The siblings this waits for because of after(), rather than
+        # just because it follows them.
+        self.declared_deps = []
+        self.blocked = False
+
+    def is_leaf(self):
+        return not isinstance(self.action, ActionTreeNode)
+
+    def get_key(self):
+        return ".".join(self.path)
+
+
+class TreeScheduler(object):
+
+    """Runs an action tree, starting each action as soon as the
+    siblings it depends on have finished.
+
+    Leaves are run by the executor, no more at a time in each lane
+    than it has capacity for; logs are started and finished on the
+    calling thread.  As with ActionTreeNode, a failure stops any
+    further actions from being started and the exception is re-raised
+    once the running ones have finished.
+
+    durations gives the time each leaf took before, by dotted name.
+    Of the actions that are ready, those with the longest chain of
+    estimated work following them are started first.  Leaves with no
+    history are assumed to take the average time.  on_progress, if
+    given, is called as leaves finish with the number finished, the
+    total and an estimate of the time remaining (None without
+    history).
+
+    capacities gives the amount of each resource (see uses())
+    available; resources not listed have capacity 1.  A ready leaf
+    waits until the resources it needs are free.
+
+    With keep_going, failures are handled as described for
+    ActionTreeNode.two_stage_run().
+    """
+
+    def __init__(self, executor, monitor=None, durations=None,
+                 on_progress=None, get_time=time.time, capacities=None,
+                 keep_going=False):
+        self._executor = executor
+        self._keep_going = keep_going
+        self._capacities = capacities or {}
+        self._in_use = {}
+        self._monitor = monitor
+        self._durations = durations or {}
+        self._on_progress = on_progress
+        self._get_time = get_time
+        self._done = Queue.Queue()
+        if len(self._durations) > 0:
+            self._default_duration = (sum(self._durations.itervalues()) /
+                                      len(self._durations))
+        else:
+            self._default_duration = 0
+
+    def _make_task(self, action, log, parent, path):
+        task = _Task(action, log, parent, path)
+        if not task.is_leaf():
+            for name, node in action.children:
+                sublog = log.child_log(name, do_start=False)
+                task.children.append(
+                    self._make_task(node, sublog, task, path + [name]))
+            for index, child in enumerate(task.children):
+                for dep_index in action.get_deps(index):
+                    task.children[dep_index].dependents.append(child)
+                    child.waiting_on += 1
+                    if action.deps[index] is not None:
+                        child.declared_deps.append(task.children[dep_index])
+        return task
+
+    def _get_needs(self, action):
+        # An action needing more than there is gets all there is.
+        needs = getattr(action, "resources", None) or {}
+        return dict((name, min(amount, self._capacities.get(name, 1)))
+                    for name, amount in needs.iteritems())
+
+    def _set_spans(self, task):
+        if task.is_leaf():
+            task.needs = self._get_needs(task.action)
+            task.span = self._durations.get(task.get_key(),
+                                            self._default_duration)
+            self._leaves.append(task)
+            return
+        # Dependents are always later siblings.
+        for child in reversed(task.children):
+            self._set_spans(child)
+            child.within = child.span + max(
+                [dependent.within for dependent in child.dependents] or [0])
+        task.span = max([child.within for child in task.children] or [0])
+
+    def _set_priorities(self, task, following):
+        # following is the estimated time of the work that must come
+        # after task's parent has finished.
+        task.priority = task.within + following
+        for child in task.children:
+            self._set_priorities(child, task.priority - task.span)
+
+    def _push_ready(self, task):
+        # Ties are broken by the order in which tasks became ready.
+        self._sequence += 1
+        heapq.heappush(self._ready, (-task.priority, self._sequence, task))
+
+    def _start(self, task):
+        task.started = True
+        if task.parent is not None:
+            task.log.start()
+        if task.is_leaf():
+            if self._monitor is not None:
+                skip_message = self._monitor.before(task.get_key(),
+                                                    task.action)
+                if skip_message is not None:
+                    task.log.message(skip_message)
+                    self._monitor.after(task.get_key(), task.action, 0)
+                    self._finish(task)
+                    return
+            self._running += 1
+            self._lane_running[task.lane] += 1
+            task.start_time = self._get_time()
+            self._running_tasks.add(task)
+            for name, amount in task.needs.iteritems():
+                self._in_use[name] = self._in_use.get(name, 0) + amount
+            self._executor.submit(
+                task.action, task.log,
+                lambda exc_info: self._done.put((task, exc_info)),
+                task.get_key())
+        else:
+            task.unfinished_children = len(task.children)
+            if len(task.children) == 0:
+                self._finish(task)
+            for child in task.children:
+                if child.waiting_on == 0:
+                    self._push_ready(child)
+
+    def _finish(self, task):
+        task.finished = True
+        if task.parent is None:
+            return
+        # Only with keep_going do failed nodes get finished here.
+        if task.failed:
+            task.log.finish(1)
+        else:
+            task.log.finish(0)
+        self._complete(task)
+
+    def _complete(self, task):
+        # Called once task has finished, or with keep_going, failed or
+        # been blocked.
+        for dependent in task.dependents:
+            if task.failed and task in dependent.declared_deps:
+                dependent.blocked = True
+            dependent.waiting_on -= 1
+            if dependent.waiting_on == 0:
+                if dependent.blocked:
+                    self._block(dependent)
+                else:
+                    self._push_ready(dependent)
+        if task.is_leaf() and not task.blocked:
+            self._leaves_finished += 1
+        task.parent.unfinished_children -= 1
+        if task.parent.unfinished_children == 0:
+            self._finish(task.parent)
+
+    def _block(self, task):
+        # task is not run because it depends on an action that failed.
+        # Its log is left unstarted.
+        task.finished = True
+        task.failed = True
+        self._complete(task)
+
+    def _leaf_succeeded(self, task):
+        if self._monitor is not None:
+            self._monitor.after(task.get_key(), task.action, 0)
+        self._finish(task)
+
+    def _fail(self, task, exc_info):
+        stop = (issubclass(exc_info[0], (SystemExit, KeyboardInterrupt)) or
+                not self._keep_going)
+        if stop and self._exc_info is None:
+            self._exc_info = exc_info
+        if issubclass(exc_info[0], (SystemExit, KeyboardInterrupt)):
+            return
+        result = action_timeout.get_result(exc_info[1])
+        if self._monitor is not None:
+            self._monitor.after(task.get_key(), task.action, result)
+        if self._keep_going:
+            log_exception(task.log, exc_info)
+        task.finished = True
+        task.log.finish(result)
+        failed = task
+        while failed is not None:
+            failed.failed = True
+            failed = failed.parent
+        if not stop:
+            self._failures.append((task.get_key(), exc_info))
+            self._complete(task)
+
+    def _finish_failed(self, task):
+        # Finishes the logs that were started, including those of
+        # subtrees that were left part-way through, but not the root.
+        for child in task.children:
+            self._finish_failed(child)
+        if task.started and not task.finished and task.parent is not None:
+            task.finished = True
+            task.log.finish(1)
+
+    def _can_start(self, task):
+        if not task.is_leaf():
+            return True
+        if task.lane is None:
+            task.lane = self._executor.get_lane(task.action)
+        if (self._lane_running[task.lane] >=
+            self._executor.capacities[task.lane]):
+            return False
+        for name, amount in task.needs.iteritems():
+            if (self._in_use.get(name, 0) + amount >
+                self._capacities.get(name, 1)):
+                return False
+        return True
+
+    def _start_ready(self):
+        # Tasks that cannot start yet because their lane is full keep
+        # their place.  Starting a task can only make the lanes fuller,
+        # so one pass is enough; tasks made ready by _start() are
+        # pushed and handled in the same pass.  Once something has
+        # failed, nothing new gets started.
+        waiting = []
+        while len(self._ready) > 0 and self._exc_info is None:
+            item = heapq.heappop(self._ready)
+            if self._can_start(item[2]):
+                self._start(item[2])
+            else:
+                waiting.append(item)
+        for item in waiting:
+            heapq.heappush(self._ready, item)
+
+    def estimate_remaining(self):
+        """Returns the estimated time until the run finishes: the
+        longer of the remaining critical path and the remaining work
+        shared between the executor's workers."""
+        now = self._get_time()
+        critical = 0
+        work = 0
+        for task in self._running_tasks:
+            elapsed = now - task.start_time
+            critical = max(critical, task.priority - elapsed)
+            work += max(0, task.span - elapsed)
+        for item in self._ready:
+            critical = max(critical, item[2].priority)
+        work += sum(task.span for task in self._leaves if not task.started)
+        workers = max(self._executor.capacities.values())
+        return max(critical, work / float(workers))
+
+    def _report_progress(self):
+        if self._on_progress is None:
+            return
+        remaining = None
+        if len(self._durations) > 0:
+            remaining = self.estimate_remaining()
+        self._on_progress(self._leaves_finished, len(self._leaves),
+                          remaining)
+
+    def _wait(self):
+        while True:
+            try:
+                # Use a timeout so that KeyboardInterrupt gets delivered.
+                return self._done.get(True, 1)
+            except Queue.Empty:
+                pass
+
+    def run(self, action, log, path=None):
+        if path is None:
+            path = [action.__name__]
+        self._running = 0
+        self._lane_running = dict(
+            (lane, 0) for lane in self._executor.capacities)
+        self._exc_info = None
+        self._ready = []
+        self._sequence = 0
+        self._leaves = []
+        self._leaves_finished = 0
+        self._running_tasks = set()
+        self._failures = []
+        root = self._make_task(action, log, None, path)
+        self._set_spans(root)
+        root.within = root.span
+        self._set_priorities(root, 0)
+        self._start(root)
+        self._start_ready()
+        while self._running > 0:
+            task, exc_info = self._wait()
+            self._running -= 1
+            self._lane_running[task.lane] -= 1
+            self._running_tasks.remove(task)
+            for name, amount in task.needs.iteritems():
+                self._in_use[name] -= amount
+            if exc_info is None:
+                self._leaf_succeeded(task)
+            else:
+                self._fail(task, exc_info)
+            self._start_ready()
+            self._report_progress()
+        if self._exc_info is not None:
+            # As when run sequentially, an interruption leaves the
+            # logs unfinished.
+            if not issubclass(self._exc_info[0],
+                              (SystemExit, KeyboardInterrupt)):
+                self._finish_failed(root)
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        if len(self._ready) > 0:
+            # E.g. the executor has a lane with no capacity.
+            raise Exception("%i action(s) could not be started: %s"
+                            % (len(self._ready),
+                               ", ".join(item[2].get_key()
+                                         for item in sorted(self._ready))))
+        if len(self._failures) > 0:
+            raise ActionsFailed(self._failures)
+
+
+def make_executor(options, action, path):
+    if options.workers > 0:
+        import action_remote
+        listen_address = None
+        if options.listen is not None:
+            listen_address = action_remote.parse_address(options.listen)
+        executor = action_remote.RemoteExecutor(
+            options.workers, action, path, listen_address)
+    elif options.processes:
+        executor = ProcessExecutor(options.jobs)
+    else:
+        executor = ThreadExecutor(options.jobs)
+    if options.async_jobs > 0:
+        executor = CoroutineExecutor(executor, options.async_jobs)
+    return executor
+
+
+def run_with_executor(action, log, executor, monitor=None, path=None,
+                      durations=None, on_progress=None, capacities=None,
+                      keep_going=False):
+    try:
+        if isinstance(action, ActionTreeNode):
+            TreeScheduler(executor, monitor, durations, on_progress,
+                          capacities=capacities,
+                          keep_going=keep_going).run(action, log, path)
+        elif monitor is not None:
+            run_monitored(action, log, monitor, ".".join(path))
+        else:
+            call_action(action, log)
+    except (SystemExit, KeyboardInterrupt):
+        # Actions may still be running, so do not wait for them.
+        executor.close(wait=False)
+        raise
+    except:
+        executor.close()
+        raise
+    else:
+        executor.close()
+
+
+class _TreePath(object):
+
+    """The names from the root of a tree down to a node.  It keeps the
+    path to the node's parent, a list or another _TreePath, instead of
+    copying the names in it, so making one takes the same time at any
+    depth.  It acts as a read-only sequence; slicing it gives a list."""
+
+    def __init__(self, parent_path, name):
+        self._parent_path = parent_path
+        self._name = name
+        self._length = len(parent_path) + 1
+
+    def __len__(self):
+        return self._length
+
+    def __reversed__(self):
+        path = self
+        while isinstance(path, _TreePath):
+            yield path._name
+            path = path._parent_path
+        for name in reversed(path):
+            yield name
+
+    def __iter__(self):
+        names = list(reversed(self))
+        names.reverse()
+        return iter(names)
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def __add__(self, other):
+        return list(self) + other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class ActionInContext(object):
 
-    def __init__(self, action, name, path):
+    """A node of a tree along with where it is in the tree.  The path
+    is either given or made from parent's, another ActionInContext, the
+    first time it is needed.  Paths made this way share their
+    ancestors' names, so getting the path of every node of a tree takes
+    time proportional to the number of nodes, however deep it is."""
+
+    def __init__(self, action, name, path=None, parent=None):
         self.action = action
         self.name = name
-        self.path = path
+        self._path = path
+        self._parent = parent
+        if parent is None:
+            self._level = len(path) - 1
+        else:
+            self._level = parent._level + 1
         self.index = None # Filled out later
 
+    @property
+    def path(self):
+        if self._path is None:
+            # Without recursing, in case the ancestors' paths are not
+            # made yet either.
+            pending = []
+            act = self
+            while act._path is None:
+                pending.append(act)
+                act = act._parent
+            for act in reversed(pending):
+                act._path = _TreePath(act._parent._path, act.name)
+        return self._path
+
     def get_level(self):
-        return len(self.path) - 1
+        return self._level
 
-    def run_leaf(self, log):
+    def run_leaf(self, log, monitor=None, keep_going=False):
         if not isinstance(self.action, ActionTreeNode):
             node = self.action
             for name in reversed(self.path):
                 node = make_node([node], name)
             node = make_node([node], "")
-            node(log)
+            node(log, monitor, path=[], keep_going=keep_going)
 
     def get_names(self):
-        for i in range(len(self.path)):
-            yield ".".join(self.path[i:])
+        # From the longest to the shortest, computed as needed.
+        path = list(self.path)
+        for i in range(len(path)):
+            yield ".".join(path[i:])
 
 
 def flatten_tree(action, name=None, path=[]):
+    """Yields an ActionInContext for each node of the tree, in
+    pre-order.  This does not recurse, so the cost per node does not
+    depend on its depth, and children are only asked for when they
+    are reached."""
     if name is None:
         name = action.__name__
-    path = path + [name]
-    yield ActionInContext(action, name, path)
-    if isinstance(action, ActionTreeNode):
-        for subname, subnode in action.children:
-            for result in flatten_tree(subnode, name=subname, path=path):
-                yield result
+    act = ActionInContext(action, name, path + [name])
+    yield act
+    if not isinstance(action, ActionTreeNode):
+        return
+    stack = [(act, iter(action.children))]
+    while len(stack) > 0:
+        parent, children = stack[-1]
+        for subname, subnode in children:
+            act = ActionInContext(subnode, subname, parent=parent)
+            yield act
+            if isinstance(subnode, ActionTreeNode):
+                stack.append((act, iter(subnode.children)))
+            break
+        else:
+            stack.pop()
 
 
 def print_node(action, index, stream):
@@ -129,35 +1164,160 @@ def get_one(lst):
     return lst[0]
 
 
-def filter_tree(action, label):
-    if isinstance(action, ActionTreeNode):
-        got = []
-        for subname, subnode in action.children:
-            if subname == label:
-                got.append((subname, subnode))
+def subset_node(action, kept, name):
+    # kept is a list of (index, subname, subnode) for the children to
+    # keep.  A dependency on a dropped child is replaced by that
+    # child's own dependencies so that ordering is preserved.
+    new_index = dict((index, i) for i, (index, subname, subnode)
+                     in enumerate(kept))
+
+    def kept_deps(index):
+        got = set()
+        for dep_index in action.get_deps(index):
+            if dep_index in new_index:
+                got.add(new_index[dep_index])
             else:
-                new_node = filter_tree(subnode, label)
+                got.update(kept_deps(dep_index))
+        return got
+
+    def new_deps(index):
+        # If the child only follows dropped children that themselves
+        # just follow their previous sibling, it still just follows
+        # its previous sibling, which --keep-going treats differently
+        # from a declared dependency.
+        previous = index - 1
+        while (action.deps[index] is None and previous >= 0 and
+               previous not in new_index):
+            index = previous
+            previous -= 1
+        if action.deps[index] is None:
+            return None
+        return sorted(kept_deps(index))
+
+    return ActionTreeNode([(subname, subnode)
+                           for index, subname, subnode in kept],
+                          name,
+                          [new_deps(index)
+                           for index, subname, subnode in kept])
+
+
+def apply_filter(action, node_filter):
+    """Returns the part of the tree selected by an
+    action_filter.CompiledFilter, in a single traversal, or None if
+    nothing is selected.  Nodes that are kept whole are shared with
+    the original tree rather than copied."""
+    path = []
+
+    def visit(node, name, parent_flags):
+        path.append(name)
+        flags = node_filter.update_flags(parent_flags, path)
+        if isinstance(node, ActionTreeNode) and not all(flags):
+            kept = []
+            for index, (subname, subnode) in enumerate(node.children):
+                new_node = visit(subnode, subname, flags)
                 if new_node is not None:
-                    got.append((subname, new_node))
-        if len(got) > 0:
-            return ActionTreeNode(got, action.__name__)
-    return None
+                    kept.append((index, subname, new_node))
+            unchanged = (len(kept) == len(node.children) and
+                         all(new_node is node.children[index][1]
+                             for index, subname, new_node in kept))
+            if unchanged:
+                result = node
+            elif len(kept) > 0 or node_filter.evaluate(flags):
+                result = subset_node(node, kept, name)
+            else:
+                result = None
+        elif node_filter.evaluate(flags):
+            # Once every pattern has matched, the result cannot change
+            # further down, so there is no need to look inside.
+            result = node
+        else:
+            result = None
+        path.pop()
+        return result
+
+    return visit(action, action.__name__, node_filter.initial_flags())
+
+
+def filter_tree(action, label):
+    return apply_filter(action, action_filter.compile_filters([label]))
 
 
 def negative_filter_tree(action, label):
-    if isinstance(action, ActionTreeNode):
-        return ActionTreeNode(
-            [(subname, negative_filter_tree(subnode, label))
-             for subname, subnode in action.children
-             if subname != label], "top")
-    return action
+    return apply_filter(action, action_filter.compile_filters(["-" + label]))
 
 
 def _add_options(add_option):
     add_option("-f", "--filter", dest="filters", default=[],
-               action="append", help="Filter to a subset of the tree")
+               action="append", metavar="EXPR",
+               help="Filter to a subset of the tree.  EXPR is a name, "
+               "glob or /regexp/, or a combination of these using and, "
+               "or, not and parentheses; -NAME excludes NAME")
     add_option("--print", dest="print_tree", action="store_true",
                default=False)
+    add_option("-j", "--jobs", dest="jobs", default=1, type=int,
+               help="Number of independent actions to run concurrently")
+    add_option("--processes", dest="processes", action="store_true",
+               default=False,
+               help="Run actions created with in_process() in a pool of "
+               "worker processes")
+    add_option("--async-jobs", dest="async_jobs", default=0, type=int,
+               metavar="N",
+               help="Run up to N actions written as generators (see "
+               "action_coroutine) concurrently on one thread")
+    add_option("--workers", dest="workers", default=0, type=int,
+               metavar="N",
+               help="Run leaf actions on N worker processes forked from "
+               "this one, or with --listen, on N workers that connect")
+    add_option("--listen", dest="listen", default=None,
+               metavar="HOST:PORT",
+               help="Wait for --workers to connect to HOST:PORT")
+    add_option("--connect", dest="connect", default=None,
+               metavar="HOST:PORT",
+               help="Act as a worker for the run listening at HOST:PORT")
+    add_option("--timeout", dest="timeout", default=None, type=float,
+               metavar="SECONDS",
+               help="Stop actions that are still running SECONDS after "
+               "the run started")
+    add_option("--action-timeout", dest="action_timeout", default=None,
+               type=float, metavar="SECONDS",
+               help="Stop each action after SECONDS unless it sets its "
+               "own timeout with annotate()")
+    add_option("--estimate", dest="estimate", action="store_true",
+               default=False,
+               help="Print an estimate of the time remaining as actions "
+               "finish, based on previous runs in the log set")
+    add_option("--resource", dest="resources", default=[],
+               action="append", metavar="NAME=N",
+               help="Let actions that declare they use NAME (see uses()) "
+               "hold up to N of it at once; the default is 1")
+    add_option("--shard", dest="shard", default=None, metavar="I/N",
+               help="Split the leaves selected into N shards of about "
+               "equal past duration and run only shard I (from 1); "
+               "all the shards must use the same logs")
+    add_option("--watch", dest="watch", action="store_true", default=False,
+               help="After running, wait for the declared inputs of the "
+               "actions to change, and re-run the actions affected")
+    add_option("-k", "--keep-going", dest="keep_going", action="store_true",
+               default=False,
+               help="After a failure, carry on with the actions that do "
+               "not depend on the failed one, and fail at the end")
+    add_option("--stamps", dest="stamps_file", default=None,
+               help="Skip actions whose declared inputs are unchanged "
+               "since they last succeeded, recording this in FILE")
+    add_option("--resume", dest="resume", action="store_true",
+               default=False,
+               help="Skip actions that finished successfully in the "
+               "previous run in the log set")
+    add_option("--profile", dest="profile", action="store_true",
+               default=False,
+               help="Print the critical path and the slowest actions "
+               "after running")
+    add_option("--profile-top", dest="profile_top", default=10, type=int,
+               help="Number of slowest actions to list with --profile")
+    add_option("--profile-output", dest="profile_output", default=None,
+               metavar="FILE",
+               help="Write action times to FILE in the folded stack "
+               "format used by flame graph tools")
 
 
 def add_options(parser):
@@ -168,52 +1328,450 @@ def add_arguments(parser):
     _add_options(parser.add_argument)
 
 
+def get_log_dir(log):
+    # Log writers other than those in build_log may not have a LogDir.
+    get = getattr(log, "get_log_dir", None)
+    if get is None:
+        return None
+    return get()
+
+
+# The action index can be cached in the file index_cache.  The cache
+# is only reused if index_key, which should change whenever the
+# tree's definition does, is the same as when it was written.
 def action_main_(action, options, args, stdout=sys.stdout,
-                 log=build_log.DummyLogWriter()):
-    for filter_name in options.filters:
-        if filter_name.startswith("-"):
-            action = negative_filter_tree(action, filter_name[1:])
+                 log=build_log.DummyLogWriter(), index_cache=None,
+                 index_key=None):
+    if options.jobs < 1:
+        raise ValueError("--jobs must be at least 1, not %i" % options.jobs)
+    if options.print_tree:
+        durations = None
+        log_dir = get_log_dir(log)
+        if options.shard is not None and log_dir is not None:
+            durations = log_dir.get_past_durations()
+        _action_main(action, options, args, stdout, log, None,
+                     index_cache, index_key, durations)
+        return
+    if options.connect is not None:
+        import action_remote
+        action_remote.run_worker(apply_timeouts(action, options),
+                                 [action.__name__],
+                                 action_remote.parse_address(options.connect))
+        return
+    monitors = []
+    to_close = []
+    log_dir = get_log_dir(log)
+    if options.resume:
+        previous = None
+        if log_dir is not None:
+            previous = log_dir.get_previous()
+        if previous is None:
+            raise Exception("--resume needs the log to be in a LogSetDir "
+                            "containing a previous run")
+        monitors.append(ResumeMonitor(previous.get_finished_actions()))
+    if options.stamps_file is not None:
+        stamps = stamp_db.StampDB(options.stamps_file)
+        to_close.append(stamps)
+        monitors.append(StampMonitor(stamps))
+    durations = None
+    if log_dir is not None:
+        state_writer = log_dir.make_state_writer()
+        duration_writer = log_dir.make_duration_writer()
+        to_close.extend([state_writer, duration_writer])
+        monitors.append(RunStateMonitor(state_writer, duration_writer))
+        durations = log_dir.get_past_durations()
+    profile = None
+    if options.profile or options.profile_output is not None:
+        # Last, so that the time other monitors take is not counted.
+        profile = action_profile.ProfileMonitor()
+        monitors.append(profile)
+    # The tree as given, for watch() to prepare again for each re-run.
+    unprepared = action
+    try:
+        try:
+            action = _action_main(action, options, args, stdout, log,
+                                  LeafMonitors(monitors), index_cache,
+                                  index_key, durations)
+        except Exception:
+            if not options.watch:
+                raise
+            # The next change might fix it.
+            traceback.print_exc(file=stdout)
+        if options.watch and len(args) > 0:
+            import action_watch
+            action_watch.watch(unprepared, options, args, stdout, log,
+                               get_rerun_monitor(monitors), durations)
+    except:
+        exc_info = sys.exc_info()
+        if profile is not None:
+            # The profile of a failed run is still worth having, but
+            # failing to write it should not hide why the run failed.
+            try:
+                write_profile(profile, options, action, stdout)
+            except Exception:
+                traceback.print_exc(file=stdout)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    else:
+        if profile is not None:
+            write_profile(profile, options, action, stdout)
+    finally:
+        for obj in to_close:
+            obj.close()
+
+
+def write_profile(profile, options, action, stdout):
+    if options.profile:
+        action_profile.write_report(stdout, profile.timings, action,
+                                    [action.__name__], get_children,
+                                    top=options.profile_top)
+    if options.profile_output is not None:
+        fh = open(options.profile_output, "w")
+        try:
+            action_profile.write_folded_stacks(fh, profile.timings)
+        finally:
+            fh.close()
+
+
+def apply_timeouts(action, options):
+    attrs = {}
+    if options.action_timeout is not None:
+        attrs["timeout"] = options.action_timeout
+    if options.timeout is not None:
+        attrs["deadline"] = time.time() + options.timeout
+    if len(attrs) == 0:
+        return action
+    return with_leaf_defaults(action, attrs)
+
+
+def get_children(action):
+    if isinstance(action, ActionTreeNode):
+        return action.children
+    return None
+
+
+def get_action_index(action, options, index_cache, index_key,
+                     rebuild=False):
+    if index_cache is None or index_key is None:
+        return action_index.build_index(action, get_children)
+    fingerprint = hashlib.sha1(
+        repr((index_key, options.filters))).hexdigest()
+    index = None
+    if not rebuild:
+        index = action_index.load_index(index_cache, fingerprint)
+    if index is None:
+        index = action_index.build_index(action, get_children, fingerprint)
+        index.save(index_cache)
+    return index
+
+
+def print_index(index, node_indexes, stream):
+    for number, node_index in enumerate(node_indexes):
+        stream.write("%s%i: %s\n" % ("   " * index.levels[node_index],
+                                      number, index.names[node_index]))
+
+
+def get_context(index, root, node_index):
+    act = ActionInContext(index.get_action(root, node_index),
+                          index.names[node_index],
+                          index.get_path(node_index))
+    act.index = node_index
+    return act
+
+
+def parse_shard(text):
+    shard, sep, count = text.partition("/")
+    if sep == "" or not shard.isdigit() or not count.isdigit():
+        raise ValueError("Shard %r should be I/N" % text)
+    shard, count = int(shard), int(count)
+    if not 1 <= shard <= count:
+        raise ValueError("Shard %r is not between 1 and %i" % (text, count))
+    return shard, count
+
+
+def get_leaves(index, node_indexes):
+    got = set()
+    for node_index in node_indexes:
+        for leaf in xrange(node_index, index.ends[node_index]):
+            if index.ends[leaf] == leaf + 1:
+                got.add(leaf)
+    return sorted(got)
+
+
+def get_shard(index, leaves, durations, shard, count):
+    """Splits leaves (node indexes, in order) into count runs of about
+    equal total duration and returns run number shard (from 1).  The
+    runs are contiguous so that neighbouring leaves, which often depend
+    on each other, tend to stay together.  Leaves with no history are
+    assumed to take the average time."""
+    durations = durations or {}
+    times = [durations.get(".".join(index.get_path(leaf)))
+             for leaf in leaves]
+    known = [duration for duration in times if duration is not None]
+    if len(known) > 0 and sum(known) > 0:
+        default = sum(known) / len(known)
+    else:
+        # Fall back to splitting by count.
+        default = 1
+        times = [None] * len(times)
+    times = [default if duration is None else duration
+             for duration in times]
+    total = sum(times)
+    got = []
+    before = 0
+    for leaf, duration in zip(leaves, times):
+        # Each leaf goes in the shard containing its midpoint.
+        middle = before + duration / 2.0
+        if min(int(middle * count / total), count - 1) == shard - 1:
+            got.append(leaf)
+        before += duration
+    return got
+
+
+def prune_to_nodes(root, index, node_indexes):
+    """Returns the part of the tree containing the given nodes, which
+    are kept whole, and their ancestors."""
+    kept = set(node_indexes)
+    ancestors = set()
+    for node_index in kept:
+        parent = index.parents[node_index]
+        while parent >= 0 and parent not in ancestors:
+            ancestors.add(parent)
+            parent = index.parents[parent]
+
+    def visit(node_index, action):
+        if node_index in kept:
+            return action
+        children = []
+        for child in index.get_children(node_index):
+            if child in kept or child in ancestors:
+                position = index.positions[child]
+                children.append(
+                    (position, index.names[child],
+                     visit(child, index.get_child_action(action, child))))
+        return subset_node(action, children, index.names[node_index])
+
+    if 0 in kept or 0 in ancestors:
+        return visit(0, root)
+    return ActionTreeNode([], index.names[0])
+
+
+def get_pruned_context(root, index, node_indexes):
+    # Running the result runs the given nodes in one go, with one log
+    # for each of their ancestors.
+    return ActionInContext(prune_to_nodes(root, index, node_indexes),
+                           index.names[0], [index.names[0]])
+
+
+def write_progress(stream, finished, total, remaining):
+    stream.write("Progress: %i/%i actions finished" % (finished, total))
+    if remaining is not None:
+        stream.write(", about %s remaining"
+                     % action_profile.format_duration(remaining))
+    stream.write("\n")
+
+
+def run_action(act, options, log, monitor, stdout=sys.stdout,
+               durations=None):
+    if not options.keep_going or isinstance(act.action, ActionTreeNode):
+        _run_action(act, options, log, monitor, stdout, durations)
+        return
+    # A leaf run by itself fails as it would inside a tree, so that
+    # the run can carry on with the other actions asked for.
+    try:
+        _run_action(act, options, log, monitor, stdout, durations)
+    except (SystemExit, KeyboardInterrupt):
+        raise
+    except:
+        exc_info = sys.exc_info()
+        log_exception(log, exc_info)
+        raise ActionsFailed([(".".join(act.path), exc_info)])
+
+
+def _run_action(act, options, log, monitor, stdout, durations):
+    if (options.jobs > 1 or options.processes or options.async_jobs > 0 or
+        options.workers > 0 or options.estimate):
+        on_progress = None
+        if options.estimate:
+            on_progress = lambda *args: write_progress(stdout, *args)
+        run_with_executor(act.action, log,
+                          make_executor(options, act.action, act.path),
+                          monitor, act.path, durations, on_progress,
+                          parse_resources(options.resources),
+                          options.keep_going)
+    elif isinstance(act.action, ActionTreeNode):
+        act.action(log, monitor, act.path, options.keep_going)
+    elif monitor is not None:
+        run_monitored(act.action, log, monitor, ".".join(act.path))
+    else:
+        call_action(act.action, log)
+
+
+def prepare_action(action, options):
+    # Applies the options that change the tree itself.
+    if len(options.filters) > 0:
+        filtered = apply_filter(
+            action, action_filter.compile_filters(options.filters))
+        if filtered is None:
+            filtered = ActionTreeNode([], action.__name__)
+        action = filtered
+    return apply_timeouts(action, options)
+
+
+def lookup_one(index, name):
+    return get_one(index.lookup(name))
+
+
+def select_nodes(index, arg):
+    """Returns the nodes that a command line argument refers to: a
+    range START:END, a glob, or a name."""
+    if ":" in arg:
+        start, sep, end = arg.partition(":")
+        if start == "":
+            start_index = 0
+        else:
+            start_index = lookup_one(index, start)
+        if end == "":
+            end_index = len(index) - 1
         else:
-            action = filter_tree(action, filter_name)
-    if len(args) == 0:
-        print_tree(flatten_tree(action), stdout)
+            end_index = lookup_one(index, end)
+        return xrange(start_index, end_index + 1)
+    elif action_index.is_glob(arg):
+        return index.glob(arg)
     else:
-        flattened = list(flatten_tree(action))
-        by_index = {}
-        for index, act in enumerate(flattened):
-            act.index = index
-            for name in list(act.get_names()) + [str(index)]:
-                by_index.setdefault(name, []).append(act)
-        def action_range(text):
-            start, sep, end = text.partition(":")
-            if start == "":
-                start_action = flattened[0]
-            else:
-                start_action = get_one(by_index[start])
-            if end == "":
-                end_action = flattened[-1]
+        return [lookup_one(index, arg)]
+
+
+def plan_steps(action, index, options, args, stdout, log, monitor,
+               durations):
+    """Returns a thunk for each thing that args ask for, in order.
+    The actions to run are all found in the tree before any are run,
+    so that a StaleIndexError is raised before anything happens."""
+    shard = None
+    if options.shard is not None:
+        shard = parse_shard(options.shard)
+
+    def run(act):
+        return thunkify(run_action, act, options, log, monitor, stdout,
+                        durations)
+
+    def print_nodes(node_indexes):
+        return thunkify(print_index, index, node_indexes, stdout)
+
+    steps = []
+    for arg in args:
+        if shard is not None:
+            shard_leaves = get_shard(
+                index, get_leaves(index, select_nodes(index, arg)),
+                durations, *shard)
+            if options.print_tree:
+                steps.append(print_nodes(shard_leaves))
             else:
-                end_action = get_one(by_index[end])
-            return start_action, end_action
-        for arg in args:
-            if ":" in arg:
-                start_action, end_action = action_range(arg)
-                actions = flattened[start_action.index:end_action.index + 1]
-                if options.print_tree:
-                    print_tree(actions, stdout)
-                else:
-                    for action in actions:
-                        action.run_leaf(log)
+                steps.append(run(get_pruned_context(action, index,
+                                                    shard_leaves)))
+        elif ":" in arg:
+            node_indexes = select_nodes(index, arg)
+            if options.print_tree:
+                steps.append(print_nodes(node_indexes))
             else:
-                if options.print_tree:
-                    print_tree(flattened, stdout)
-                else:
-                    get_one(by_index[arg]).action(log)
+                # Only the leaves are run, not whole subtrees that the
+                # range starts inside.
+                leaves = [node_index for node_index in node_indexes
+                          if index.ends[node_index] == node_index + 1]
+                steps.append(run(get_pruned_context(action, index, leaves)))
+        elif options.print_tree:
+            steps.append(print_nodes(xrange(len(index))))
+        elif action_index.is_glob(arg):
+            # Run each matching action once, including those that
+            # are inside other matching actions.
+            end_index = 0
+            for node_index in index.glob(arg):
+                if node_index >= end_index:
+                    steps.append(run(get_context(index, action, node_index)))
+                    end_index = index.ends[node_index]
+        else:
+            steps.append(run(get_context(index, action,
+                                         lookup_one(index, arg))))
+    return steps
+
+
+def find_by_path(root, path):
+    """Returns the action whose full path is path, expanding only the
+    nodes along it, or None if there is not exactly one."""
+    if path[0] != root.__name__:
+        return None
+    action = root
+    for name in path[1:]:
+        matches = [subnode for subname, subnode in get_children(action) or []
+                   if subname == name]
+        if len(matches) != 1:
+            return None
+        action = matches[0]
+    return action
+
+
+def plan_steps_by_path(action, options, args, stdout, log, monitor,
+                       durations):
+    # Without a cached index, actions given by their full dotted
+    # paths can be found without building an index, which would
+    # expand the whole tree.  A full path is taken to mean the node at
+    # that path even if another node's path ends with it.  Returns
+    # None if some argument needs the index.
+    if options.print_tree or options.shard is not None:
+        return None
+    steps = []
+    for arg in args:
+        if ":" in arg or action_index.is_glob(arg) or arg.isdigit():
+            return None
+        path = arg.split(".")
+        found = find_by_path(action, path)
+        if found is None:
+            return None
+        steps.append(thunkify(run_action,
+                              ActionInContext(found, path[-1], path),
+                              options, log, monitor, stdout, durations))
+    return steps
+
+
+def _action_main(action, options, args, stdout, log, monitor,
+                 index_cache=None, index_key=None, durations=None):
+    action = prepare_action(action, options)
+    steps = None
+    if index_cache is None and len(args) > 0:
+        steps = plan_steps_by_path(action, options, args, stdout, log,
+                                   monitor, durations)
+    if steps is None:
+        index = get_action_index(action, options, index_cache, index_key)
+        if len(args) == 0:
+            print_index(index, xrange(len(index)), stdout)
+            return action
+        try:
+            steps = plan_steps(action, index, options, args, stdout, log,
+                               monitor, durations)
+        except action_index.StaleIndexError:
+            # The tree changed without index_key changing.
+            index = get_action_index(action, options, index_cache,
+                                     index_key, rebuild=True)
+            steps = plan_steps(action, index, options, args, stdout, log,
+                               monitor, durations)
+    failures = []
+    for step in steps:
+        if not options.keep_going:
+            step()
+            continue
+        try:
+            step()
+        except ActionsFailed, exc:
+            failures.extend(exc.failures)
+    if len(failures) > 0:
+        raise ActionsFailed(failures)
+    return action
 
 
 def action_main(action, args, stdout=sys.stdout,
-                log=build_log.DummyLogWriter()):
+                log=build_log.DummyLogWriter(), index_cache=None,
+                index_key=None):
     parser = optparse.OptionParser()
     add_options(parser)
     options, remaining_args = parser.parse_args(args)
-    action_main_(action, options, remaining_args, stdout, log)
+    action_main_(action, options, remaining_args, stdout, log,
+                 index_cache, index_key)
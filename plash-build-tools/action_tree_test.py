@@ -17,9 +17,23 @@
 # 02110-1301, USA.
 
 import StringIO
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+import action_filter
+import action_index
+import action_profile
+import action_remote
+import action_timeout
 import action_tree
+import action_watch
 import build_log
 
 
@@ -78,22 +92,392 @@ class TreeWithFailure(object):
         return [self.failer, self.subtree]
 
 
+class TreeWithConcurrentFailure(object):
+
+    def __init__(self):
+        self._failed = threading.Event()
+
+    def failer(self, log):
+        self._failed.set()
+        raise Exception("lose")
+
+    # Still running when failer fails.
+    def slow(self, log):
+        self._failed.wait(5)
+        time.sleep(0.1)
+
+    def after_slow(self, log):
+        pass
+
+    @action_tree.action_node
+    def subtree(self):
+        return [self.slow, self.after_slow]
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [self.failer, action_tree.after([], self.subtree)]
+
+
+class ParallelTree(object):
+
+    def __init__(self):
+        self.got = []
+        self._both_started = threading.Event()
+        self._lock = threading.Lock()
+
+    def record(self, name):
+        self._lock.acquire()
+        try:
+            self.got.append(name)
+        finally:
+            self._lock.release()
+
+    def checkout(self, log):
+        self.record("checkout")
+
+    # These two can only finish if they are run concurrently.
+    def build_docs(self, log):
+        self.record("build_docs")
+        self._both_started.wait(5)
+        assert self._both_started.isSet()
+
+    def build_debs(self, log):
+        self.record("build_debs")
+        self._both_started.set()
+
+    def upload(self, log):
+        self.record("upload")
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [self.checkout,
+                action_tree.after(["checkout"], self.build_docs),
+                action_tree.after(["checkout"], self.build_debs),
+                action_tree.after(["build_docs", "build_debs"], self.upload)]
+
+
+# Module-level so that they can be pickled for ProcessExecutor.
+def log_pid(name, log):
+    sublog = log.child_log(name)
+    sublog.message(str(os.getpid()))
+    sublog.finish(0)
+
+
+def exit_in_worker(log):
+    sys.exit("lose")
+
+
+class ProcessTree(object):
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [action_tree.in_process(log_pid, "first"),
+                ("second", action_tree.in_process(log_pid, "second"), [])]
+
+
+class ProcessTreeWithFailure(object):
+
+    def leaf(self, log):
+        pass
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [action_tree.in_process(exit_in_worker), self.leaf]
+
+
+class TreeWithInputs(object):
+
+    def __init__(self, input_file):
+        self.got = []
+        self._input_file = input_file
+        self.param = "a"
+
+    def build(self, log):
+        self.got.append("build")
+
+    def no_inputs(self, log):
+        self.got.append("no_inputs")
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [action_tree.inputs(self.build, files=[self._input_file],
+                                   params=self.param),
+                self.no_inputs]
+
+
+class ScriptedWatcher(object):
+
+    # Reports that changed has changed, after delay seconds, each of
+    # the first times times that it is waited on with no timeout.
+    # Then it acts as if interrupted.
+    def __init__(self, changed, times, delay):
+        self._changed = changed
+        self._times = times
+        self._delay = delay
+
+    def wait(self, timeout):
+        if timeout is not None:
+            return set()
+        if self._times == 0:
+            raise KeyboardInterrupt()
+        self._times -= 1
+        time.sleep(self._delay)
+        return set([self._changed])
+
+    def close(self):
+        pass
+
+
+class FlakyTree(object):
+
+    def __init__(self):
+        self.got = []
+        self.fail = True
+
+    def leaf1(self, log):
+        self.got.append("leaf1")
+
+    def leaf2(self, log):
+        self.got.append("leaf2")
+        if self.fail:
+            raise Exception("lose")
+
+    def leaf3(self, log):
+        self.got.append("leaf3")
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [self.leaf1, self.leaf2, self.leaf3]
+
+
+class CountingTree(object):
+
+    def __init__(self):
+        self.expanded = []
+
+    def leaf(self, log):
+        pass
+
+    @action_tree.action_node
+    def a(self):
+        self.expanded.append("a")
+        return [self.leaf]
+
+    @action_tree.action_node
+    def b(self):
+        self.expanded.append("b")
+        return [self.leaf]
+
+    @action_tree.action_node
+    def all_steps(self):
+        self.expanded.append("all_steps")
+        return [self.a, self.b]
+
+
+class CoroutineTree(object):
+
+    def __init__(self, temp_dir):
+        self.threads = []
+        self._flag_file = os.path.join(temp_dir, "flag")
+
+    # This can only finish if wait_for_flag is run concurrently.
+    def wait_for_flag(self, log):
+        self.threads.append(threading.currentThread())
+        sublog = log.child_log("poll")
+        rc = yield subprocess.Popen(
+            ["sh", "-c", 'for i in $(seq 500); do [ -e "$0" ] && exit 0; '
+             'sleep 0.01; done; exit 1', self._flag_file])
+        assert rc == 0, rc
+        sublog.finish(0)
+
+    def set_flag(self, log):
+        self.threads.append(threading.currentThread())
+        yield 0.05
+        write_file(self._flag_file, "")
+
+    def interrupt(self, log):
+        yield 0
+        raise KeyboardInterrupt()
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [self.wait_for_flag,
+                ("set_flag", self.set_flag, []),
+                action_tree.after([], action_tree.annotate(self.set_flag))]
+
+
+class RemoteTree(object):
+
+    def first(self, log):
+        log_pid("pid", log)
+        fh = log.make_file()
+        fh.write("output of first")
+        fh.close()
+
+    def second(self, log):
+        log_pid("pid", log)
+
+    def failer(self, log):
+        raise Exception("lose")
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [self.first, ("second", self.second, [])]
+
+    @action_tree.action_node
+    def with_failure(self):
+        return [self.failer, self.second]
+
+
+class TreeWithTimeouts(object):
+
+    def __init__(self):
+        self.got = []
+
+    def slow(self, log):
+        time.sleep(0.3)
+        self.got.append("slow")
+
+    def hung(self, log):
+        self.got.append("hung")
+        yield subprocess.Popen(["sleep", "60"])
+
+    def hung_command(self, log):
+        self.got.append("hung_command")
+        action_timeout.cmd_env.BasicEnv().cmd(["sh", "-c", "sleep 60"])
+
+    def fast(self, log):
+        self.got.append("fast")
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [action_tree.annotate(self.slow, timeout=0.05), self.fast]
+
+    @action_tree.action_node
+    def coroutines(self):
+        return [self.hung, self.fast]
+
+    @action_tree.action_node
+    def commands(self):
+        return [action_tree.annotate(self.hung_command, timeout=0.1),
+                self.fast]
+
+
+class IndependentTree(object):
+
+    def __init__(self):
+        self.got = []
+
+    def short(self, log):
+        self.got.append("short")
+
+    def long(self, log):
+        self.got.append("long")
+
+    def after_short(self, log):
+        self.got.append("after_short")
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [self.short, ("long", self.long, []),
+                action_tree.after(["short"], self.after_short)]
+
+
+class TreeWithFailedDependency(object):
+
+    def __init__(self):
+        self.got = []
+
+    def failer(self, log):
+        raise Exception("lose")
+
+    def needs_failer(self, log):
+        self.got.append("needs_failer")
+
+    def needs_that(self, log):
+        self.got.append("needs_that")
+
+    def follower(self, log):
+        self.got.append("follower")
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [self.failer,
+                action_tree.after(["failer"], self.needs_failer),
+                action_tree.after(["needs_failer"], self.needs_that),
+                self.follower]
+
+
+class TreeWithResources(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._holding = {}
+        self.most_held = {}
+
+    def _use(self, names, log):
+        self._lock.acquire()
+        try:
+            for name in names:
+                self._holding[name] = self._holding.get(name, 0) + 1
+                self.most_held[name] = max(self.most_held.get(name, 0),
+                                           self._holding[name])
+        finally:
+            self._lock.release()
+        time.sleep(0.05)
+        self._lock.acquire()
+        try:
+            for name in names:
+                self._holding[name] -= 1
+        finally:
+            self._lock.release()
+
+    @action_tree.action_node
+    def all_steps(self):
+        return [("build%i" % i,
+                 action_tree.uses(
+                     lambda log, i=i: self._use(["chroot:%i" % (i % 3),
+                                                 "cpu"], log),
+                     "chroot:%i" % (i % 3), "cpu=2"),
+                 [])
+                for i in range(6)]
+
+
+class RecordingFile(StringIO.StringIO):
+
+    def __init__(self, files):
+        StringIO.StringIO.__init__(self)
+        self._files = files
+
+    def close(self):
+        self._files.append(self.getvalue())
+        StringIO.StringIO.close(self)
+
+
 class SimpleLog(object):
 
     def __init__(self, name="top"):
         self._name = name
         self._sublogs = []
         self._result = None
+        self.messages = []
+        self.files = []
 
-    def start(self):
+    def start(self, start_time=None):
         pass
 
+    def message(self, message):
+        self.messages.append(message)
+
     def child_log(self, name, do_start=True):
         child = SimpleLog(name)
         self._sublogs.append(child)
         return child
 
-    def finish(self, result):
+    def make_file(self):
+        return RecordingFile(self.files)
+
+    def finish(self, result, end_time=None):
         self._result = result
 
     def format(self, stream, indent=0):
@@ -115,6 +499,14 @@ def assert_equals(x, y):
         raise AssertionError('"%s" != "%s"' % (x, y))
 
 
+def write_file(filename, data):
+    fh = open(filename, "w")
+    try:
+        fh.write(data)
+    finally:
+        fh.close()
+
+
 def iostring(func):
     stream = StringIO.StringIO()
     func(stream)
@@ -201,6 +593,21 @@ top [None]
     quux [0]
 """)
 
+    def test_logging_range(self):
+        tree = ExampleTree().all_steps
+        for args in (["bar:qux"], ["-j", "2", "bar:qux"]):
+            log = SimpleLog()
+            action_tree.action_main(tree, args, log=log)
+            # The leaves in the range share their parents' logs.
+            assert_equals(iostring(log.format), """\
+top [None]
+  subtree1 [0]
+    bar [0]
+    baz [0]
+  subtree2 [0]
+    qux [0]
+""")
+
     def test_logging_enrol_up_front(self):
         tree = TreeWithFailure().all_steps
         log = SimpleLog()
@@ -216,6 +623,770 @@ top [None]
     leaf2 [None]
 """)
 
+    def test_parallel_running(self):
+        tree = ParallelTree()
+        log = SimpleLog()
+        action_tree.action_main(tree.all_steps, ["-j", "4", "0"], log=log)
+        self.assertEquals(tree.got[0], "checkout")
+        self.assertEquals(sorted(tree.got[1:3]), ["build_debs", "build_docs"])
+        self.assertEquals(tree.got[3], "upload")
+        assert_equals(iostring(log.format), """\
+top [None]
+  checkout [0]
+  build_docs [0]
+  build_debs [0]
+  upload [0]
+""")
+
+    def test_parallel_running_keeps_sequential_order(self):
+        example = ExampleTree()
+        action_tree.action_main(example.all_steps, ["--jobs", "4", "0"])
+        self.assertEquals(example.got, ["foo", "bar", "baz", "qux", "quux"])
+
+    def test_parallel_failure(self):
+        tree = TreeWithFailure().all_steps
+        log = SimpleLog()
+        self.assertRaises(
+            Exception,
+            lambda: action_tree.action_main(tree, ["-j", "2", "0"], log=log))
+        assert_equals(iostring(log.format), """\
+top [None]
+  failer [1]
+  subtree [None]
+    leaf1 [None]
+    leaf2 [None]
+""")
+
+    def test_parallel_failure_finishes_started_logs(self):
+        log = SimpleLog()
+        self.assertRaises(
+            Exception,
+            lambda: action_tree.action_main(
+                TreeWithConcurrentFailure().all_steps, ["-j", "2", "0"],
+                log=log))
+        assert_equals(iostring(log.format), """\
+top [None]
+  failer [1]
+  subtree [1]
+    slow [0]
+    after_slow [None]
+""")
+
+    def test_scheduler_with_no_capacity(self):
+        # Rather than finishing without starting anything.
+        example = ExampleTree()
+        self.assertRaises(
+            Exception,
+            lambda: action_tree.run_with_executor(
+                example.all_steps, SimpleLog(),
+                action_tree.ThreadExecutor(0), path=["all_steps"]))
+        self.assertEquals(example.got, [])
+
+    def test_no_jobs_rejected(self):
+        for args in ([], ["--estimate"], ["--processes"]):
+            example = ExampleTree()
+            self.assertRaises(
+                ValueError,
+                lambda: action_tree.action_main(example.all_steps,
+                                                args + ["-j", "0", "0"],
+                                                stdout=StringIO.StringIO()))
+            self.assertEquals(example.got, [])
+
+    def test_keep_going(self):
+        for args in ([], ["-j", "2"]):
+            tree = TreeWithFailedDependency()
+            log = SimpleLog()
+            try:
+                action_tree.action_main(tree.all_steps,
+                                        args + ["--keep-going", "0"],
+                                        log=log)
+            except action_tree.ActionsFailed, exc:
+                self.assertEquals([key for key, exc_info in exc.failures],
+                                  ["all_steps.failer"])
+            else:
+                self.fail("Expected ActionsFailed")
+            # Only the actions declared with after() are not run.
+            self.assertEquals(tree.got, ["follower"])
+            assert_equals(iostring(log.format), """\
+top [None]
+  failer [1]
+  needs_failer [None]
+  needs_that [None]
+  follower [0]
+""")
+            self.assertEquals(len(log._sublogs[0].files), 1)
+            assert "Exception: lose" in log._sublogs[0].files[0], \
+                log._sublogs[0].files
+
+    def test_keep_going_with_named_leaves(self):
+        for args in (["failer", "follower"],
+                     ["all_steps.failer", "all_steps.follower"],
+                     ["-j", "2", "failer", "follower"]):
+            tree = TreeWithFailedDependency()
+            log = SimpleLog()
+            try:
+                action_tree.action_main(tree.all_steps,
+                                        ["--keep-going"] + args, log=log)
+            except action_tree.ActionsFailed, exc:
+                self.assertEquals([key for key, exc_info in exc.failures],
+                                  ["all_steps.failer"])
+            else:
+                self.fail("Expected ActionsFailed")
+            self.assertEquals(tree.got, ["follower"])
+            assert "Exception: lose" in log.files[0], log.files
+
+    def test_filtering_keeps_implicit_dependencies(self):
+        tree = TreeWithFailedDependency().all_steps
+        filtered = action_tree.negative_filter_tree(tree, "needs_failer")
+        self.assertEquals([name for name, node in filtered.children],
+                          ["failer", "needs_that", "follower"])
+        self.assertEquals(filtered.deps, [None, [0], None])
+
+    def test_filtering_keeps_dependencies(self):
+        tree = ParallelTree().all_steps
+        filtered = action_tree.negative_filter_tree(tree, "build_docs")
+        self.assertEquals([name for name, node in filtered.children],
+                          ["checkout", "build_debs", "upload"])
+        self.assertEquals([filtered.get_deps(index) for index in range(3)],
+                          [[], [0], [0, 1]])
+
+    def test_dependency_must_be_earlier_sibling(self):
+        self.assertRaises(
+            ValueError,
+            lambda: action_tree.make_node(
+                [action_tree.after(["bar"], ExampleTree().foo)], "top"))
+
+    def test_process_pool(self):
+        log = SimpleLog()
+        action_tree.action_main(ProcessTree().all_steps,
+                                ["-j", "2", "--processes", "0"], log=log)
+        assert_equals(iostring(log.format), """\
+top [None]
+  log_pid [0]
+    first [0]
+  second [0]
+    second [0]
+""")
+        pids = [sublog._sublogs[0].messages[0] for sublog in log._sublogs]
+        assert str(os.getpid()) not in pids, pids
+
+    def test_process_pool_failure(self):
+        log = SimpleLog()
+        self.assertRaises(
+            action_tree.ProcessActionError,
+            lambda: action_tree.action_main(
+                ProcessTreeWithFailure().all_steps, ["--processes", "0"],
+                log=log))
+        assert_equals(iostring(log.format), """\
+top [None]
+  exit_in_worker [1]
+  leaf [None]
+""")
+
+    def test_coroutine_actions(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        tree = CoroutineTree(temp_dir)
+        log = SimpleLog()
+        action_tree.action_main(tree.all_steps, ["--async-jobs", "4", "0"],
+                                log=log)
+        assert_equals(iostring(log.format), """\
+top [None]
+  wait_for_flag [0]
+    poll [0]
+  set_flag [0]
+  set_flag [0]
+""")
+        self.assertEquals(len(set(tree.threads)), 1)
+        assert threading.currentThread() not in tree.threads
+
+    def test_coroutine_actions_run_sequentially(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        tree = CoroutineTree(temp_dir)
+        node = action_tree.make_node([tree.set_flag, tree.wait_for_flag],
+                                     "top")
+        node(SimpleLog())
+        self.assertEquals(tree.threads, [threading.currentThread()] * 2)
+
+    def test_coroutine_interrupt(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        tree = CoroutineTree(temp_dir)
+        node = action_tree.make_node([tree.interrupt], "top")
+        for args in (["0"], ["--async-jobs", "2", "0"]):
+            log = SimpleLog()
+            self.assertRaises(
+                KeyboardInterrupt,
+                lambda: action_tree.action_main(node, args, log=log))
+            # As with other actions, the log is left unfinished.
+            assert_equals(iostring(log.format), """\
+top [None]
+  interrupt [None]
+""")
+
+    def test_remote_workers(self):
+        log = SimpleLog()
+        action_tree.action_main(RemoteTree().all_steps,
+                                ["--workers", "2", "0"], log=log)
+        assert_equals(iostring(log.format), """\
+top [None]
+  first [0]
+    pid [0]
+  second [0]
+    pid [0]
+""")
+        self.assertEquals(log._sublogs[0].files, ["output of first"])
+        pids = [sublog._sublogs[0].messages[0] for sublog in log._sublogs]
+        assert str(os.getpid()) not in pids, pids
+
+    def test_remote_worker_failure(self):
+        log = SimpleLog()
+        self.assertRaises(
+            action_remote.RemoteActionError,
+            lambda: action_tree.action_main(RemoteTree().with_failure,
+                                            ["--workers", "2", "0"],
+                                            log=log))
+        assert_equals(iostring(log.format), """\
+top [None]
+  failer [1]
+  second [None]
+""")
+
+    def test_connecting_workers(self):
+        tree = RemoteTree()
+        executor = action_remote.RemoteExecutor(
+            2, listen_address=("127.0.0.1", 0))
+        threads = []
+        for i in range(2):
+            thread = threading.Thread(
+                target=lambda: action_remote.run_worker(
+                    tree.all_steps, ["all_steps"], executor.address))
+            thread.start()
+            threads.append(thread)
+        log = SimpleLog()
+        action_tree.run_with_executor(tree.all_steps, log, executor,
+                                      path=["all_steps"])
+        for thread in threads:
+            thread.join()
+        assert_equals(iostring(log.format), """\
+top [None]
+  first [0]
+    pid [0]
+  second [0]
+    pid [0]
+""")
+
+    def test_finding_remote_actions(self):
+        def leaf(log):
+            pass
+
+        tree = action_tree.make_node([("a", leaf), ("b", leaf),
+                                      ("b", leaf)], "top")
+        self.assertEquals(
+            action_remote.find_action(tree, ["top"], "top.a"), leaf)
+        for key in ("top.b", "top.c", "other.a"):
+            self.assertRaises(
+                LookupError,
+                lambda: action_remote.find_action(tree, ["top"], key))
+
+    def test_replaying_remote_log_times(self):
+        recorder = build_log.LogRecorder(get_time=lambda: 0)
+        replayer = action_remote.LogReplayer(recorder)
+        for line in ["root add log step", "step name step",
+                     "step start_time 10.5", "step end_time 20.5",
+                     "step result 0"]:
+            replayer.process_line(line)
+        self.assertEquals(recorder.get_records(),
+                          [(0, "child_log", "step", False),
+                           (1, "start", 10.5),
+                           (1, "finish", 0, 20.5)])
+
+    def test_action_timeout(self):
+        for args in (["0"], ["-j", "2", "0"]):
+            tree = TreeWithTimeouts()
+            log = SimpleLog()
+            self.assertRaises(
+                action_timeout.ActionTimeout,
+                lambda: action_tree.action_main(tree.all_steps, args,
+                                                log=log))
+            assert_equals(iostring(log.format), """\
+top [None]
+  slow [124]
+  fast [None]
+""")
+            self.assertEquals(log._sublogs[0].messages,
+                              ["timed out after 0.05s"])
+            self.assertEquals(tree.got, ["slow"])
+
+    def test_timeout_kills_commands(self):
+        if action_timeout.cmd_env is None:
+            self.skipTest("cmd_env is not on the path")
+        tree = TreeWithTimeouts()
+        log = SimpleLog()
+        start = time.time()
+        self.assertRaises(
+            action_timeout.ActionTimeout,
+            lambda: action_tree.action_main(tree.commands, ["0"], log=log))
+        self.assertTrue(time.time() - start < 30)
+        assert_equals(iostring(log.format), """\
+top [None]
+  hung_command [124]
+  fast [None]
+""")
+
+    def test_global_timeout_stops_coroutine_actions(self):
+        tree = TreeWithTimeouts()
+        log = SimpleLog()
+        start = time.time()
+        self.assertRaises(
+            action_timeout.ActionTimeout,
+            lambda: action_tree.action_main(
+                tree.coroutines, ["--async-jobs", "2", "--timeout", "0.1",
+                                  "0"], log=log))
+        self.assertTrue(time.time() - start < 30)
+        assert_equals(iostring(log.format), """\
+top [None]
+  hung [124]
+  fast [None]
+""")
+
+    def test_history_priority(self):
+        durations = {"all_steps.short": 1, "all_steps.long": 10,
+                     "all_steps.after_short": 1}
+        tree = IndependentTree()
+        action_tree.TreeScheduler(action_tree.ThreadExecutor(1),
+                                  durations=durations).run(tree.all_steps,
+                                                           SimpleLog())
+        self.assertEquals(tree.got, ["long", "short", "after_short"])
+        # What follows an action counts towards its priority.
+        durations["all_steps.after_short"] = 20
+        tree = IndependentTree()
+        action_tree.TreeScheduler(action_tree.ThreadExecutor(1),
+                                  durations=durations).run(tree.all_steps,
+                                                           SimpleLog())
+        self.assertEquals(tree.got, ["short", "after_short", "long"])
+
+    def test_estimated_remaining_time(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        logset = build_log.LogSetDir(temp_dir)
+        stream = StringIO.StringIO()
+        action_tree.action_main(ExampleTree().all_steps, ["--estimate", "0"],
+                                stdout=stream, log=logset.make_logger())
+        # Without history there is no estimate.
+        self.assertEquals(stream.getvalue().splitlines()[0],
+                          "Progress: 1/5 actions finished")
+        log = logset.make_logger()
+        self.assertEquals(
+            sorted(log.get_log_dir().get_past_durations().keys()),
+            ["all_steps.subtree1.bar", "all_steps.subtree1.baz",
+             "all_steps.subtree1.foo", "all_steps.subtree2.quux",
+             "all_steps.subtree2.qux"])
+        stream = StringIO.StringIO()
+        action_tree.action_main(ExampleTree().all_steps, ["--estimate", "0"],
+                                stdout=stream, log=log)
+        lines = stream.getvalue().splitlines()
+        self.assertEquals(len(lines), 5)
+        assert lines[0].startswith(
+            "Progress: 1/5 actions finished, about "), lines
+
+    def test_resources(self):
+        tree = TreeWithResources()
+        action_tree.action_main(tree.all_steps,
+                                ["-j", "6", "--resource", "cpu=5", "0"])
+        # Each chroot is used by one action at a time, and the three
+        # chroots could be used at once, but there is only enough cpu
+        # for two actions.
+        self.assertEquals(tree.most_held,
+                          {"chroot:0": 1, "chroot:1": 1, "chroot:2": 1,
+                           "cpu": 2})
+        self.assertEquals(action_tree.parse_resources(["a", "b:c=3"]),
+                          {"a": 1, "b:c": 3})
+        self.assertRaises(ValueError,
+                          lambda: action_tree.parse_resources(["a=b"]))
+
+    def test_skipping_up_to_date_actions(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        input_file = os.path.join(temp_dir, "input")
+        stamps_file = os.path.join(temp_dir, "stamps")
+        write_file(input_file, "foo")
+        tree = TreeWithInputs(input_file)
+
+        def run(*args):
+            log = SimpleLog()
+            action_tree.action_main(
+                tree.all_steps, ["--stamps", stamps_file] + list(args),
+                log=log)
+            return log
+
+        run("0")
+        self.assertEquals(pop_all(tree.got), ["build", "no_inputs"])
+        log = run("0")
+        self.assertEquals(pop_all(tree.got), ["no_inputs"])
+        self.assertEquals(log._sublogs[0].messages,
+                          [action_tree.UP_TO_DATE_MESSAGE])
+        run("build")
+        self.assertEquals(pop_all(tree.got), [])
+        run("-j", "2", "0")
+        self.assertEquals(pop_all(tree.got), ["no_inputs"])
+        write_file(input_file, "changed")
+        run("0")
+        self.assertEquals(pop_all(tree.got), ["build", "no_inputs"])
+        tree = TreeWithInputs(input_file)
+        tree.param = "b"
+        run("1:")
+        self.assertEquals(pop_all(tree.got), ["build", "no_inputs"])
+        run("1:")
+        self.assertEquals(pop_all(tree.got), ["no_inputs"])
+
+    def test_resume(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        logset = build_log.LogSetDir(temp_dir)
+        tree = FlakyTree()
+        self.assertRaises(
+            Exception,
+            lambda: action_tree.action_main(tree.all_steps, ["0"],
+                                            log=logset.make_logger()))
+        self.assertEquals(pop_all(tree.got), ["leaf1", "leaf2"])
+        tree.fail = False
+        action_tree.action_main(tree.all_steps, ["--resume", "0"],
+                                log=logset.make_logger())
+        self.assertEquals(pop_all(tree.got), ["leaf2", "leaf3"])
+        # The skipped leaf is recorded as finished in the new run too.
+        action_tree.action_main(tree.all_steps, ["--resume", "0"],
+                                log=logset.make_logger())
+        self.assertEquals(pop_all(tree.got), [])
+
+    def test_resume_needs_previous_run(self):
+        self.assertRaises(
+            Exception,
+            lambda: action_tree.action_main(FlakyTree().all_steps,
+                                            ["--resume", "0"]))
+
+    def test_running_by_glob(self):
+        example = ExampleTree()
+        action_tree.action_main(example.all_steps, ["q*"])
+        self.assertEquals(pop_all(example.got), ["qux", "quux"])
+        action_tree.action_main(example.all_steps, ["subtree*.ba?"])
+        self.assertEquals(pop_all(example.got), ["bar", "baz"])
+        # An action inside another matching one is only run once.
+        action_tree.action_main(example.all_steps, ["subtree*", "*.foo"])
+        self.assertEquals(pop_all(example.got),
+                          ["foo", "bar", "baz", "qux", "quux", "foo"])
+        action_tree.action_main(example.all_steps, ["s*.*"])
+        self.assertEquals(pop_all(example.got),
+                          ["foo", "bar", "baz", "qux", "quux"])
+
+    def test_sharding(self):
+        example = ExampleTree()
+        for shard in ("1/2", "2/2"):
+            action_tree.action_main(example.all_steps,
+                                    ["--shard", shard, "-j", "2", "0"])
+        # Without history, shards have about the same number of leaves.
+        self.assertEquals(pop_all(example.got),
+                          ["foo", "bar", "baz", "qux", "quux"])
+        action_tree.action_main(example.all_steps,
+                                ["--shard", "2/2", "subtree1"])
+        self.assertEquals(pop_all(example.got), ["bar", "baz"])
+        tree = example.all_steps
+        index = action_index.build_index(tree, action_tree.get_children)
+        leaves = action_tree.get_leaves(index, [0])
+        durations = {"all_steps.subtree1.foo": 10,
+                     "all_steps.subtree1.bar": 1,
+                     "all_steps.subtree1.baz": 1,
+                     "all_steps.subtree2.qux": 4}
+        # quux has no history, so it is assumed to take the average.
+        self.assertEquals(
+            [index.names[leaf] for leaf
+             in action_tree.get_shard(index, leaves, durations, 1, 2)],
+            ["foo"])
+        self.assertEquals(
+            [index.names[leaf] for leaf
+             in action_tree.get_shard(index, leaves, durations, 2, 2)],
+            ["bar", "baz", "qux", "quux"])
+        for text in ("1", "0/2", "3/2", "a/b"):
+            self.assertRaises(ValueError,
+                              lambda: action_tree.parse_shard(text))
+
+    def test_watching_inputs(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        input_file = os.path.join(temp_dir, "input")
+        write_file(input_file, "a")
+        for make_watcher in (action_watch.InotifyWatcher,
+                             lambda paths: action_watch.PollingWatcher(
+                                 paths, interval=0.01)):
+            watcher = make_watcher([input_file])
+            try:
+                self.assertEquals(watcher.wait(0.05), set())
+                time.sleep(0.02)
+                write_file(input_file, "bb")
+                write_file(os.path.join(temp_dir, "other"), "c")
+                changed = action_watch.wait_for_changes(watcher, 0.1)
+            finally:
+                watcher.close()
+            assert input_file in changed, changed
+        self.assertTrue(action_watch.is_affected([temp_dir], [input_file]))
+        self.assertFalse(action_watch.is_affected([input_file],
+                                                  [input_file + "2"]))
+
+    def test_watch_reruns_resumed_actions(self):
+        monitor = action_tree.get_rerun_monitor(
+            [action_tree.ResumeMonitor(set(["all_steps.foo"]))])
+        self.assertEquals(monitor.before("all_steps.foo", None), None)
+
+    def test_watch_reruns_get_fresh_deadlines(self):
+        input_file = os.path.abspath("input")
+        tree = TreeWithInputs(input_file)
+        parser = optparse.OptionParser()
+        action_tree.add_options(parser)
+        options, args = parser.parse_args(["--timeout", "0.05", "0"])
+        stdout = StringIO.StringIO()
+        # Each change comes after the first run's deadline.
+        action_watch.watch(
+            tree.all_steps, options, args, stdout,
+            build_log.DummyLogWriter(), action_tree.LeafMonitors([]),
+            make_watcher=lambda paths: ScriptedWatcher(input_file, 2, 0.1))
+        self.assertEquals(tree.got, ["build", "build"])
+        self.assertEquals(stdout.getvalue().count("Traceback"), 0)
+
+    def test_watch_reruns_declared_dependents(self):
+        tree = TreeWithFailedDependency().all_steps
+        index = action_index.build_index(tree, action_tree.get_children)
+        failer, needs_failer, needs_that, follower = range(1, 5)
+        self.assertEquals(action_watch.add_dependents(tree, index, [failer]),
+                          [failer, needs_failer, needs_that])
+        self.assertEquals(
+            action_watch.add_dependents(tree, index, [follower]), [follower])
+        example = ExampleTree()
+        index = action_index.build_index(example.all_steps,
+                                         action_tree.get_children)
+        pruned = action_tree.prune_to_nodes(example.all_steps, index, [2, 6])
+        pruned(SimpleLog())
+        self.assertEquals(example.got, ["foo", "qux"])
+
+    def test_flatten_tree(self):
+        acts = list(action_tree.flatten_tree(ExampleTree().all_steps))
+        self.assertEquals(
+            [(act.get_level(), ".".join(act.path)) for act in acts],
+            [(0, "all_steps"),
+             (1, "all_steps.subtree1"),
+             (2, "all_steps.subtree1.foo"),
+             (2, "all_steps.subtree1.bar"),
+             (2, "all_steps.subtree1.baz"),
+             (1, "all_steps.subtree2"),
+             (2, "all_steps.subtree2.qux"),
+             (2, "all_steps.subtree2.quux")])
+        self.assertEquals(list(acts[3].get_names()),
+                          ["all_steps.subtree1.bar", "subtree1.bar", "bar"])
+        path = acts[6].path
+        self.assertEquals(len(path), 3)
+        self.assertEquals(list(reversed(path)),
+                          ["qux", "subtree2", "all_steps"])
+        self.assertEquals(path[1:], ["subtree2", "qux"])
+        self.assertEquals(path + ["x"],
+                          ["all_steps", "subtree2", "qux", "x"])
+        # Deeper than the recursion limit.
+        depth = sys.getrecursionlimit() * 2
+        node = action_tree.ActionTreeNode([], "node")
+        for i in range(depth):
+            node = action_tree.ActionTreeNode([("node", node)], "node")
+        acts = list(action_tree.flatten_tree(node))
+        self.assertEquals(len(acts), depth + 1)
+        self.assertEquals(acts[-1].get_level(), depth)
+        self.assertEquals(len(acts[-1].path), depth + 1)
+        self.assertEquals(list(acts[-1].path), ["node"] * (depth + 1))
+
+    def test_action_index(self):
+        index = action_index.build_index(ExampleTree().all_steps,
+                                         action_tree.get_children)
+        self.assertEquals(index.names,
+                          ["all_steps", "subtree1", "foo", "bar", "baz",
+                           "subtree2", "qux", "quux"])
+        self.assertEquals(index.levels, [0, 1, 2, 2, 2, 1, 2, 2])
+        self.assertEquals(index.ends, [8, 5, 3, 4, 5, 8, 7, 8])
+        self.assertEquals(index.lookup("foo"), [2])
+        self.assertEquals(index.lookup("subtree1.foo"), [2])
+        self.assertEquals(index.lookup("all_steps.subtree1.foo"), [2])
+        self.assertEquals(index.lookup("subtree2.foo"), [])
+        self.assertEquals(index.lookup("6"), [6])
+        self.assertEquals(index.glob("*.q*"), [6, 7])
+        self.assertEquals(index.lookup("all_steps.foo"), [])
+        self.assertEquals(index.glob("all_steps.subtree2.*"), [6, 7])
+        self.assertEquals(index.glob("all_steps.subtree1.b*"), [3, 4])
+        self.assertEquals(index.glob("subtree?.*a*"), [3, 4])
+        self.assertEquals(index.glob("other.subtree1.*"), [])
+        self.assertEquals(index.get_path(4), ["all_steps", "subtree1", "baz"])
+        self.assertEquals(list(index.get_children(0)), [1, 5])
+
+    def test_index_cache(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        cache_file = os.path.join(temp_dir, "index")
+        example = ExampleTree()
+
+        def run(tree, args, key):
+            stream = StringIO.StringIO()
+            action_tree.action_main(tree, args, stdout=stream,
+                                    index_cache=cache_file, index_key=key)
+            return stream.getvalue()
+
+        listing = run(example.all_steps, [], "v1")
+        assert os.path.exists(cache_file)
+        smaller_tree = action_tree.make_node([example.subtree1], "all_steps")
+        # The stale cache is used while the key is unchanged...
+        self.assertEquals(run(smaller_tree, [], "v1"), listing)
+        # ...and replaced when it changes.
+        assert_equals(run(smaller_tree, [], "v2"), """\
+0: all_steps
+   1: subtree1
+      2: foo
+      3: bar
+      4: baz
+""")
+        run(example.all_steps, ["-f", "subtree1", "bar"], "v1")
+        self.assertEquals(pop_all(example.got), ["bar"])
+        # A stale cache that does not match the tree is rebuilt rather
+        # than used to find actions.
+        run(example.all_steps, [], "v3")
+        reordered_tree = action_tree.make_node(
+            [example.subtree2, example.subtree1], "all_steps")
+        run(reordered_tree, ["bar"], "v3")
+        self.assertEquals(pop_all(example.got), ["bar"])
+        assert_equals(run(reordered_tree, [], "v3").splitlines()[1],
+                      "   1: subtree2")
+
+    def test_lazy_tree_construction(self):
+        tree = CountingTree()
+        self.assertTrue(tree.all_steps is tree.all_steps)
+        self.assertEquals(tree.expanded, [])
+        self.assertEquals([name for name, node in tree.all_steps.children],
+                          ["a", "b"])
+        tree.all_steps.children
+        self.assertEquals(tree.expanded, ["all_steps"])
+
+    def test_cached_index_only_expands_selected_path(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        cache_file = os.path.join(temp_dir, "index")
+
+        def run(tree, args):
+            action_tree.action_main(tree.all_steps, args,
+                                    stdout=StringIO.StringIO(),
+                                    index_cache=cache_file, index_key="v1")
+
+        tree = CountingTree()
+        run(tree, [])
+        self.assertEquals(tree.expanded, ["all_steps", "a", "b"])
+        tree = CountingTree()
+        run(tree, [])
+        run(tree, ["--print", "0"])
+        self.assertEquals(tree.expanded, [])
+        run(tree, ["a"])
+        self.assertEquals(tree.expanded, ["all_steps", "a"])
+
+    def test_full_paths_found_without_index(self):
+        tree = CountingTree()
+        action_tree.action_main(tree.all_steps, ["all_steps.b"])
+        self.assertEquals(tree.expanded, ["all_steps", "b"])
+        # Other names need the whole tree to be searched.
+        tree = CountingTree()
+        action_tree.action_main(tree.all_steps, ["b"])
+        self.assertEquals(tree.expanded, ["all_steps", "a", "b"])
+
+    def test_filter_expressions(self):
+        example = ExampleTree()
+
+        def run(*filters):
+            args = []
+            for filter_text in filters:
+                args.extend(["-f", filter_text])
+            action_tree.action_main(example.all_steps, args + ["0"])
+            return pop_all(example.got)
+
+        self.assertEquals(run("subtree1 or qux"), ["foo", "bar", "baz", "qux"])
+        self.assertEquals(run("/tree2/"), ["qux", "quux"])
+        self.assertEquals(run("b* and not baz"), ["bar"])
+        self.assertEquals(run("-(subtree1 or quux)"), ["qux"])
+        self.assertEquals(run("subtree1", "-bar"), ["foo", "baz"])
+        self.assertEquals(run("subtree2.q*"), ["qux", "quux"])
+        self.assertEquals(run("nonexistent"), [])
+
+    def test_filtering_shares_unchanged_nodes(self):
+        tree = ExampleTree().all_steps
+        filtered = action_tree.apply_filter(
+            tree, action_filter.compile_filters(["-qux"]))
+        self.assertEquals(filtered.__name__, "all_steps")
+        self.assertTrue(filtered.children[0][1] is tree.children[0][1])
+        self.assertTrue(
+            action_tree.apply_filter(
+                tree, action_filter.compile_filters(["not x"])) is tree)
+
+    def test_filter_syntax_errors(self):
+        for text in ["(foo", "foo and", "foo bar", "/foo", "or", "/(/"]:
+            self.assertRaises(action_filter.FilterSyntaxError,
+                              lambda: action_filter.compile_filters([text]))
+
+    def test_critical_path(self):
+        walls = {"checkout": 1, "build_docs": 3, "build_debs": 2,
+                 "upload": 1}
+        timings = dict(("all_steps.%s" % name,
+                        action_profile.Timing(0, wall, 0, 0))
+                       for name, wall in walls.iteritems())
+        span, keys = action_profile.critical_path(
+            ParallelTree().all_steps, ["all_steps"], timings,
+            action_tree.get_children)
+        self.assertEquals(span, 5)
+        self.assertEquals(keys, ["all_steps.checkout", "all_steps.build_docs",
+                                 "all_steps.upload"])
+        # Siblings with no declared dependencies run one after another.
+        del timings["all_steps.upload"]
+        timings["all_steps.subtree1.foo"] = action_profile.Timing(0, 1, 0, 0)
+        timings["all_steps.subtree2.qux"] = action_profile.Timing(0, 2, 0, 0)
+        span, keys = action_profile.critical_path(
+            ExampleTree().all_steps, ["all_steps"], timings,
+            action_tree.get_children)
+        self.assertEquals(span, 3)
+
+    def test_profile_output(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        folded_file = os.path.join(temp_dir, "folded")
+        stream = StringIO.StringIO()
+        action_tree.action_main(
+            ExampleTree().all_steps,
+            ["--profile", "--profile-top", "2", "--profile-output",
+             folded_file, "0"], stdout=stream)
+        report = stream.getvalue()
+        assert "Critical path:" in report, report
+        slowest = report.split("Slowest actions:\n")[1].splitlines()
+        self.assertEquals(len(slowest), 3)
+        lines = open(folded_file, "r").read().splitlines()
+        self.assertEquals([line.split(" ")[0] for line in lines],
+                          ["all_steps;subtree1;bar",
+                           "all_steps;subtree1;baz",
+                           "all_steps;subtree1;foo",
+                           "all_steps;subtree2;quux",
+                           "all_steps;subtree2;qux"])
+
+    def test_profile_error_does_not_hide_failure(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-action_tree_test-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        stream = StringIO.StringIO()
+        try:
+            action_tree.action_main(
+                TreeWithFailure().all_steps,
+                ["--profile-output", os.path.join(temp_dir, "no/such/file"),
+                 "0"], stdout=stream)
+        except Exception, exc:
+            self.assertEquals(str(exc), "lose")
+        else:
+            self.fail("Expected an exception")
+        assert "IOError" in stream.getvalue(), stream.getvalue()
+
 
 if __name__ == "__main__":
     unittest.main()
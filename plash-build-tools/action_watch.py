@@ -0,0 +1,285 @@
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Re-running actions when their inputs change (--watch).
+
+Only the files that leaves declare with action_tree.inputs() are
+watched.  When some of them change, the leaves that declare them are
+re-run, along with the actions that were declared with after() to
+depend on those leaves or their ancestors.  Actions that merely follow
+them are not re-run.
+
+On Linux, changes are noticed with inotify.  Elsewhere, the files'
+sizes and mtimes are polled.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import select
+import struct
+import time
+import traceback
+
+import action_index
+import action_tree
+import stamp_db
+
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+_event_header = struct.Struct("iIII")
+
+
+def get_watched_dirs(input_paths):
+    # Files are watched through their directories, so that files that
+    # editors replace by renaming are still noticed.
+    dirs = set()
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            for dir_path, dirnames, filenames in os.walk(input_path):
+                dirs.add(dir_path)
+        else:
+            dirs.add(os.path.dirname(input_path))
+    return sorted(dirs)
+
+
+class InotifyWatcher(object):
+
+    def __init__(self, input_paths):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init() failed")
+        fcntl.fcntl(self._fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._dirs = {}
+        for dir_path in get_watched_dirs(input_paths):
+            self._add_watch(dir_path)
+
+    def _add_watch(self, dir_path):
+        wd = self._libc.inotify_add_watch(self._fd, dir_path, WATCH_MASK)
+        # Directories that do not exist yet cannot be watched.
+        if wd >= 0:
+            self._dirs[wd] = dir_path
+
+    def wait(self, timeout):
+        """Returns the pathnames that changed, or an empty set if
+        nothing changed within timeout seconds (None to block)."""
+        while True:
+            try:
+                readable = select.select([self._fd], [], [], timeout)[0]
+                break
+            except select.error, exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+        if len(readable) == 0:
+            return set()
+        data = os.read(self._fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            dir_path = self._dirs.get(wd)
+            if dir_path is None:
+                continue
+            pathname = os.path.join(dir_path, name)
+            changed.add(pathname)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                for new_dir in get_watched_dirs([pathname]):
+                    self._add_watch(new_dir)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+
+    def __init__(self, input_paths, interval=0.5):
+        self._input_paths = input_paths
+        self._interval = interval
+        self._state = self._get_state()
+
+    def _get_state(self):
+        state = {}
+        for input_path in self._input_paths:
+            for pathname in stamp_db.walk_files(input_path):
+                try:
+                    stat = os.stat(pathname)
+                except OSError:
+                    continue
+                state[pathname] = (stat.st_size, stat.st_mtime)
+        return state
+
+    def wait(self, timeout):
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while True:
+            state = self._get_state()
+            changed = set(pathname for pathname
+                          in set(state).union(self._state)
+                          if state.get(pathname) !=
+                          self._state.get(pathname))
+            self._state = state
+            if len(changed) > 0:
+                return changed
+            if end_time is None:
+                time.sleep(self._interval)
+            else:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return changed
+                time.sleep(min(self._interval, remaining))
+
+    def close(self):
+        pass
+
+
+def make_watcher(input_paths):
+    try:
+        return InotifyWatcher(input_paths)
+    except (OSError, AttributeError):
+        # AttributeError means that libc has no inotify.
+        return PollingWatcher(input_paths)
+
+
+def wait_for_changes(watcher, debounce):
+    """Waits for something to change, then for debounce seconds in
+    which nothing else changes, so that a burst of changes (such as
+    saving several files) gives one re-run."""
+    changed = set()
+    while len(changed) == 0:
+        changed.update(watcher.wait(None))
+    while True:
+        more = watcher.wait(debounce)
+        if len(more) == 0:
+            return changed
+        changed.update(more)
+
+
+def get_leaf_inputs(root, index, leaves):
+    # Returns a dict mapping leaf indexes to their declared input
+    # files, as absolute pathnames.
+    got = {}
+    for leaf in leaves:
+        input_files = getattr(index.get_action(root, leaf), "input_files",
+                              None)
+        if input_files:
+            got[leaf] = [os.path.abspath(input_path)
+                         for input_path in input_files]
+    return got
+
+
+def is_affected(input_paths, changed):
+    for input_path in input_paths:
+        prefix = input_path.rstrip("/") + "/"
+        for pathname in changed:
+            if pathname == input_path or pathname.startswith(prefix):
+                return True
+    return False
+
+
+def add_dependents(root, index, node_indexes):
+    """Returns node_indexes plus the nodes that were declared with
+    after() to depend on any of them or their ancestors, directly or
+    indirectly."""
+    got = set(node_indexes)
+    to_visit = list(got)
+    visited = set()
+    while len(to_visit) > 0:
+        node_index = to_visit.pop()
+        while node_index > 0 and node_index not in visited:
+            visited.add(node_index)
+            parent = index.parents[node_index]
+            parent_action = index.get_action(root, parent)
+            for sibling in index.get_children(parent):
+                deps = parent_action.deps[index.positions[sibling]]
+                if (deps is not None and
+                    index.positions[node_index] in deps and
+                    sibling not in got):
+                    got.add(sibling)
+                    to_visit.append(sibling)
+            node_index = parent
+    return sorted(got)
+
+
+def watch(action, options, args, stdout, log, monitor, durations=None,
+          debounce=0.2, make_watcher=make_watcher):
+    """Re-runs the leaves selected by args whenever their declared
+    inputs change, until interrupted.  action is the tree before
+    prepare_action(), which is applied for each re-run so that each
+    gets its own --timeout deadline."""
+    prepared = action_tree.prepare_action(action, options)
+    index = action_index.build_index(prepared, action_tree.get_children)
+    leaves = action_tree.get_leaves(
+        index, [node_index for arg in args
+                for node_index in action_tree.select_nodes(index, arg)])
+    leaf_inputs = get_leaf_inputs(prepared, index, leaves)
+    input_paths = sorted(set(input_path
+                             for input_paths in leaf_inputs.itervalues()
+                             for input_path in input_paths))
+    if len(input_paths) == 0:
+        stdout.write("No inputs declared, so there is nothing to watch\n")
+        return
+    stdout.write("Watching %i inputs of %i actions\n"
+                 % (len(input_paths), len(leaf_inputs)))
+    stdout.flush()
+    watcher = make_watcher(input_paths)
+    try:
+        while True:
+            changed = wait_for_changes(watcher, debounce)
+            affected = [leaf for leaf, paths
+                        in sorted(leaf_inputs.iteritems())
+                        if is_affected(paths, changed)]
+            if len(affected) == 0:
+                continue
+            prepared = action_tree.prepare_action(action, options)
+            to_run = add_dependents(prepared, index, affected)
+            stdout.write("Re-running %i actions\n" % len(to_run))
+            stdout.flush()
+            act = action_tree.get_pruned_context(prepared, index, to_run)
+            try:
+                action_tree.run_action(act, options, log, monitor, stdout,
+                                       durations)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except:
+                traceback.print_exc(file=stdout)
+            stdout.write("Waiting for changes\n")
+            stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -16,20 +16,68 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+import hashlib
+import itertools
+import multiprocessing
 import os
+import re
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
 
 from buildutils import remove_prefix
 
+try:
+    import log_catalog
+except ImportError:
+    # sqlite3 is not available.
+    log_catalog = None
+
+
+# When a NodeStream writes the records it has buffered.
+FLUSH_ALWAYS = "always"      # Each record as it is written.
+FLUSH_ON_FINISH = "finish"   # When a log finishes.
+FLUSH_INTERVAL = "interval"  # At the first record after flush_interval.
+FLUSH_EXPLICIT = "explicit"  # Only when flush() is called.
+
+FLUSH_POLICIES = (FLUSH_ALWAYS, FLUSH_ON_FINISH, FLUSH_INTERVAL,
+                  FLUSH_EXPLICIT)
+
 
 class NodeStream(object):
 
-    def __init__(self, output):
+    """Writes the records of a log to output, buffering them as the
+    flush policy allows so that a chatty action does not cost a
+    write() call per record.
+
+    With FLUSH_ALWAYS or FLUSH_ON_FINISH, everything up to the end of
+    each finished log has been written, as with no buffering.  With
+    fsync, it is also synced to disc at those points."""
+
+    def __init__(self, output, flush_policy=FLUSH_ALWAYS,
+                 flush_interval=1.0, fsync=False, get_time=time.time):
+        assert flush_policy in FLUSH_POLICIES, flush_policy
         self.output = output
         self._names = set()
+        # Actions may be run on several threads at once.
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._flush_policy = flush_policy
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+        self._get_time = get_time
+        self._last_flush = get_time()
 
     def alloc_name(self, name):
+        self._lock.acquire()
+        try:
+            return self._alloc_name(name)
+        finally:
+            self._lock.release()
+
+    def _alloc_name(self, name):
         if name in self._names:
             suffix = 1
             while True:
@@ -42,6 +90,267 @@ class NodeStream(object):
         self._names.add(new_name)
         return new_name
 
+    def write_add(self, node_id, tag_name, new_id):
+        self.write("%s add %s %s\n" % (node_id, tag_name, new_id))
+
+    def write_attr(self, node_id, key, value):
+        self.write("%s %s %s\n" % (node_id, key, value))
+
+    def write(self, data):
+        self._lock.acquire()
+        try:
+            self._write(data)
+        finally:
+            self._lock.release()
+
+    def _write(self, data):
+        # Called with the lock held.
+        if self._flush_policy == FLUSH_ALWAYS:
+            self.output.write(data)
+            return
+        self._buffer.append(data)
+        if (self._flush_policy == FLUSH_INTERVAL and
+            self._get_time() - self._last_flush >= self._flush_interval):
+            self._flush()
+
+    def _flush(self):
+        # Called with the lock held.
+        if len(self._buffer) > 0:
+            self.output.write("".join(self._buffer))
+            self._buffer = []
+        self._last_flush = self._get_time()
+
+    def _sync(self):
+        if self._fsync:
+            self.output.flush()
+            os.fsync(self.output.fileno())
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._flush()
+            self._sync()
+        finally:
+            self._lock.release()
+
+    def checkpoint(self):
+        # Called when a log finishes.
+        if self._flush_policy in (FLUSH_ALWAYS, FLUSH_ON_FINISH):
+            self.flush()
+
+
+# The binary encoding of the records that NodeStream writes as text.
+# After BINARY_MAGIC, each record starts with an opcode byte:
+#
+#   _KEY <string>                       defines the next key number
+#   _ADD <node> <key> <base> <suffix>   adds a child, the next node
+#   _ATTR <node> <key> <string>         sets an attribute
+#
+# Numbers are unsigned LEB128 varints and strings are a varint length
+# followed by the bytes.  Node 0 is the root.  Keys (tag and attribute
+# names, and the names that node IDs are made from) are numbered in
+# order of definition, and nodes in the order they are added.  Added
+# nodes keep their text IDs, as made by NodeStream.alloc_name(), so
+# that logs can be converted back to text exactly: the ID is the base
+# key, followed by "_<suffix>" if the suffix is not 0.
+
+BINARY_MAGIC = "\0build_log binary 2\n"
+
+_KEY = "\0"
+_ADD = "\1"
+_ATTR = "\2"
+
+_NODE_ID_REGEXP = re.compile(r"(.*)_([1-9][0-9]*)$", re.DOTALL)
+
+
+def encode_varint(value):
+    got = []
+    while value >= 0x80:
+        got.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    got.append(chr(value))
+    return "".join(got)
+
+
+def _encode_string(string):
+    return encode_varint(len(string)) + string
+
+
+class BinaryEncoder(object):
+
+    def __init__(self):
+        self._nodes = {"root": 0}
+        self._keys = {}
+
+    def _key(self, key, got):
+        number = self._keys.get(key)
+        if number is None:
+            number = len(self._keys)
+            self._keys[key] = number
+            got.append(_KEY + _encode_string(key))
+        return encode_varint(number)
+
+    def encode_add(self, node_id, tag_name, new_id):
+        got = []
+        key = self._key(tag_name, got)
+        match = _NODE_ID_REGEXP.match(new_id)
+        if match is None:
+            base, suffix = new_id, 0
+        else:
+            base, suffix = match.group(1), int(match.group(2))
+        base = self._key(base, got)
+        got.append(_ADD + encode_varint(self._nodes[node_id]) + key +
+                   base + encode_varint(suffix))
+        self._nodes[new_id] = len(self._nodes)
+        return "".join(got)
+
+    def encode_attr(self, node_id, key, value):
+        got = []
+        key = self._key(key, got)
+        got.append(_ATTR + encode_varint(self._nodes[node_id]) + key +
+                   _encode_string(value))
+        return "".join(got)
+
+
+# The number of varints in each kind of record.  For _KEY and _ATTR,
+# the last is the length of the string that follows.
+_VARINT_COUNTS = {0: 1, 1: 4, 2: 3}
+
+
+class BinaryDecoder(object):
+
+    """Turns the binary encoding, fed in chunks of any size, back into
+    the (node ID, attribute, argument) records of the text format."""
+
+    def __init__(self):
+        self._data = ""
+        self._nodes = ["root"]
+        self._keys = []
+
+    def feed(self, data):
+        data = self._data + data
+        # Indexing a bytearray gives ints without calling ord().
+        codes = bytearray(data)
+        size = len(codes)
+        nodes = self._nodes
+        keys = self._keys
+        records = []
+        pos = 0
+        while pos < size:
+            # Decode the record's varints and string, giving up on it
+            # if it is incomplete.
+            numbers = []
+            end = pos + 1
+            opcode = codes[pos]
+            for i in xrange(_VARINT_COUNTS[opcode]):
+                if end < size and codes[end] < 0x80:
+                    # The common case of a one byte varint.
+                    numbers.append(codes[end])
+                    end += 1
+                    continue
+                value = 0
+                shift = 0
+                while end < size:
+                    byte = codes[end]
+                    end += 1
+                    value |= (byte & 0x7f) << shift
+                    if byte < 0x80:
+                        break
+                    shift += 7
+                else:
+                    break
+                numbers.append(value)
+            else:
+                if opcode == 1:
+                    new_id = keys[numbers[2]]
+                    if numbers[3] != 0:
+                        new_id = "%s_%i" % (new_id, numbers[3])
+                    nodes.append(new_id)
+                    records.append((nodes[numbers[0]], "add",
+                                    "%s %s" % (keys[numbers[1]], new_id)))
+                    pos = end
+                    continue
+                string_end = end + numbers[-1]
+                if string_end <= size:
+                    string = data[end:string_end]
+                    pos = string_end
+                    if opcode == 0:
+                        keys.append(string)
+                    else:
+                        assert opcode == 2, opcode
+                        records.append((nodes[numbers[0]], keys[numbers[1]],
+                                        string))
+                    continue
+            break
+        self._data = data[pos:]
+        return records
+
+    def close(self):
+        if len(self._data) > 0:
+            raise ValueError("Binary log ends part way through a record")
+
+
+def read_log_records(fh, chunk_size=1 << 20):
+    """Yields the (node ID, attribute, argument) records of a log in
+    either format."""
+    start = fh.read(len(BINARY_MAGIC))
+    if start == BINARY_MAGIC:
+        decoder = BinaryDecoder()
+        while True:
+            data = fh.read(chunk_size)
+            if len(data) == 0:
+                break
+            for record in decoder.feed(data):
+                yield record
+        decoder.close()
+        return
+    if start.startswith("\0"):
+        raise ValueError("Log is in an unsupported binary format: %r"
+                         % start)
+    if len(start) > 0 and not start.endswith("\n"):
+        start += fh.readline()
+    for line in itertools.chain(start.splitlines(True), fh):
+        yield tuple(line.rstrip("\n").split(" ", 2))
+
+
+class BinaryNodeStream(NodeStream):
+
+    """NodeStream that writes the binary encoding."""
+
+    def __init__(self, output, *args, **kwargs):
+        NodeStream.__init__(self, output, *args, **kwargs)
+        self._encoder = BinaryEncoder()
+        self._write(BINARY_MAGIC)
+
+    def write_add(self, node_id, tag_name, new_id):
+        self._lock.acquire()
+        try:
+            self._write(self._encoder.encode_add(node_id, tag_name, new_id))
+        finally:
+            self._lock.release()
+
+    def write_attr(self, node_id, key, value):
+        self._lock.acquire()
+        try:
+            self._write(self._encoder.encode_attr(node_id, key, value))
+        finally:
+            self._lock.release()
+
+
+def convert_log(input_file, output, binary):
+    """Copies a log in either format to output, in the binary format
+    if binary is true, otherwise as text."""
+    if binary:
+        stream = BinaryNodeStream(output)
+    else:
+        stream = NodeStream(output)
+    for node_id, attr, arg in read_log_records(input_file):
+        if attr == "add":
+            tag_name, new_id = arg.split(" ", 1)
+            stream.write_add(node_id, tag_name, new_id)
+        else:
+            stream.write_attr(node_id, attr, arg)
+
 
 class NodeWriter(object):
 
@@ -53,8 +362,7 @@ class NodeWriter(object):
         if id_name is None:
             id_name = tag_name
         new_id = self._stream.alloc_name(id_name)
-        self._stream.output.write("%s add %s %s\n" %
-                                  (self._id, tag_name, new_id))
+        self._stream.write_add(self._id, tag_name, new_id)
         child = NodeWriter(self._stream, new_id)
         for key, value in attrs:
             child.add_attr(key, value)
@@ -66,10 +374,58 @@ class NodeWriter(object):
         assert " " not in key
         assert "\n" not in key
         assert "\n" not in value
-        self._stream.output.write("%s %s %s\n" % (self._id, key, value))
+        self._stream.write_attr(self._id, key, value)
+
+    def checkpoint(self):
+        self._stream.checkpoint()
+
+    def flush(self):
+        self._stream.flush()
+
+
+# The events that read_log_events() yields, as tuples:
+#   (NODE_ADDED, parent ID, tag name, node ID)
+#   (ATTR_SET, node ID, key, value)
+#   (END_OF_LOG,)
+# The names are those of the LogEventHandler methods they call.
+NODE_ADDED = "node_added"
+ATTR_SET = "attr_set"
+END_OF_LOG = "end_of_log"
+
+
+def read_log_events(fh):
+    """Yields the events of a log in either format as it is read,
+    without keeping anything, so that code that only needs a few
+    fields does not have to build the whole tree."""
+    for node_id, attr, arg in read_log_records(fh):
+        if attr == "add":
+            tag_name, new_id = arg.split(" ", 1)
+            yield (NODE_ADDED, node_id, tag_name, new_id)
+        else:
+            yield (ATTR_SET, node_id, attr, arg)
+    yield (END_OF_LOG,)
 
 
-class StreamReader(object):
+class LogEventHandler(object):
+
+    """Receives the events of a log from process_log_events()."""
+
+    def node_added(self, parent_id, tag_name, node_id):
+        pass
+
+    def attr_set(self, node_id, key, value):
+        pass
+
+    def end_of_log(self):
+        pass
+
+
+def process_log_events(fh, handler):
+    for event in read_log_events(fh):
+        getattr(handler, event[0])(*event[1:])
+
+
+class StreamReader(LogEventHandler):
 
     def __init__(self):
         import lxml.etree as etree
@@ -77,82 +433,479 @@ class StreamReader(object):
         self._map = {"root": self._root_node}
 
     def process_line(self, line):
-        import lxml.etree as etree
         node_id, attr, arg = line.split(" ", 2)
-        node = self._map[node_id]
         if attr == "add":
             tag_name, new_node_id = arg.split(" ", 1)
-            new_node = etree.Element(tag_name)
-            assert arg not in self._map
-            self._map[new_node_id] = new_node
-            node.append(new_node)
+            self.node_added(node_id, tag_name, new_node_id)
         else:
-            node.attrib[attr] = arg
+            self.attr_set(node_id, attr, arg)
+
+    def node_added(self, parent_id, tag_name, node_id):
+        import lxml.etree as etree
+        assert node_id not in self._map
+        new_node = etree.SubElement(self._map[parent_id], tag_name)
+        self._map[node_id] = new_node
+
+    def attr_set(self, node_id, key, value):
+        self._map[node_id].attrib[key] = value
 
     def process_file(self, fh):
-        for line in fh:
-            self.process_line(line.rstrip("\n"))
+        # The file may be in either format.
+        process_log_events(fh, self)
 
     def get_root(self):
         return self._root_node
 
 
+class SummaryTreeBuilder(StreamReader):
+
+    """Builds only the part of a log's tree that
+    format_short_summary() shows: the top-level logs, and the logs
+    below them that failed or have not finished, with their files.
+    Other logs are dropped as they finish, so the memory used depends
+    on the number of failures rather than on the size of the log."""
+
+    def node_added(self, parent_id, tag_name, node_id):
+        if parent_id in self._map and tag_name in ("log", "file"):
+            StreamReader.node_added(self, parent_id, tag_name, node_id)
+
+    def attr_set(self, node_id, key, value):
+        node = self._map.get(node_id)
+        if node is None:
+            return
+        node.attrib[key] = value
+        if node.tag == "file":
+            # Nothing else is set on files.
+            del self._map[node_id]
+        elif key == "result":
+            parent = node.getparent()
+            # Logs finish after the logs inside them, so any that are
+            # left have failed.
+            if (int(value) == 0 and parent is not self._root_node and
+                node.find("log") is None):
+                parent.remove(node)
+                del self._map[node_id]
+
+
 def get_xml_from_log(input_file):
     reader = StreamReader()
     reader.process_file(input_file)
     return reader.get_root()
 
 
+class RunStateWriter(object):
+
+    """Appends the result of each leaf action to a LogDir's state file
+    as it finishes, so that a later run can resume from it.  Also
+    used for the file recording how long each leaf took."""
+
+    def __init__(self, fh):
+        self._fh = fh
+        self._lock = threading.Lock()
+
+    def record(self, key, result):
+        assert "\n" not in key
+        self._lock.acquire()
+        try:
+            self._fh.write("%s %s\n" % (result, key))
+            self._fh.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._fh.close()
+
+
+class _SummaryLog(object):
+
+    def __init__(self, parent, name):
+        self.parent = parent
+        self.name = name
+        self.result = None
+        self.start_time = None
+        self.end_time = None
+        self.files = []
+        self.contains_failure = False
+
+
+class RunSummaryWriter(object):
+
+    """Collects what the summary file needs as a run's logs are
+    written, and writes it when the root log finishes.  Logs that
+    succeed, contain no failures and are not top-level are forgotten
+    as they finish, so that this stays small."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._logs = {0: _SummaryLog(None, None)}
+        self._next_id = 1
+        self._other_files = []
+        self._failed = []
+
+    def add_log(self, parent_id, name):
+        self._lock.acquire()
+        try:
+            log_id = self._next_id
+            self._next_id += 1
+            self._logs[log_id] = _SummaryLog(parent_id, name)
+            return log_id
+        finally:
+            self._lock.release()
+
+    def start(self, log_id, start_time):
+        self._logs[log_id].start_time = start_time
+
+    def add_file(self, log_id, filename):
+        self._lock.acquire()
+        try:
+            self._logs[log_id].files.append(filename)
+        finally:
+            self._lock.release()
+
+    def get_path(self, log_id):
+        names = []
+        while log_id in self._logs and log_id != 0:
+            log = self._logs[log_id]
+            names.append(log.name)
+            log_id = log.parent
+        return ".".join(reversed(names))
+
+    def finish(self, log_id, result, end_time):
+        self._lock.acquire()
+        try:
+            log = self._logs[log_id]
+            log.result = result
+            log.end_time = end_time
+            if result != 0 and log_id != 0:
+                self._failed.append(self.get_path(log_id))
+                parent_id = log_id
+                # An ancestor is only missing if it finished first.
+                while parent_id in self._logs:
+                    self._logs[parent_id].contains_failure = True
+                    parent_id = self._logs[parent_id].parent
+            # Logs finish after the logs inside them.
+            if not log.contains_failure and log.parent not in (0, None):
+                del self._logs[log_id]
+                self._other_files.extend(log.files)
+            if log_id == 0:
+                self._write()
+        finally:
+            self._lock.release()
+
+    def _write(self):
+        dir_path = os.path.dirname(self._filename)
+
+        def get_size(filename):
+            try:
+                return os.stat(os.path.join(dir_path, filename)).st_size
+            except OSError:
+                return 0
+
+        def format_value(value):
+            if value is None:
+                return "-"
+            return str(value)
+
+        root = self._logs[0]
+        lines = ["result %s\n" % format_value(root.result),
+                 "start_time %s\n" % format_value(root.start_time),
+                 "end_time %s\n" % format_value(root.end_time)]
+        lines.extend("failed %s\n" % path for path in self._failed)
+        other_files = list(self._other_files)
+        for log_id, log in sorted(self._logs.iteritems()):
+            if log_id != 0 and not (log.parent == 0 or log.contains_failure):
+                other_files.extend(log.files)
+                continue
+            if log_id != 0:
+                lines.append("log %i %i %s %s %s %s\n" % (
+                        log_id, log.parent, format_value(log.result),
+                        format_value(log.start_time),
+                        format_value(log.end_time), log.name))
+            for filename in log.files:
+                lines.append("file %i %i %s\n"
+                             % (log_id, get_size(filename), filename))
+        for filename in other_files:
+            lines.append("file - %i %s\n" % (get_size(filename), filename))
+        temp_filename = self._filename + ".tmp"
+        fh = open(temp_filename, "w")
+        try:
+            fh.writelines(lines)
+        finally:
+            fh.close()
+        os.rename(temp_filename, self._filename)
+
+
+class RunSummary(object):
+
+    """A run's summary file, written when its root log finished:
+
+      result <result>
+      start_time <time>
+      end_time <time>
+      failed <dotted path of a log that failed>
+      log <ID> <parent ID> <result> <start time> <end time> <name>
+      file <log ID> <size> <filename>
+
+    There is a log line for each top-level log, each log that failed,
+    and each log containing one, which is all that
+    format_short_summary() needs.  The root log has ID 0.  Every file
+    has a file line, but the log ID is "-" for files of logs that have
+    no log line.  Values that are not known are "-".
+    """
+
+    def __init__(self, fh):
+        self.result = None
+        self.start_time = None
+        self.end_time = None
+        self.failed = []
+        self.logs = []
+        self.files = []
+        for line in fh:
+            kind, sep, rest = line.rstrip("\n").partition(" ")
+            if kind == "failed":
+                self.failed.append(rest)
+            elif kind == "log":
+                self.logs.append(rest.split(" ", 5))
+            elif kind == "file":
+                self.files.append(rest.split(" ", 2))
+            elif kind in ("result", "start_time", "end_time"):
+                setattr(self, kind, rest)
+            # Other kinds, e.g. from later versions, are ignored.
+
+    def has_failed(self):
+        return (len(self.failed) > 0 or
+                self.result not in ("-", None) and int(self.result) != 0)
+
+    def get_xml(self):
+        # Returns the tree that SummaryTreeBuilder would give.
+        import lxml.etree as etree
+
+        def set_attrs(node, attrs):
+            for key, value in attrs:
+                if value != "-":
+                    node.attrib[key] = value
+
+        root = etree.Element("root")
+        set_attrs(root, [("start_time", self.start_time),
+                         ("end_time", self.end_time),
+                         ("result", self.result)])
+        nodes = {"0": root}
+        for log_id, parent_id, result, start_time, end_time, name \
+                in self.logs:
+            node = etree.SubElement(nodes[parent_id], "log")
+            set_attrs(node, [("name", name), ("start_time", start_time),
+                             ("end_time", end_time), ("result", result)])
+            nodes[log_id] = node
+        for log_id, size, filename in self.files:
+            if log_id in nodes:
+                etree.SubElement(nodes[log_id], "file").attrib["filename"] = \
+                    filename
+        return root
+
+
 class LogDir(object):
 
-    def __init__(self, dir_path, get_time=time.time):
+    def __init__(self, dir_path, get_time=time.time, log_set=None):
         self._dir_path = dir_path
         self._get_time = get_time
+        self._log_set = log_set
         self._counter = 0
+        self._counter_lock = threading.Lock()
         self._log_file = os.path.join(self._dir_path, "0000-log")
+        self._state_file = os.path.join(self._dir_path, "0000-state")
+        self._durations_file = os.path.join(self._dir_path, "0000-durations")
+        self._summary_file = os.path.join(self._dir_path, "0000-summary")
 
     def make_filename(self, name):
-        self._counter += 1
-        basename = "%04i-%s" % (self._counter, name)
+        self._counter_lock.acquire()
+        try:
+            self._counter += 1
+            counter = self._counter
+        finally:
+            self._counter_lock.release()
+        basename = "%04i-%s" % (counter, name)
         return basename, os.path.join(self._dir_path, basename)
 
-    def make_logger(self):
+    def make_logger(self, flush_policy=FLUSH_ALWAYS, fsync=False,
+                    binary=False):
         assert not os.path.exists(self._log_file)
-        stream = NodeStream(open(self._log_file, "w", buffering=0))
+        if binary:
+            stream_class = BinaryNodeStream
+        else:
+            stream_class = NodeStream
+        # NodeStream does the buffering.
+        stream = stream_class(open(self._log_file, "wb", buffering=0),
+                              flush_policy, fsync=fsync,
+                              get_time=self._get_time)
         log = LogWriter(NodeWriter(stream, "root"),
-                        self, "root", self._get_time)
+                        self, "root", self._get_time,
+                        RunSummaryWriter(self._summary_file))
         log.start()
         return log
 
+    def get_run_summary(self):
+        # Returns None if the run's root log did not finish, or it
+        # was written before there were summaries.
+        if not os.path.exists(self._summary_file):
+            return None
+        fh = open(self._summary_file, "r")
+        try:
+            return RunSummary(fh)
+        finally:
+            fh.close()
+
     def get_xml(self):
-        log = get_xml_from_log(open(self._log_file, "r"))
+        return self._read_xml(StreamReader())
+
+    def get_summary_xml(self):
+        # Enough of the tree for format_short_summary().
+        summary = self.get_run_summary()
+        if summary is not None:
+            return self._add_pathnames(summary.get_xml())
+        return self._read_xml(SummaryTreeBuilder())
+
+    def _read_xml(self, reader):
+        fh = open(self._log_file, "rb")
+        try:
+            reader.process_file(fh)
+        finally:
+            fh.close()
+        return self._add_pathnames(reader.get_root())
+
+    def _add_pathnames(self, log):
         for file_node in log.xpath(".//file"):
             file_node.attrib["pathname"] = \
                 os.path.join(self._dir_path, file_node.attrib["filename"])
         return log
 
+    def has_failed(self):
+        summary = self.get_run_summary()
+        if summary is not None:
+            return summary.has_failed()
+        fh = open(self._log_file, "rb")
+        try:
+            return log_has_failed(fh)
+        finally:
+            fh.close()
+
     def get_timestamp(self):
         return os.stat(self._log_file).st_mtime
 
+    def is_finished(self):
+        # The summary is written after the root log's last record.
+        return os.path.exists(self._summary_file)
+
+    def get_log_stamp(self):
+        # Changes whenever the log file is written to.
+        stat = os.stat(self._log_file)
+        return "%i %r" % (stat.st_size, stat.st_mtime)
+
+    def finish_run(self):
+        # Called when the run's root log finishes, after its summary
+        # has been written.
+        if self._log_set is not None:
+            self._log_set.finish_run(self)
+
+    def make_state_writer(self):
+        return RunStateWriter(open(self._state_file, "a"))
+
+    def make_duration_writer(self):
+        return RunStateWriter(open(self._durations_file, "a"))
+
+    def _read_values(self, filename):
+        # Returns the last value recorded for each key.
+        values = {}
+        if os.path.exists(filename):
+            fh = open(filename, "r")
+            try:
+                for line in fh:
+                    value, sep, key = line.rstrip("\n").partition(" ")
+                    values[key] = value
+            finally:
+                fh.close()
+        return values
+
+    def get_finished_actions(self):
+        # Returns the dotted names of the leaf actions whose last
+        # recorded result is success.
+        return set(key for key, result
+                   in self._read_values(self._state_file).iteritems()
+                   if result == "0")
+
+    def get_durations(self):
+        # Returns the time in seconds that each leaf action that
+        # succeeded took.
+        return dict((key, float(value)) for key, value
+                    in self._read_values(self._durations_file).iteritems())
+
+    def get_previous_runs(self):
+        # Yields the runs before this one in its LogSetDir, most
+        # recent first.
+        if self._log_set is None:
+            return
+        dir_path = os.path.realpath(self._dir_path)
+        found_self = False
+        for log in self._log_set.get_logs():
+            if os.path.realpath(log._dir_path) == dir_path:
+                found_self = True
+            elif found_self:
+                yield log
+
+    def get_previous(self):
+        # Returns the run before this one in its LogSetDir, if known.
+        for log in self.get_previous_runs():
+            return log
+        return None
+
+    def get_past_durations(self, max_runs=10):
+        # Returns the most recent duration recorded for each leaf
+        # action in up to max_runs previous runs.
+        durations = {}
+        for log in itertools.islice(self.get_previous_runs(), max_runs):
+            for key, duration in log.get_durations().iteritems():
+                durations.setdefault(key, duration)
+        return durations
+
 
 class LogWriter(object):
 
-    def __init__(self, node, log_dir, name, get_time):
+    # summary is a RunSummaryWriter, shared by the logs of a run, and
+    # summary_id identifies this log in it.  It is written when the
+    # root log (ID 0) finishes.
+    def __init__(self, node, log_dir, name, get_time, summary=None,
+                 summary_id=0):
         self._node = node
         self._log_dir = log_dir
         self._name = name
         self._get_time = get_time
-
-    def start(self):
-        self._node.add_attr("start_time", str(self._get_time()))
+        self._summary = summary
+        self._summary_id = summary_id
+
+    # repr() rather than str() because str() rounds the time to 10ms.
+    # Times are given when replaying logs recorded elsewhere.
+    def start(self, start_time=None):
+        if start_time is None:
+            start_time = self._get_time()
+        start_time = repr(start_time)
+        self._node.add_attr("start_time", start_time)
+        if self._summary is not None:
+            self._summary.start(self._summary_id, start_time)
+
+    def get_log_dir(self):
+        return self._log_dir
 
     def message(self, message):
         self._node.new_child("message", [("text", message)])
 
     def child_log(self, name, do_start=True):
+        summary_id = None
+        if self._summary is not None:
+            summary_id = self._summary.add_log(self._summary_id, name)
         sublog = LogWriter(self._node.new_child("log", [("name", name)],
                                                 id_name=name),
-                           self._log_dir, name, self._get_time)
+                           self._log_dir, name, self._get_time,
+                           self._summary, summary_id)
         if do_start:
             sublog.start()
         return sublog
@@ -160,12 +913,26 @@ class LogWriter(object):
     def make_file(self):
         relative_name, filename = self._log_dir.make_filename(self._name)
         self._node.new_child("file", [("filename", relative_name)])
+        if self._summary is not None:
+            self._summary.add_file(self._summary_id, relative_name)
         assert not os.path.exists(filename)
         return open(filename, "w")
 
-    def finish(self, result):
-        self._node.add_attr("end_time", str(self._get_time()))
+    def finish(self, result, end_time=None):
+        if end_time is None:
+            end_time = self._get_time()
+        end_time = repr(end_time)
+        self._node.add_attr("end_time", end_time)
         self._node.add_attr("result", str(result))
+        self._node.checkpoint()
+        if self._summary is not None:
+            self._summary.finish(self._summary_id, result, end_time)
+            if self._summary_id == 0:
+                self._log_dir.finish_run()
+
+    def flush(self):
+        # Writes out any records that are buffered.
+        self._node.flush()
 
 
 class Ansi16Color(object):
@@ -208,11 +975,14 @@ class PrintTitlesLogWriter(object):
             stand_out_text = lambda text: text
         self._stand_out_text = stand_out_text
 
-    def start(self):
+    def start(self, start_time=None):
         title = " > ".join([self._stand_out_text(name) for name in self._path])
         self._stream.write(title)
         self._stream.write("\n")
-        self._delegate.start()
+        self._delegate.start(start_time)
+
+    def get_log_dir(self):
+        return self._delegate.get_log_dir()
 
     def message(self, message):
         self._delegate.message(message)
@@ -225,15 +995,21 @@ class PrintTitlesLogWriter(object):
     def make_file(self):
         return self._delegate.make_file()
 
-    def finish(self, result):
-        self._delegate.finish(result)
+    def finish(self, result, end_time=None):
+        self._delegate.finish(result, end_time)
+
+    def flush(self):
+        self._delegate.flush()
 
 
 class DummyLogWriter(object):
 
-    def start(self):
+    def start(self, start_time=None):
         pass
 
+    def get_log_dir(self):
+        return None
+
     def message(self, message):
         pass
 
@@ -243,18 +1019,105 @@ class DummyLogWriter(object):
     def make_file(self):
         return open("/dev/null", "w")
 
-    def finish(self, result):
+    def finish(self, result, end_time=None):
         pass
 
+    def flush(self):
+        pass
+
+
+class LogRecorder(object):
+
+    """Log writer that records the calls made on it, and on its child
+    logs, as a list of picklable tuples so that they can be replayed
+    onto another log writer with replay_log(), e.g. after running an
+    action in another process.  Logs are given the start and end
+    times at which they were recorded, unless other times are passed
+    to start() and finish().
+    """
+
+    def __init__(self, records=None, log_id=0, get_time=time.time):
+        if records is None:
+            records = []
+        self._records = records
+        self._id = log_id
+        self._get_time = get_time
+
+    def start(self, start_time=None):
+        if start_time is None:
+            start_time = self._get_time()
+        self._records.append((self._id, "start", start_time))
+
+    def get_log_dir(self):
+        return None
+
+    def message(self, message):
+        self._records.append((self._id, "message", message))
+
+    def child_log(self, name, do_start=True):
+        self._records.append((self._id, "child_log", name, False))
+        child = LogRecorder(self._records, len(self._records),
+                            self._get_time)
+        if do_start:
+            child.start()
+        return child
+
+    def make_file(self):
+        # The file is copied into the real log when replayed.
+        fd, filename = tempfile.mkstemp(prefix="log-recorder-")
+        self._records.append((self._id, "make_file", filename))
+        return os.fdopen(fd, "w")
+
+    def finish(self, result, end_time=None):
+        if end_time is None:
+            end_time = self._get_time()
+        self._records.append((self._id, "finish", result, end_time))
+
+    def flush(self):
+        # The records are only kept in memory until they are replayed.
+        pass
+
+    def get_records(self):
+        return self._records
+
+
+def replay_log(records, log):
+    # A child log's ID is the 1-based index of the record creating it.
+    logs = {0: log}
+    for index, record in enumerate(records):
+        log_id, method, args = record[0], record[1], record[2:]
+        target = logs[log_id]
+        if method == "child_log":
+            logs[index + 1] = target.child_log(*args)
+        elif method == "make_file":
+            [filename] = args
+            src = open(filename, "r")
+            dest = target.make_file()
+            try:
+                shutil.copyfileobj(src, dest)
+            finally:
+                src.close()
+                dest.close()
+            os.unlink(filename)
+        else:
+            getattr(target, method)(*args)
+
 
 class LogSetDir(object):
 
+    """A directory of runs' LogDirs, in YYYY/MM/DD/NNNN subdirectories.
+    The runs are listed in a catalog (see log_catalog), when sqlite3
+    is available, rather than by walking the directory tree."""
+
     def __init__(self, dir_path, get_time=time.time):
         self._dir = dir_path
         self._get_time = get_time
+        self._catalog_file = os.path.join(dir_path, "catalog.sqlite")
 
-    def make_logger(self):
-        time_now = time.gmtime(self._get_time())
+    def make_logger(self, flush_policy=FLUSH_ALWAYS, fsync=False,
+                    binary=False):
+        start_time = self._get_time()
+        time_now = time.gmtime(start_time)
         subdir_base = time.strftime("%Y/%m/%d", time_now)
         i = 0
         while True:
@@ -263,7 +1126,89 @@ class LogSetDir(object):
                 break
             i += 1
         os.makedirs(log_dir)
-        return LogDir(log_dir, self._get_time).make_logger()
+        log = LogDir(log_dir, self._get_time, self).make_logger(
+            flush_policy, fsync, binary)
+        # Only once the log file exists, or get_logs() in another
+        # process could take the run for a deleted one.
+        catalog = self._get_catalog()
+        if catalog is not None:
+            catalog.add_run(self._get_path(log_dir), start_time=start_time)
+        return log
+
+    def _get_path(self, log_dir):
+        return os.path.relpath(log_dir, self._dir)
+
+    def _get_catalog(self):
+        # Returns None if there is no catalog to use, including when it
+        # is missing and cannot be built, e.g. because the directory
+        # is read-only.
+        if log_catalog is None or not os.path.exists(self._dir):
+            return None
+        if not os.path.exists(self._catalog_file):
+            # Build it under another name so that other processes do
+            # not see it half-built.
+            try:
+                fd, temp_file = tempfile.mkstemp(dir=self._dir,
+                                                 prefix="catalog.sqlite.tmp")
+            except (OSError, IOError):
+                return None
+            os.close(fd)
+            try:
+                self._update_catalog(log_catalog.LogCatalog(temp_file))
+                os.rename(temp_file, self._catalog_file)
+            except:
+                os.unlink(temp_file)
+                raise
+        try:
+            return log_catalog.LogCatalog(self._catalog_file)
+        except log_catalog.Error:
+            return None
+
+    def _update_catalog(self, catalog):
+        paths = set(catalog.get_paths())
+        found = set()
+        for log in self._get_logs(self._dir):
+            path = self._get_path(log._dir_path)
+            found.add(path)
+            if path not in paths:
+                self._add_run(catalog, log)
+        catalog.remove_runs(sorted(paths - found))
+
+    def update_catalog(self):
+        """Brings the catalog up to date with runs that were added to
+        or removed from the directory by other means."""
+        catalog = self._get_catalog()
+        if catalog is not None:
+            self._update_catalog(catalog)
+
+    def _add_run(self, catalog, log):
+        summary = log.get_run_summary()
+        if summary is None:
+            # The run has not finished, or it was written before there
+            # were summaries.  It has no known start time, so go by
+            # when it was last written.
+            catalog.add_run(self._get_path(log._dir_path),
+                            end_time=log.get_timestamp(),
+                            durations=log.get_durations())
+            return
+
+        def get_value(value, convert):
+            if value in ("-", None):
+                return None
+            return convert(value)
+
+        catalog.add_run(self._get_path(log._dir_path),
+                        start_time=get_value(summary.start_time, float),
+                        end_time=get_value(summary.end_time, float),
+                        result=get_value(summary.result, int),
+                        failed=int(summary.has_failed()),
+                        durations=log.get_durations())
+
+    def finish_run(self, log):
+        # Called when the root log of a run in this LogSetDir finishes.
+        catalog = self._get_catalog()
+        if catalog is not None:
+            self._add_run(catalog, log)
 
     def _sorted_leafnames(self, dir_path):
         # For compatibility with existing log dirs, sort by number not
@@ -281,15 +1226,69 @@ class LogSetDir(object):
 
     def _get_logs(self, dir_path):
         if os.path.exists(os.path.join(dir_path, "0000-log")):
-            yield LogDir(dir_path, self._get_time)
+            yield LogDir(dir_path, self._get_time, self)
         else:
             if os.path.exists(dir_path):
                 for leafname in self._sorted_leafnames(dir_path):
                     for log in self._get_logs(os.path.join(dir_path, leafname)):
                         yield log
 
+    def _get_log_dirs(self, catalog, paths):
+        # Skips runs that were deleted by other means after they were
+        # cataloged, and drops them from the catalog if it can.
+        for path in paths:
+            log = LogDir(os.path.join(self._dir, path), self._get_time, self)
+            if os.path.exists(log._log_file):
+                yield log
+            else:
+                try:
+                    catalog.remove_runs([path])
+                except log_catalog.Error:
+                    pass
+
     def get_logs(self):
-        return self._get_logs(self._dir)
+        # Yields the runs, most recent first.
+        catalog = self._get_catalog()
+        if catalog is None:
+            return self._get_logs(self._dir)
+        return self._get_log_dirs(catalog, catalog.get_paths())
+
+    def find_runs(self, failed=None, since=None, limit=None):
+        """Returns LogDirs for the runs that failed (or, if failed is
+        False, succeeded) and that started at or after the time since,
+        most recent first, up to limit of them."""
+        catalog = self._get_catalog()
+        if catalog is None:
+            logs = self.get_logs()
+            if failed is not None:
+                logs = (log for log in logs
+                        if log.get_run_summary() is not None and
+                        log.has_failed() == failed)
+            if since is not None:
+                logs = (log for log in logs if log.get_timestamp() >= since)
+            return list(itertools.islice(logs, limit))
+        # Not limited in the query, in case some of the runs are gone.
+        return list(itertools.islice(
+                self._get_log_dirs(
+                    catalog, catalog.get_paths(failed=failed, since=since)),
+                limit))
+
+    def get_action_durations(self, action, limit=None):
+        # Returns (LogDir, duration) pairs for the runs in which the
+        # leaf action with the dotted name action succeeded, most
+        # recent first.
+        catalog = self._get_catalog()
+        if catalog is None:
+            got = ((log, log.get_durations().get(action))
+                   for log in self.get_logs())
+            return list(itertools.islice(
+                    ((log, duration) for log, duration in got
+                     if duration is not None), limit))
+        rows = catalog.get_action_durations(action)
+        durations = dict(rows)
+        logs = self._get_log_dirs(catalog, [path for path, duration in rows])
+        return [(log, durations[self._get_path(log._dir_path)])
+                for log in itertools.islice(logs, limit)]
 
 
 class NullPathnameMapper(object):
@@ -423,14 +1422,144 @@ def write_xml_file(filename, xml):
         fh.close()
 
 
-def format_logs(targets, path_mapper, dest_filename):
+def _dump_html(html):
+    # Gives text that _load_html() turns back into HTML that is
+    # serialized the same.  Parsing alone would turn elements with
+    # empty text, e.g. <td></td>, into empty elements, <td/>, so their
+    # positions are listed on the first line.  There is no whitespace,
+    # so that the HTML is pretty-printed the same as freshly rendered
+    # HTML when it is spliced in.
+    import lxml.etree as etree
+    empty = [str(index) for index, element in enumerate(html.iter())
+             if element.text == ""]
+    return " ".join(empty) + "\n" + etree.tostring(html, with_tail=False)
+
+
+def _load_html(text):
+    import lxml.etree as etree
+    empty, newline, xml = text.partition("\n")
+    html = etree.fromstring(xml)
+    elements = list(html.iter())
+    for index in empty.split():
+        elements[int(index)].text = ""
+    return html
+
+
+class FragmentCache(object):
+
+    """Caches the HTML rendered for runs in a directory, so that
+    formatting a log set again only renders the runs that have changed.
+    A fragment is used until the size or mtime of its run's log file
+    changes, or, for a run that has not finished, until one of its
+    files stops being empty.  If the directory cannot be written to,
+    nothing is cached."""
+
+    def __init__(self, dir_path):
+        self._dir = dir_path
+
+    def _get_stamp(self, log):
+        stamp = log.get_log_stamp()
+        if not log.is_finished():
+            # The HTML links to the run's files that are not empty,
+            # and a run that is still going may write to them without
+            # writing to its log.
+            empty = sorted(
+                leafname for leafname in os.listdir(log._dir_path)
+                if os.path.getsize(os.path.join(log._dir_path,
+                                                leafname)) == 0)
+            stamp += " " + repr(empty)
+        return stamp
+
+    def _get_filename(self, log, kind, path_mapper):
+        # The path mapper determines the links to the run's files.
+        key = "\0".join(
+            [kind, os.path.realpath(log._dir_path),
+             path_mapper.map_pathname(os.path.join(log._dir_path, ""))])
+        return os.path.join(self._dir, hashlib.sha1(key).hexdigest())
+
+    def get_html(self, log, kind, path_mapper, render):
+        # render(log) is called to produce the HTML if there is no
+        # usable fragment.  kind distinguishes the renderings.
+        stamp = self._get_stamp(log) + "\n"
+        filename = self._get_filename(log, kind, path_mapper)
+        if os.path.exists(filename):
+            fh = open(filename, "r")
+            try:
+                if fh.readline() == stamp:
+                    return _load_html(fh.read())
+            finally:
+                fh.close()
+        html = render(log)
+        try:
+            if not os.path.exists(self._dir):
+                os.makedirs(self._dir)
+            fd, temp_file = tempfile.mkstemp(dir=self._dir, prefix="tmp-")
+        except (OSError, IOError):
+            return html
+        fh = os.fdopen(fd, "w")
+        try:
+            fh.write(stamp)
+            fh.write(_dump_html(html))
+        finally:
+            fh.close()
+        os.rename(temp_file, filename)
+        return html
+
+
+def render_long(log, path_mapper, cache=None):
+    def render(log):
+        return format_top_log(log.get_xml(), path_mapper)
+
+    if cache is None:
+        return render(log)
+    return cache.get_html(log, "long", path_mapper, render)
+
+
+def render_short(log, path_mapper, cache=None):
+    def render(log):
+        return format_short_summary(log.get_summary_xml(), path_mapper)
+
+    if cache is None:
+        return render(log)
+    return cache.get_html(log, "short", path_mapper, render)
+
+
+def _render_in_worker(args):
+    # LogDirs are not picklable, so they are passed by pathname, and
+    # lxml elements are not either, so the HTML is passed back as text.
+    render, dir_path, path_mapper, cache = args
+    return _dump_html(render(LogDir(dir_path), path_mapper, cache))
+
+
+def render_logs(logs, render, path_mapper, cache=None, jobs=1):
+    """Returns the HTML that render (render_long or render_short) gives
+    for each of logs, in order, formatting them in jobs processes."""
+    if jobs <= 1:
+        return [render(log, path_mapper, cache) for log in logs]
+    work = [(render, log._dir_path, path_mapper, cache) for log in logs]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Giving a timeout lets KeyboardInterrupt through.
+        texts = pool.map_async(_render_in_worker, work,
+                               len(work) / (jobs * 4) + 1).get(1e9)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return [_load_html(text) for text in texts]
+
+
+def format_logs(targets, path_mapper, dest_filename, cache=None, jobs=1):
     headings = tag("tr", *[tag("th", target.get_name())
                            for target in targets])
     columns = tag("tr")
     for target in targets:
         column = tag("td")
-        for log in target.get_logs():
-            column.append(format_top_log(log.get_xml(), path_mapper))
+        column.extend(render_logs(target.get_logs(), render_long,
+                                  path_mapper, cache, jobs))
         columns.append(column)
     html = wrap_body(tagp("table", [("class", "summary")],
                           headings, columns))
@@ -456,21 +1585,19 @@ def format_short_summary(log, path_mapper):
     return table
 
 
-def for_some(iterator):
-    for x in iterator:
-        if x:
+def log_has_failed(fh):
+    # Only logs are given results, so there is no need to track which
+    # nodes are logs.  This stops reading at the first failure.
+    for event in read_log_events(fh):
+        if (event[0] == ATTR_SET and event[2] == "result" and
+            int(event[3]) != 0):
             return True
     return False
 
 
-def log_has_failed(log):
-    return (int(log.attrib.get("result", 0)) != 0 or
-            for_some(log_has_failed(sublog) for sublog in log.xpath("log")))
-
-
 def warn_failures(logs, stamp_time):
     for log in logs:
-        if log_has_failed(log.get_xml()):
+        if log.has_failed():
             if log.get_timestamp() > stamp_time:
                 print("failed")
                 subprocess.call("beep -l 10 -f 1000", shell=True)
@@ -50,6 +50,96 @@ class NodeStreamTest(unittest.TestCase):
 """)
 
 
+    def test_flush_policies(self):
+        class Output(object):
+            def __init__(self):
+                self.writes = []
+            def write(self, data):
+                self.writes.append(data)
+
+        def run(flush_policy, get_time=None):
+            output = Output()
+            log_dir = build_log.LogDir(self.make_temp_dir())
+            stream = build_log.NodeStream(output, flush_policy,
+                                          get_time=get_time or (lambda: 0))
+            log = build_log.LogWriter(build_log.NodeWriter(stream, "root"),
+                                      log_dir, "root", lambda: 0)
+            sublog = log.child_log("child")
+            sublog.message("hello")
+            sublog.finish(0)
+            log.message("not finished")
+            return output.writes, log
+
+        writes, log = run(build_log.FLUSH_ALWAYS)
+        self.assertEquals(len(writes), 9)
+        writes, log = run(build_log.FLUSH_ON_FINISH)
+        # Everything up to the finish is written at once.
+        self.assertEquals(len(writes), 1)
+        self.assertEquals(writes[0].splitlines()[-1], "child result 0")
+        log.flush()
+        self.assertEquals(len(writes), 2)
+        # The clock moves on twice, by more than the interval.
+        times = iter([0, 0, 0, 0, 5, 5])
+        writes, log = run(build_log.FLUSH_INTERVAL, lambda: next(times, 10))
+        self.assertEquals(len(writes), 2)
+        writes, log = run(build_log.FLUSH_EXPLICIT)
+        self.assertEquals(writes, [])
+        log.flush()
+        self.assertEquals(len("".join(writes).splitlines()), 9)
+
+    def test_binary_format(self):
+        stream = StringIO.StringIO()
+        node = build_log.NodeWriter(build_log.NodeStream(stream), "root")
+        for i in range(300):
+            child = node.new_child("log", [("name", "step%i" % (i % 7))],
+                                   id_name="step%i" % (i % 7))
+            child.add_attr("text", "x" * i)
+        # IDs that only look like they have a numeric suffix.
+        for name in ["a_0", "a_01", "a_", "_2"]:
+            node.new_child("log", id_name=name)
+        text = stream.getvalue()
+        binary = StringIO.StringIO()
+        build_log.convert_log(StringIO.StringIO(text), binary, True)
+        assert len(binary.getvalue()) < len(text)
+        text2 = StringIO.StringIO()
+        build_log.convert_log(StringIO.StringIO(binary.getvalue()), text2,
+                              False)
+        self.assertEquals(text2.getvalue(), text)
+        # Records split across chunks are read correctly.
+        self.assertEquals(
+            list(build_log.read_log_records(
+                    StringIO.StringIO(binary.getvalue()), chunk_size=5)),
+            [tuple(line.split(" ", 2)) for line in text.splitlines()])
+        self.assertEquals(
+            etree.tostring(build_log.get_xml_from_log(
+                    StringIO.StringIO(binary.getvalue()))),
+            etree.tostring(build_log.get_xml_from_log(
+                    StringIO.StringIO(text))))
+        self.assertRaises(
+            ValueError,
+            lambda: list(build_log.read_log_records(
+                    StringIO.StringIO(binary.getvalue()[:-1]))))
+        self.assertRaises(
+            ValueError,
+            lambda: list(build_log.read_log_records(
+                    StringIO.StringIO("\0build_log binary 1\n"))))
+
+    def test_binary_log_dir(self):
+        log_dir = build_log.LogDir(self.make_temp_dir())
+        log = log_dir.make_logger(binary=True)
+        log.child_log("foo").finish(0)
+        log.finish(1)
+        xml = log_dir.get_xml()
+        self.assertEquals([(node.attrib["name"], node.attrib["result"])
+                           for node in xml.xpath("log")], [("foo", "0")])
+        self.assertEquals(xml.attrib["result"], "1")
+
+    def make_temp_dir(self):
+        temp_dir = tempfile.mkdtemp(prefix="tmp-NodeStreamTest-")
+        self.addCleanup(lambda: shutil.rmtree(temp_dir))
+        return temp_dir
+
+
 def write_file(filename, data):
     fh = open(filename, "w")
     try:
@@ -58,6 +148,14 @@ def write_file(filename, data):
         fh.close()
 
 
+def read_file(filename):
+    fh = open(filename, "r")
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+
 class TempDirTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -127,6 +225,206 @@ class LogSetDirTest(TempDirTestCase):
         self.assertEquals(xml.xpath(".//@start_time"),
                           ["0", "0", "1", "2", "3", "4"])
 
+    def test_run_state(self):
+        logset = build_log.LogSetDir(self.make_temp_dir())
+        log_dirs = []
+        for i in range(2):
+            log_dirs.append(logset.make_logger().get_log_dir())
+        self.assertEquals(log_dirs[1].get_previous()._dir_path,
+                          log_dirs[0]._dir_path)
+        self.assertEquals(log_dirs[0].get_previous(), None)
+        writer = log_dirs[0].make_state_writer()
+        writer.record("all.foo", 0)
+        writer.record("all.bar", 1)
+        writer.record("all.baz", 1)
+        writer.record("all.baz", 0)
+        writer.close()
+        self.assertEquals(log_dirs[0].get_finished_actions(),
+                          set(["all.foo", "all.baz"]))
+
+    def test_past_durations(self):
+        logset = build_log.LogSetDir(self.make_temp_dir())
+        log_dirs = []
+        for durations in ([("all.foo", 1.5), ("all.bar", 2)],
+                          [("all.foo", 3)],
+                          []):
+            log_dir = logset.make_logger().get_log_dir()
+            writer = log_dir.make_duration_writer()
+            for key, duration in durations:
+                writer.record(key, duration)
+            writer.close()
+            log_dirs.append(log_dir)
+        self.assertEquals(log_dirs[1].get_durations(), {"all.foo": 3})
+        self.assertEquals(log_dirs[2].get_past_durations(),
+                          {"all.foo": 3, "all.bar": 2})
+        self.assertEquals(log_dirs[2].get_past_durations(max_runs=1),
+                          {"all.foo": 3})
+
+    def test_catalog(self):
+        times = [100]
+        logs_dir = self.make_temp_dir()
+        logset = build_log.LogSetDir(logs_dir, get_time=lambda: times[0])
+        log_dirs = []
+        for result in (0, 1, 0, 1, None):
+            times[0] += 10
+            log = logset.make_logger()
+            writer = log.get_log_dir().make_duration_writer()
+            writer.record("all.foo", times[0])
+            writer.close()
+            if result is not None:
+                log.finish(result)
+            log_dirs.append(log.get_log_dir()._dir_path)
+
+        def get_runs(**kwargs):
+            return [run._dir_path for run in logset.find_runs(**kwargs)]
+
+        def check():
+            self.assertEquals([run._dir_path for run in logset.get_logs()],
+                              log_dirs[::-1])
+            # The last run has not finished, and the first may have
+            # been removed.
+            self.assertEquals(get_runs(failed=True),
+                              [log_dirs[-2], log_dirs[-4]])
+            self.assertEquals(get_runs(failed=False, limit=1),
+                              [log_dirs[-3]])
+            self.assertEquals(get_runs(since=130, failed=True),
+                              [log_dirs[-2]])
+
+        check()
+        self.assertEquals(
+            [(run._dir_path, duration) for run, duration
+             in logset.get_action_durations("all.foo", limit=2)],
+            [(log_dirs[3], 140), (log_dirs[2], 130)])
+        # A missing catalog is rebuilt from the directory tree.
+        os.unlink(os.path.join(logs_dir, "catalog.sqlite"))
+        check()
+        shutil.rmtree(log_dirs.pop(0))
+        logset.update_catalog()
+        check()
+        # Runs deleted without updating the catalog are skipped, and
+        # dropped from the catalog.
+        shutil.rmtree(log_dirs.pop(-2))
+        self.assertEquals([run._dir_path for run in logset.get_logs()],
+                          log_dirs[::-1])
+        self.assertEquals(get_runs(failed=True, limit=1), [log_dirs[0]])
+        self.assertEquals(len(logset._get_catalog().get_paths()),
+                          len(log_dirs))
+
+
+class LogEventsTest(TempDirTestCase):
+
+    def make_log(self, failing_leaf, finish=False):
+        log_dir = build_log.LogDir(self.make_temp_dir(), get_time=lambda: 0)
+        log = log_dir.make_logger()
+        top = log.child_log("top")
+        middle = top.child_log("middle")
+        for name in ("leaf1", "leaf2"):
+            leaf = middle.child_log(name)
+            leaf.message("hello")
+            fh = leaf.make_file()
+            fh.write("output\n")
+            fh.close()
+            leaf.finish(int(name == failing_leaf))
+        middle.finish(int(failing_leaf is not None))
+        top.finish(int(failing_leaf is not None))
+        if finish:
+            log.finish(0)
+        return log_dir
+
+    def test_events(self):
+        stream = StringIO.StringIO()
+        node = build_log.NodeWriter(build_log.NodeStream(stream), "root")
+        node.new_child("log", [("name", "foo")], id_name="foo")
+        events = list(build_log.read_log_events(
+                StringIO.StringIO(stream.getvalue())))
+        self.assertEquals(events,
+                          [(build_log.NODE_ADDED, "root", "log", "foo"),
+                           (build_log.ATTR_SET, "foo", "name", "foo"),
+                           (build_log.END_OF_LOG,)])
+
+    def test_has_failed(self):
+        self.assertFalse(self.make_log(None).has_failed())
+        self.assertTrue(self.make_log("leaf2").has_failed())
+
+    def test_summary_tree(self):
+        xml = self.make_log("leaf2").get_summary_xml()
+        # Only the failure and the logs it is inside are kept, and
+        # messages are dropped.
+        self.assertEquals(
+            [(node.tag, node.get("name")) for node in xml.iter()],
+            [("root", None), ("log", "top"), ("log", "middle"),
+             ("log", "leaf2"), ("file", None)])
+        assert xml.xpath("log/log/log/file/@pathname")[0].endswith(
+            "-leaf2"), xml.xpath(".//@pathname")
+        xml = self.make_log(None).get_summary_xml()
+        self.assertEquals(xml.xpath("log/@name"), ["top"])
+        self.assertEquals(xml.xpath(".//log/log"), [])
+
+    def test_run_summary(self):
+        self.assertEquals(self.make_log("leaf2").get_run_summary(), None)
+        log_dir = self.make_log("leaf2", finish=True)
+        summary = log_dir.get_run_summary()
+        self.assertEquals((summary.result, summary.start_time,
+                           summary.end_time), ("0", "0", "0"))
+        self.assertEquals(summary.failed,
+                          ["top.middle.leaf2", "top.middle", "top"])
+        self.assertEquals(sorted((filename, int(size)) for log_id, size,
+                                 filename in summary.files),
+                          [("0001-leaf1", 7), ("0002-leaf2", 7)])
+        # The summary gives the same tree as reading the log.
+        self.assertEquals(
+            etree.tostring(log_dir.get_summary_xml()),
+            etree.tostring(log_dir._read_xml(
+                    build_log.SummaryTreeBuilder())))
+        # Once there is a summary, the log itself is not read.
+        write_file(os.path.join(log_dir._dir_path, "0000-log"), "")
+        self.assertTrue(log_dir.has_failed())
+        self.assertFalse(self.make_log(None, finish=True).has_failed())
+        # Unknown kinds of line do not replace the summary's methods.
+        summary = build_log.RunSummary(
+            StringIO.StringIO("result 1\nhas_failed no\n"))
+        self.assertTrue(summary.has_failed())
+
+
+class LogRecorderTest(TempDirTestCase):
+
+    def test_replay(self):
+        times = iter([10, 20])
+        recorder = build_log.LogRecorder(get_time=lambda: next(times))
+        sublog = recorder.child_log("foo")
+        sublog.message("hello")
+        sublog.flush()
+        fh = sublog.make_file()
+        fh.write("output\n")
+        fh.close()
+        sublog.finish(0)
+        log_dir = build_log.LogDir(self.make_temp_dir(), get_time=lambda: 0)
+        log = log_dir.make_logger()
+        build_log.replay_log(recorder.get_records(), log)
+        xml = log_dir.get_xml()
+        self.assertEquals(xml.xpath("log/@name"), ["foo"])
+        self.assertEquals(xml.xpath("log/@result"), ["0"])
+        # The times are those at which the log was recorded.
+        self.assertEquals(xml.xpath("log/@start_time"), ["10"])
+        self.assertEquals(xml.xpath("log/@end_time"), ["20"])
+        self.assertEquals(xml.xpath("log/message/@text"), ["hello"])
+        [pathname] = xml.xpath("log/file/@pathname")
+        self.assertEquals(open(pathname, "r").read(), "output\n")
+
+    def test_replay_given_times(self):
+        # Through a wrapper that passes the times on.
+        recorder = build_log.LogRecorder(get_time=lambda: 10)
+        wrapped = build_log.PrintTitlesLogWriter(StringIO.StringIO(),
+                                                 recorder)
+        sublog = wrapped.child_log("foo", do_start=False)
+        sublog.start(30)
+        sublog.finish(0, 40)
+        log_dir = build_log.LogDir(self.make_temp_dir(), get_time=lambda: 0)
+        build_log.replay_log(recorder.get_records(), log_dir.make_logger())
+        xml = log_dir.get_xml()
+        self.assertEquals(xml.xpath("log/@start_time"), ["30"])
+        self.assertEquals(xml.xpath("log/@end_time"), ["40"])
+
 
 # TODO: remove this.
 class DummyTarget(object):
@@ -175,6 +473,85 @@ class FormattingTest(TempDirTestCase, GoldenTestCase):
                                log_dir, html_file])
         assert os.path.exists(html_file)
 
+    def test_fragment_cache(self):
+        logset = build_log.LogSetDir(self.make_temp_dir())
+        finished = logset.make_logger()
+        finished.child_log("foo").finish(1)
+        finished.finish(1)
+        running = logset.make_logger()
+        sublog = running.child_log("bar")
+        fh = sublog.make_file()
+        cache = build_log.FragmentCache(self.make_temp_dir())
+        mapper = build_log.NullPathnameMapper()
+        rendered = []
+
+        def render(log):
+            rendered.append(log)
+            return build_log.render_short(log, mapper)
+
+        def format_all():
+            return [etree.tostring(cache.get_html(log, "short", mapper,
+                                                  render))
+                    for log in logset.get_logs()]
+
+        html = format_all()
+        self.assertEquals(len(rendered), 2)
+        self.assertEquals(format_all(), html)
+        self.assertEquals(len(rendered), 2)
+        # Elements with empty text come back from the cache unchanged.
+        for log in logset.get_logs():
+            fresh = etree.tostring(build_log.render_long(log, mapper))
+            for i in range(2):
+                self.assertEquals(
+                    etree.tostring(build_log.render_long(log, mapper, cache)),
+                    fresh)
+        # A run that has not finished is rendered again when one of
+        # its files is written to, as well as when its log is.
+        fh.write("output\n")
+        fh.close()
+        format_all()
+        self.assertEquals(len(rendered), 3)
+        self.assertEquals(rendered[-1]._dir_path,
+                          running.get_log_dir()._dir_path)
+        sublog.finish(0)
+        running.finish(0)
+        format_all()
+        format_all()
+        self.assertEquals(len(rendered), 4)
+        # Nothing is cached if the cache directory cannot be made.
+        cache = build_log.FragmentCache(
+            os.path.join(running.get_log_dir()._log_file, "cache"))
+        self.assertEquals(format_all(), format_all())
+        self.assertEquals(len(rendered), 8)
+
+    def test_formatting_in_parallel(self):
+        log_dir = self.make_temp_dir()
+        logset = build_log.LogSetDir(log_dir)
+        for i in range(5):
+            log = logset.make_logger()
+            log.child_log("foo").finish(i % 2)
+            log.finish(i % 2)
+        # An unfinished run's HTML has elements with empty text.
+        logset.make_logger().child_log("bar")
+        output_dir = self.make_temp_dir()
+
+        def format(*args):
+            output_file = os.path.join(output_dir, "log.html")
+            format_log.main(list(args) + [log_dir, output_file])
+            return read_file(output_file)
+
+        self.assertEquals(format("--no-cache", "--jobs", "3"),
+                          format("--no-cache"))
+        self.assertEquals(format("--short", "--jobs", "3"),
+                          format("--short", "--no-cache"))
+        mapper = build_log.NullPathnameMapper()
+        for render in (build_log.render_long, build_log.render_short):
+            self.assertEquals(
+                [etree.tostring(html) for html in build_log.render_logs(
+                        logset.get_logs(), render, mapper, jobs=2)],
+                [etree.tostring(html) for html in build_log.render_logs(
+                        logset.get_logs(), render, mapper, jobs=1)])
+
     def test_time_duration_formatting(self):
         pairs = [(0, "0s"),
                  (0.1, "0s"),
@@ -0,0 +1,65 @@
+
+# Copyright (C) 2008 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+%prog [--binary | --text] <input-log> <output-log>
+
+Convert a log file (0000-log) between the text and binary formats.
+By default it is converted to whichever format it is not in.
+"""
+
+import optparse
+import sys
+
+import build_log
+
+
+def is_binary_log(filename):
+    fh = open(filename, "rb")
+    try:
+        return fh.read(len(build_log.BINARY_MAGIC)) == build_log.BINARY_MAGIC
+    finally:
+        fh.close()
+
+
+def main(argv):
+    parser = optparse.OptionParser(__doc__.strip())
+    parser.add_option("--binary", dest="binary", action="store_true",
+                      default=None, help="Write the binary format")
+    parser.add_option("--text", dest="binary", action="store_false",
+                      help="Write the text format")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error("Expected an input and an output filename")
+    input_filename, output_filename = args
+    binary = options.binary
+    if binary is None:
+        binary = not is_binary_log(input_filename)
+    input_file = open(input_filename, "rb")
+    try:
+        output = open(output_filename, "wb")
+        try:
+            build_log.convert_log(input_file, output, binary)
+        finally:
+            output.close()
+    finally:
+        input_file.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
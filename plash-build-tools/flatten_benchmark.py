@@ -0,0 +1,81 @@
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Times action_tree.flatten_tree(), getting the level and the path of
+each node, on deep and on wide trees of increasing size.  The time per
+node should stay about the same as the trees grow, including for a
+chain of nodes much deeper than the recursion limit.
+
+Usage: python flatten_benchmark.py [max-nodes]
+"""
+
+import sys
+import time
+
+import action_tree
+
+
+def leaf(log):
+    pass
+
+
+def make_chain(size):
+    # Each node has a leaf and the rest of the chain as children.
+    node = action_tree.ActionTreeNode([("leaf", leaf)], "node0")
+    for i in xrange(1, size // 2):
+        node = action_tree.ActionTreeNode([("leaf", leaf),
+                                           ("node%i" % i, node)],
+                                          "node%i" % i)
+    return node
+
+
+def make_wide(size, fanout=10):
+    nodes = [("leaf%i" % i, leaf) for i in xrange(size)]
+    while len(nodes) > 1:
+        nodes = [("node%i" % i,
+                  action_tree.ActionTreeNode(nodes[i:i + fanout],
+                                             "node%i" % i))
+                 for i in xrange(0, len(nodes), fanout)]
+    return nodes[0][1]
+
+
+def time_flatten(tree):
+    start = time.time()
+    count = 0
+    for act in action_tree.flatten_tree(tree):
+        act.get_level()
+        len(act.path)
+        count += 1
+    return count, time.time() - start
+
+
+def main(args):
+    max_nodes = 100000
+    if len(args) > 0:
+        max_nodes = int(args[0])
+    size = 1000
+    while size <= max_nodes:
+        for shape, make_tree in (("deep", make_chain), ("wide", make_wide)):
+            count, taken = time_flatten(make_tree(size))
+            print "%s %7i nodes: %.3fs, %.2fus per node" % (
+                shape, count, taken, taken * 1e6 / count)
+        size *= 10
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
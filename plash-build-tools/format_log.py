@@ -17,13 +17,17 @@
 # 02110-1301, USA.
 
 """
-%prog [--short] <logset-dir> <output-file>
+%prog [--short] [--cache-dir DIR | --no-cache] [--jobs N]
+    <logset-dir> <output-file>
 
-Output HTML version of logs.
+Output HTML version of logs.  The HTML for finished runs is cached, by
+default in html-cache in the logset dir, so that only new and
+unfinished runs are formatted again.
 """
 
 import gc
 import optparse
+import os
 import sys
 
 from build_log import tag
@@ -35,18 +39,31 @@ def main(argv):
     parser.add_option(
         "--short", default=False, dest="short", action="store_true",
         help="Short version, only showing top-level items and errors")
+    parser.add_option(
+        "--cache-dir", dest="cache_dir", default=None,
+        help="Directory for caching the HTML of runs")
+    parser.add_option(
+        "--no-cache", default=False, dest="no_cache", action="store_true",
+        help="Format every run without using the cache")
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", default=1, type="int",
+        help="Number of processes to read and format runs in")
     options, args = parser.parse_args(argv)
     log_dir, output_file = args
     logset = build_log.LogSetDir(log_dir)
+    cache = None
+    if not options.no_cache:
+        cache = build_log.FragmentCache(
+            options.cache_dir or os.path.join(log_dir, "html-cache"))
+    if options.short:
+        render = build_log.render_short
+    else:
+        render = build_log.render_long
     body = build_log.tag("body")
-    for log in logset.get_logs():
-        if options.short:
-            xml = build_log.format_short_summary(
-                log.get_xml(), build_log.NullPathnameMapper())
-        else:
-            xml = build_log.format_top_log(
-                log.get_xml(), build_log.NullPathnameMapper())
-        body.append(xml)
+    for html in build_log.render_logs(logset.get_logs(), render,
+                                      build_log.NullPathnameMapper(), cache,
+                                      options.jobs):
+        body.append(html)
         body.append(tag("hr"))
     build_log.write_xml_file(output_file, build_log.wrap_body(body))
 
@@ -0,0 +1,149 @@
+
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+An index of the runs in a build_log.LogSetDir, kept in an SQLite
+database in the log set's directory, so that runs can be listed and
+queried without walking the YYYY/MM/DD/NNNN tree.
+
+The catalog is updated as runs are created and when their root logs
+finish.  If it is missing, it is rebuilt from the tree.  Runs that
+are deleted or copied in by other means are only noticed by
+LogSetDir.update_catalog().
+"""
+
+import sqlite3
+
+# Raised when the catalog cannot be read or written, e.g. because it
+# is in a read-only directory.
+Error = sqlite3.Error
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY,
+    sort_key TEXT NOT NULL,
+    start_time REAL,
+    end_time REAL,
+    result INTEGER,
+    failed INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_by_sort_key ON runs (sort_key);
+CREATE TABLE IF NOT EXISTS durations (
+    path TEXT NOT NULL,
+    action TEXT NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (path, action)
+);
+CREATE INDEX IF NOT EXISTS durations_by_action ON durations (action);
+"""
+
+
+def get_sort_key(path):
+    # Runs are ordered by the numbers in their paths, as numbers
+    # rather than as strings.
+    return "/".join("%010i" % int(component) for component in path.split("/"))
+
+
+class LogCatalog(object):
+
+    """Paths are relative to the log set's directory."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Several processes may use the catalog, so connections are
+        # not kept open.
+        conn = sqlite3.connect(self._filename, timeout=60)
+        conn.text_factory = str
+        return conn
+
+    def _execute(self, query, args=()):
+        conn = self._connect()
+        try:
+            rows = conn.execute(query, args).fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def add_run(self, path, start_time=None, end_time=None, result=None,
+                failed=None, durations=None):
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO runs"
+                         " VALUES (?, ?, ?, ?, ?, ?)",
+                         (path, get_sort_key(path), start_time, end_time,
+                          result, failed))
+            conn.execute("DELETE FROM durations WHERE path = ?", (path,))
+            if durations is not None:
+                conn.executemany("INSERT INTO durations VALUES (?, ?, ?)",
+                                 [(path, key, duration) for key, duration
+                                  in durations.iteritems()])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove_runs(self, paths):
+        conn = self._connect()
+        try:
+            for path in paths:
+                conn.execute("DELETE FROM runs WHERE path = ?", (path,))
+                conn.execute("DELETE FROM durations WHERE path = ?", (path,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_paths(self, failed=None, since=None, limit=None):
+        """Returns the paths of runs, most recent first.  failed, if
+        given, selects runs that did or did not fail; runs that did not
+        finish have neither.  since selects runs that started (or for
+        old runs, were last written) at or after that time."""
+        conditions = []
+        args = []
+        if failed is not None:
+            conditions.append("failed = ?")
+            args.append(int(failed))
+        if since is not None:
+            conditions.append("coalesce(start_time, end_time) >= ?")
+            args.append(since)
+        query = "SELECT path FROM runs"
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY sort_key DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        return [path for (path,) in self._execute(query, args)]
+
+    def get_action_durations(self, action, limit=None):
+        """Returns (path, duration) pairs for the runs in which action
+        succeeded, most recent first."""
+        query = ("SELECT runs.path, duration FROM durations"
+                 " JOIN runs ON runs.path = durations.path"
+                 " WHERE action = ? ORDER BY sort_key DESC")
+        args = [action]
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        return self._execute(query, args)
@@ -0,0 +1,159 @@
+# Copyright (C) 2008 Mark Seaborn
+#
+# chroot_build is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation; either version 2.1 of the
+# License, or (at your option) any later version.
+#
+# chroot_build is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with chroot_build; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import hashlib
+import os
+import threading
+
+
+def hash_file(pathname):
+    digest = hashlib.sha1()
+    fh = open(pathname, "rb")
+    try:
+        while True:
+            data = fh.read(65536)
+            if len(data) == 0:
+                break
+            digest.update(data)
+    finally:
+        fh.close()
+    return digest.hexdigest()
+
+
+def walk_files(pathname):
+    if os.path.isdir(pathname):
+        for dir_path, dirnames, filenames in os.walk(pathname):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(dir_path, filename)
+    else:
+        yield pathname
+
+
+class StampDB(object):
+
+    """Records a digest of the declared inputs of each action that
+    completed successfully, so that it can be skipped next time if
+    they have not changed.
+
+    The database is an append-only text file, so a crash loses at
+    most the record being written.  Later lines override earlier
+    ones.  It also caches file content hashes by size and mtime so
+    that unchanged inputs are not re-read on every run.
+
+      A <digest> <action key>
+      F <size> <mtime> <sha1> <pathname>
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._actions = {}
+        self._files = {}
+        line_count = 0
+        if os.path.exists(filename):
+            fh = open(filename, "r")
+            try:
+                for line in fh:
+                    line_count += 1
+                    self._read_line(line.rstrip("\n"))
+            finally:
+                fh.close()
+        if line_count > 2 * (len(self._actions) + len(self._files)):
+            self._compact()
+        self._output = open(filename, "a")
+
+    def _read_line(self, line):
+        kind, sep, rest = line.partition(" ")
+        if kind == "A":
+            digest, sep, key = rest.partition(" ")
+            self._actions[key] = digest
+        elif kind == "F":
+            size, mtime, digest, pathname = rest.split(" ", 3)
+            self._files[pathname] = (int(size), mtime, digest)
+
+    def _format_lines(self):
+        for pathname, (size, mtime, digest) in sorted(self._files.items()):
+            yield "F %i %s %s %s\n" % (size, mtime, digest, pathname)
+        for key, digest in sorted(self._actions.items()):
+            yield "A %s %s\n" % (digest, key)
+
+    def _compact(self):
+        temp_filename = self._filename + ".tmp"
+        fh = open(temp_filename, "w")
+        try:
+            fh.writelines(self._format_lines())
+        finally:
+            fh.close()
+        os.rename(temp_filename, self._filename)
+
+    def _write(self, line):
+        self._output.write(line)
+        self._output.flush()
+
+    def _hash_file(self, pathname):
+        try:
+            st = os.stat(pathname)
+        except OSError:
+            return "missing"
+        mtime = repr(st.st_mtime)
+        cached = self._files.get(pathname)
+        if cached is not None and cached[:2] == (st.st_size, mtime):
+            return cached[2]
+        digest = hash_file(pathname)
+        self._files[pathname] = (st.st_size, mtime, digest)
+        if "\n" not in pathname:
+            self._write("F %i %s %s %s\n" % (st.st_size, mtime, digest,
+                                             pathname))
+        return digest
+
+    def get_digest(self, action):
+        """Returns a digest of action's declared inputs, or None if it
+        declares none, in which case it should always be run."""
+        input_files = getattr(action, "input_files", None)
+        input_params = getattr(action, "input_params", None)
+        if input_files is None and input_params is None:
+            return None
+        digest = hashlib.sha1()
+        digest.update(repr(input_params))
+        self._lock.acquire()
+        try:
+            for input_path in input_files or ():
+                for pathname in walk_files(os.path.abspath(input_path)):
+                    digest.update("\0%s\0%s" % (pathname,
+                                                self._hash_file(pathname)))
+        finally:
+            self._lock.release()
+        return digest.hexdigest()
+
+    def is_up_to_date(self, key, digest):
+        return digest is not None and self._actions.get(key) == digest
+
+    def record(self, key, digest):
+        if digest is None or "\n" in key:
+            return
+        self._lock.acquire()
+        try:
+            if self._actions.get(key) == digest:
+                return
+            self._actions[key] = digest
+            self._write("A %s %s\n" % (digest, key))
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._output.close()